@@ -2,11 +2,22 @@ import os
 import re
 import io
 import html
+import time
+import atexit
+import asyncio
 import sqlite3
 import secrets
+import hashlib
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, List, Tuple, Dict
+import functools
+import itertools
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Tuple, Dict, Iterable, Iterator, Set
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -15,8 +26,10 @@ from telegram import (
     KeyboardButton,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -38,9 +51,6 @@ logger = logging.getLogger("shopbot")
 TOKEN = os.getenv("TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # Owner / Main Admin
 DB_PATH = os.getenv("DB_PATH", "shop.db")
-_db_dir = os.path.dirname(DB_PATH) if DB_PATH else ""
-if _db_dir:
-    os.makedirs(_db_dir, exist_ok=True)
 CURRENCY = os.getenv("CURRENCY", "$")
 BINANCE_UID = os.getenv("BINANCE_ID", "YOUR_BINANCE_ID_ADDRESS")
 BYBIT_UID = os.getenv("BYBIT_UID", "12345678")
@@ -55,10 +65,11 @@ HIDDEN_CATEGORIES = {
     "🟦 STEAM (USA)",
     "🪂 PUBG MOBILE UC",
 }
-if not TOKEN:
-    raise RuntimeError("TOKEN env var is missing")
-if ADMIN_ID == 0:
-    raise RuntimeError("ADMIN_ID env var is missing or 0")
+def check_env():
+    if not TOKEN:
+        raise RuntimeError("TOKEN env var is missing")
+    if ADMIN_ID == 0:
+        raise RuntimeError("ADMIN_ID env var is missing or 0")
 # =========================
 # Admin roles
 # =========================
@@ -112,320 +123,757 @@ def extract_sort_value(title: str) -> float:
 # =========================
 # DB
 # =========================
-con = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = con.cursor()
-cur.executescript(
-    """
-PRAGMA journal_mode=WAL;
-PRAGMA foreign_keys=ON;
-CREATE TABLE IF NOT EXISTS users(
-  user_id INTEGER PRIMARY KEY,
-  username TEXT,
-  first_name TEXT,
-  balance REAL NOT NULL DEFAULT 0
-);
-CREATE TABLE IF NOT EXISTS categories(
-  cid INTEGER PRIMARY KEY AUTOINCREMENT,
-  title TEXT NOT NULL UNIQUE
-);
-CREATE TABLE IF NOT EXISTS products(
-  pid INTEGER PRIMARY KEY AUTOINCREMENT,
-  cid INTEGER NOT NULL,
-  title TEXT NOT NULL,
-  price REAL NOT NULL,
-  product_type TEXT NOT NULL DEFAULT 'CODE',
-  active INTEGER NOT NULL DEFAULT 1,
-  FOREIGN KEY(cid) REFERENCES categories(cid)
-);
-CREATE TABLE IF NOT EXISTS codes(
-  code_id INTEGER PRIMARY KEY AUTOINCREMENT,
-  pid INTEGER NOT NULL,
-  code_text TEXT NOT NULL,
-  used INTEGER NOT NULL DEFAULT 0,
-  used_at TEXT,
-  order_id INTEGER,
-  FOREIGN KEY(pid) REFERENCES products(pid)
-);
-CREATE TABLE IF NOT EXISTS orders(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER NOT NULL,
-  pid INTEGER NOT NULL,
-  product_title TEXT NOT NULL,
-  qty INTEGER NOT NULL,
-  total REAL NOT NULL,
-  status TEXT NOT NULL DEFAULT 'PENDING',
-  delivered_text TEXT,
-  created_at TEXT NOT NULL DEFAULT (datetime('now'))
-);
-CREATE TABLE IF NOT EXISTS deposits(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER NOT NULL,
-  method TEXT NOT NULL,
-  note TEXT NOT NULL,
-  txid TEXT,
-  amount REAL,
-  status TEXT NOT NULL DEFAULT 'WAITING_PAYMENT',
-  created_at TEXT NOT NULL DEFAULT (datetime('now'))
-);
-CREATE TABLE IF NOT EXISTS manual_orders(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER NOT NULL,
-  service TEXT NOT NULL,
-  plan_title TEXT NOT NULL,
-  price REAL NOT NULL,
-  email TEXT,
-  password TEXT,
-  player_id TEXT,
-  note TEXT,
-  status TEXT NOT NULL DEFAULT 'PENDING',
-  delivered_text TEXT,
-  created_at TEXT NOT NULL DEFAULT (datetime('now'))
-);
-CREATE TABLE IF NOT EXISTS manual_prices(
-  pkey TEXT PRIMARY KEY,
-  price REAL NOT NULL
-);
-"""
-)
-con.commit()
-def ensure_schema():
-    # unique code per product
-    try:
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_unique ON codes(pid, code_text)")
-        con.commit()
-    except Exception:
-        pass
-    # helpful indexes
-    try:
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_codes_pid_used ON codes(pid, used)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_deposits_user_status ON deposits(user_id, status)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_manual_user_status ON manual_orders(user_id, status)")
-        con.commit()
-    except Exception:
-        pass
-    # migrate manual_orders columns if missing
-    for col, ctype in [("player_id", "TEXT"), ("note", "TEXT"), ("delivered_text", "TEXT")]:
+# Every thread (the event loop + the DB workers) gets its own connection,
+# so slow queries can run off the loop without sharing a cursor.
+# Helpers use db_read() (per-thread read-only WAL connection) and
+# db_write() (one shared writer connection, serialized by a lock).
+# Non-critical writes (db_write(durable=False)) are group-committed: they stay
+# in the open writer transaction until DB_BATCH_MAX_DELAY_MS passes,
+# DB_BATCH_MAX_STATEMENTS blocks pile up, or a durable write commits them.
+DB_WORKERS = max(1, int(os.getenv("DB_WORKERS", "4")))
+DB_BATCH_MAX_DELAY_MS = max(1, int(os.getenv("DB_BATCH_MAX_DELAY_MS", "250")))
+DB_BATCH_MAX_STATEMENTS = max(1, int(os.getenv("DB_BATCH_MAX_STATEMENTS", "64")))
+_db_local = threading.local()
+_db_write_lock = threading.RLock()
+_db_writer: Optional[sqlite3.Connection] = None
+_db_write_depth = 0
+_db_batch_pending = 0
+_db_batch_durable = False
+def _reader_db() -> sqlite3.Connection:
+    c = getattr(_db_local, "reader", None)
+    if c is None:
+        uri = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+        c = sqlite3.connect(uri, uri=True, timeout=30)
+        _db_local.reader = c
+    return c
+def _writer_db() -> sqlite3.Connection:
+    global _db_writer
+    if _db_writer is None:
+        c = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False, isolation_level=None)
+        c.execute("PRAGMA foreign_keys=ON")
+        _db_writer = c
+        threading.Thread(target=_db_flush_loop, name="db-flush", daemon=True).start()
+    return _db_writer
+def db_flush():
+    """Commit any group-committed writes still sitting in the writer transaction."""
+    global _db_batch_pending
+    with _db_write_lock:
+        if _db_writer is None or _db_write_depth:
+            return
+        if _db_writer.in_transaction:
+            _db_writer.execute("COMMIT")
+        _db_batch_pending = 0
+def _db_flush_loop():
+    while True:
+        time.sleep(DB_BATCH_MAX_DELAY_MS / 1000)
         try:
-            cur.execute(f"ALTER TABLE manual_orders ADD COLUMN {col} {ctype}")
-            con.commit()
-        except Exception:
-            pass
-    # ✅ Anti double-confirm: add client_ref unique to orders
-    try:
-        cur.execute("ALTER TABLE orders ADD COLUMN client_ref TEXT")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_client_ref_unique ON orders(client_ref)")
-        con.commit()
-    except Exception:
-        pass
-    # ✅ User suspend
+            db_flush()
+        except sqlite3.Error:
+            logger.exception("Group commit flush failed")
+atexit.register(db_flush)
+@contextmanager
+def db_read():
+    c = _reader_db().cursor()
     try:
-        cur.execute("ALTER TABLE users ADD COLUMN suspended INTEGER NOT NULL DEFAULT 0")
-        con.commit()
-    except Exception:
-        pass
-    # ✅ Admins table (Owner + Helpers)
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS admins(
-              user_id INTEGER PRIMARY KEY,
-              role TEXT NOT NULL
-            )
-            """
+        yield c
+    finally:
+        c.close()
+@contextmanager
+def db_write(durable: bool = True):
+    """
+    Cursor on the single writer connection. Each block runs in a savepoint, so
+    a failing block only undoes its own work; nested blocks join the outer one.
+    The outermost durable block commits right away (together with any batched
+    writes before it); durable=False leaves the commit to the group flusher.
+    """
+    global _db_write_depth, _db_batch_pending, _db_batch_durable
+    with _db_write_lock:
+        c = _writer_db()
+        if not c.in_transaction:
+            c.execute("BEGIN IMMEDIATE")
+        _db_write_depth += 1
+        sp = f"w{_db_write_depth}"
+        c.execute(f"SAVEPOINT {sp}")
+        wcur = c.cursor()
+        try:
+            yield wcur
+        except BaseException:
+            try:
+                c.execute(f"ROLLBACK TO {sp}")
+                c.execute(f"RELEASE {sp}")
+            except sqlite3.Error:
+                if c.in_transaction:
+                    c.execute("ROLLBACK")
+                    _users_seen.clear()
+                _db_batch_pending = 0
+                _db_batch_durable = False
+            raise
+        else:
+            c.execute(f"RELEASE {sp}")
+            _db_batch_durable = _db_batch_durable or durable
+            if _db_write_depth == 1:
+                _db_batch_pending += 1
+                if _db_batch_durable or _db_batch_pending >= DB_BATCH_MAX_STATEMENTS:
+                    c.execute("COMMIT")
+                    _db_batch_pending = 0
+                    _db_batch_durable = False
+        finally:
+            _db_write_depth -= 1
+            wcur.close()
+def db_fetchone(sql: str, params: tuple = ()) -> Optional[tuple]:
+    with db_read() as c:
+        c.execute(sql, params)
+        return c.fetchone()
+def db_fetchall(sql: str, params: tuple = ()) -> List[tuple]:
+    with db_read() as c:
+        c.execute(sql, params)
+        return c.fetchall()
+def db_execute(sql: str, params: tuple = ()) -> int:
+    # single-statement write; handlers call it through run_db so the writer lock is never taken on the loop
+    with db_write() as c:
+        c.execute(sql, params)
+        return c.rowcount
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking DB helper on the DB thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+def rebuild_user_stats(c) -> int:
+    # recompute user_stats from orders / manual_orders / deposits using cursor c
+    c.execute("DELETE FROM user_stats")
+    c.execute(
+        """
+        INSERT INTO user_stats(user_id, orders_count, orders_spent, manual_count, manual_spent, deposits_approved)
+        SELECT u.user_id,
+               COALESCE(o.cnt, 0), COALESCE(o.spent, 0),
+               COALESCE(m.cnt, 0), COALESCE(m.spent, 0),
+               COALESCE(d.total, 0)
+        FROM users u
+        LEFT JOIN (SELECT user_id, COUNT(*) cnt, SUM(total) spent FROM orders WHERE status='COMPLETED' GROUP BY user_id) o ON o.user_id=u.user_id
+        LEFT JOIN (SELECT user_id, COUNT(*) cnt, SUM(price) spent FROM manual_orders WHERE status='COMPLETED' GROUP BY user_id) m ON m.user_id=u.user_id
+        LEFT JOIN (SELECT user_id, SUM(amount) total FROM deposits WHERE status='APPROVED' GROUP BY user_id) d ON d.user_id=u.user_id
+        WHERE o.user_id IS NOT NULL OR m.user_id IS NOT NULL OR d.user_id IS NOT NULL
+        """
+    )
+    return c.rowcount
+def day_range_ts(day: str) -> Tuple[int, int]:
+    # [start, end) epoch seconds of a UTC "YYYY-MM-DD" day, for *_ts range predicates
+    start = int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+    return start, start + 86400
+def rebuild_daily_rollups(c, day: Optional[str] = None) -> int:
+    # recompute ledger_daily / activity_daily from the base tables using cursor c;
+    # with `day`, only that UTC day is rebuilt (index range scans on created_ts / approved_ts)
+    if day:
+        args = day_range_ts(day)
+        rng = " AND created_ts >= ? AND created_ts < ?"
+        rng_dep = " AND approved_ts >= ? AND approved_ts < ?"
+        c.execute("DELETE FROM ledger_daily WHERE day=?", (day,))
+    else:
+        args = ()
+        rng = rng_dep = ""
+        c.execute("DELETE FROM ledger_daily")
+    c.execute(
+        """
+        INSERT INTO ledger_daily(day, user_id, opening, net, total_in, total_out, tx_count, order_out, manual_out, deposit_in)
+        SELECT g.day, g.user_id, bl.balance_before, g.net, g.total_in, g.total_out, g.tx_count, g.order_out, g.manual_out, g.deposit_in
+        FROM (
+          SELECT date(created_at) day, user_id, MIN(id) first_id,
+                 SUM(delta) net,
+                 SUM(CASE WHEN delta>0 THEN delta ELSE 0 END) total_in,
+                 SUM(CASE WHEN delta<0 THEN -delta ELSE 0 END) total_out,
+                 COUNT(*) tx_count,
+                 SUM(CASE WHEN source_type='ORDER_PURCHASE' THEN -delta ELSE 0 END) order_out,
+                 SUM(CASE WHEN source_type IN ('MANUAL_SHAHID_CHARGE','MANUAL_FF_CHARGE') THEN -delta ELSE 0 END) manual_out,
+                 SUM(CASE WHEN source_type='DEPOSIT_APPROVED' THEN delta ELSE 0 END) deposit_in
+          FROM balance_ledger WHERE 1=1{rng} GROUP BY date(created_at), user_id
+        ) g JOIN balance_ledger bl ON bl.id=g.first_id
+        """.format(rng=rng),
+        args,
+    )
+    n = c.rowcount
+    if day:
+        c.execute("DELETE FROM activity_daily WHERE day=?", (day,))
+    else:
+        c.execute("DELETE FROM activity_daily")
+    c.execute(
+        """
+        INSERT INTO activity_daily(day, user_id, orders_total, manual_total, deposits_total)
+        SELECT day, user_id, SUM(o), SUM(m), SUM(d) FROM (
+          SELECT date(created_at) day, user_id, total o, 0 m, 0 d FROM orders WHERE status='COMPLETED'{rng}
+          UNION ALL
+          SELECT date(created_at), user_id, 0, CASE WHEN status!='REJECTED' THEN price ELSE 0 END, 0 FROM manual_orders WHERE 1=1{rng}
+          UNION ALL
+          SELECT date(COALESCE(approved_at, created_at)), user_id, 0, 0, amount FROM deposits WHERE status='APPROVED'{rng_dep}
+        ) GROUP BY day, user_id
+        """.format(rng=rng, rng_dep=rng_dep),
+        args * 3,
+    )
+    return n + c.rowcount
+# =========================
+# Schema migrations
+# =========================
+# Each migration is (version, description, steps); a step is one SQL statement or a callable(cursor).
+# Steps must tolerate a database that already has the object (old deployments were migrated by
+# ad-hoc try/except blocks), hence IF NOT EXISTS everywhere and _add_column for ALTERs.
+def _add_column(c, table: str, col: str, decl: str):
+    c.execute(f"PRAGMA table_xinfo({table})")
+    if col not in {r[1] for r in c.fetchall()}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+def _m_legacy_columns(c):
+    for col in ("player_id", "note", "delivered_text"):
+        _add_column(c, "manual_orders", col, "TEXT")
+    _add_column(c, "orders", "client_ref", "TEXT")
+    _add_column(c, "users", "suspended", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(c, "manual_orders", "approved_by", "INTEGER")
+    _add_column(c, "deposits", "approved_at", "TEXT")
+def _m_epoch_columns(c):
+    ts_expr = "CAST(strftime('%s', {}) AS INTEGER)"
+    for table, col, src in [
+        ("orders", "created_ts", "created_at"),
+        ("manual_orders", "created_ts", "created_at"),
+        ("deposits", "created_ts", "created_at"),
+        ("deposits", "approved_ts", "COALESCE(approved_at, created_at)"),
+        ("balance_ledger", "created_ts", "created_at"),
+        ("reseller_profit_log", "created_ts", "created_at"),
+    ]:
+        _add_column(c, table, col, f"INTEGER GENERATED ALWAYS AS ({ts_expr.format(src)}) VIRTUAL")
+def _m_products_sort_value(c):
+    _add_column(c, "products", "sort_value", "REAL")
+    c.execute("SELECT pid, title FROM products WHERE sort_value IS NULL")
+    missing = [(extract_sort_value(title), pid) for pid, title in c.fetchall()]
+    if missing:
+        c.executemany("UPDATE products SET sort_value=? WHERE pid=?", missing)
+CODE_RULE_DEFAULTS = [
+    ("FF16", r"\d{16}", "Free Fire code must be 16 digits فقط.\nمثال: 1234567890123456"),
+    ("PUBG18", r"[A-Za-z0-9]{18}", "PUBG code must be 18 characters (A-Z a-z 0-9)."),
+]
+def _m_code_rules(c):
+    c.executemany("INSERT OR IGNORE INTO code_rules(rule, pattern, message) VALUES(?,?,?)", CODE_RULE_DEFAULTS)
+    _add_column(c, "products", "code_rule", "TEXT")
+    c.execute(
+        """
+        SELECT p.pid, p.title, c.title
+        FROM products p
+        JOIN categories c ON c.cid=p.cid
+        WHERE p.code_rule IS NULL
+        """
+    )
+    rules = [(guess_code_rule(pt, ct), pid) for pid, pt, ct in c.fetchall()]
+    rules = [r for r in rules if r[0]]
+    if rules:
+        c.executemany("UPDATE products SET code_rule=? WHERE pid=?", rules)
+CODE_HASH_INDEX_SQL = "CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_hash ON codes(code_hash)"
+def _duplicate_code_copies(c) -> List[Tuple[int, int, int, str, int, int, int]]:
+    # every extra copy of a voucher: (code_hash, code_id, pid, code_text, used, kept_code_id, kept_pid).
+    # The kept copy is a sold one if there is one, else the oldest.
+    c.execute(
+        """
+        SELECT code_hash FROM codes WHERE code_hash IS NOT NULL
+        GROUP BY code_hash HAVING COUNT(*) > 1
+        """
+    )
+    out = []
+    for (h,) in c.fetchall():
+        c.execute("SELECT code_id, pid, code_text, used FROM codes WHERE code_hash=? ORDER BY used DESC, code_id ASC", (h,))
+        (keep_id, keep_pid, _, _), *extra = c.fetchall()
+        out.extend((h, code_id, pid, text, used, keep_id, keep_pid) for code_id, pid, text, used in extra)
+    return out
+def dedupe_codes(c) -> int:
+    # owner-confirmed (/dupcodes resolve): drop extra unsold copies, then enable the unique index.
+    # Returns the number of codes removed from stock.
+    removed = 0
+    for h, code_id, _, _, used, _, _ in _duplicate_code_copies(c):
+        if used:
+            c.execute("UPDATE codes SET code_hash=NULL WHERE code_id=?", (code_id,))
+        else:
+            c.execute("DELETE FROM codes WHERE code_id=?", (code_id,))
+            removed += 1
+    c.execute(CODE_HASH_INDEX_SQL)
+    return removed
+def _m_code_hash(c):
+    # fingerprint every code. Copies of the same voucher are reported but never deleted here:
+    # if any unsold copy is duplicated the unique index waits for /dupcodes resolve.
+    _add_column(c, "codes", "code_hash", "INTEGER")
+    c.execute("SELECT code_id, code_text FROM codes WHERE code_hash IS NULL")
+    rows = [(code_fingerprint(text), code_id) for code_id, text in c.fetchall()]
+    if rows:
+        c.executemany("UPDATE codes SET code_hash=? WHERE code_id=?", rows)
+    unsold = 0
+    for h, code_id, pid, text, used, keep_id, keep_pid in _duplicate_code_copies(c):
+        c.execute(
+            "INSERT INTO code_collisions(code_hash, code_text, pid, existing_pid, existing_code_id, source) VALUES(?,?,?,?,?,'migration')",
+            (h, text, pid, keep_pid, keep_id),
         )
-        con.commit()
-    except Exception:
-        pass
-    # ✅ manual_orders approved_by (admin id)
-    try:
-        cur.execute("ALTER TABLE manual_orders ADD COLUMN approved_by INTEGER")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE deposits ADD COLUMN approved_at TEXT")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS balance_ledger(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              user_id INTEGER NOT NULL,
-              delta REAL NOT NULL,
-              balance_before REAL NOT NULL,
-              balance_after REAL NOT NULL,
-              source_type TEXT NOT NULL,
-              source_id TEXT,
-              note TEXT,
-              created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-            """
+        if used:
+            # already delivered twice: keep the order history, drop the fingerprint
+            c.execute("UPDATE codes SET code_hash=NULL WHERE code_id=?", (code_id,))
+        else:
+            unsold += 1
+    if unsold:
+        logger.warning("%s unsold codes duplicate another code; left in stock, see /dupcodes", unsold)
+    else:
+        c.execute(CODE_HASH_INDEX_SQL)
+def _m_code_fingerprints(c):
+    # sold codes of products deleted before this table existed only survive in their orders
+    c.execute(
+        """
+        SELECT o.id, o.pid, o.delivered_text FROM orders o
+        LEFT JOIN products p ON p.pid=o.pid
+        WHERE p.pid IS NULL AND o.status='COMPLETED' AND o.delivered_text IS NOT NULL
+        """
+    )
+    rows = [
+        (code_fingerprint(cc), pid, cc, oid)
+        for oid, pid, text in c.fetchall()
+        for cc in (line.strip() for line in text.splitlines()) if cc
+    ]
+    if rows:
+        c.executemany("INSERT OR IGNORE INTO code_fingerprints(code_hash, pid, code_text, order_id) VALUES(?,?,?,?)", rows)
+# unsold stock per product, straight off idx_codes_unused (also used to rebuild product_stock)
+CODE_STOCK_SQL = "SELECT pid, COUNT(*) FROM codes WHERE used=0 GROUP BY pid"
+MIGRATIONS: List[Tuple[int, str, list]] = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users(
+          user_id INTEGER PRIMARY KEY,
+          username TEXT,
+          first_name TEXT,
+          balance REAL NOT NULL DEFAULT 0
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user_created ON balance_ledger(user_id, created_at)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS manual_flags(
-              fkey TEXT PRIMARY KEY,
-              enabled INTEGER NOT NULL DEFAULT 1
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS categories(
+          cid INTEGER PRIMARY KEY AUTOINCREMENT,
+          title TEXT NOT NULL UNIQUE
         )
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS audit_alerts(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              audit_date TEXT NOT NULL,
-              user_id INTEGER NOT NULL,
-              issue_key TEXT NOT NULL,
-              created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS products(
+          pid INTEGER PRIMARY KEY AUTOINCREMENT,
+          cid INTEGER NOT NULL,
+          title TEXT NOT NULL,
+          price REAL NOT NULL,
+          product_type TEXT NOT NULL DEFAULT 'CODE',
+          active INTEGER NOT NULL DEFAULT 1,
+          FOREIGN KEY(cid) REFERENCES categories(cid)
         )
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_audit_alert_unique ON audit_alerts(audit_date, user_id, issue_key)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_product_prices(
-              user_id INTEGER NOT NULL,
-              pid INTEGER NOT NULL,
-              price REAL NOT NULL,
-              created_at TEXT NOT NULL DEFAULT (datetime('now')),
-              PRIMARY KEY(user_id, pid)
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS codes(
+          code_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          pid INTEGER NOT NULL,
+          code_text TEXT NOT NULL,
+          used INTEGER NOT NULL DEFAULT 0,
+          used_at TEXT,
+          order_id INTEGER,
+          FOREIGN KEY(pid) REFERENCES products(pid)
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_product_prices_pid ON user_product_prices(pid)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_manual_prices(
-              user_id INTEGER NOT NULL,
-              pkey TEXT NOT NULL,
-              price REAL NOT NULL,
-              created_at TEXT NOT NULL DEFAULT (datetime('now')),
-              PRIMARY KEY(user_id, pkey)
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          pid INTEGER NOT NULL,
+          product_title TEXT NOT NULL,
+          qty INTEGER NOT NULL,
+          total REAL NOT NULL,
+          status TEXT NOT NULL DEFAULT 'PENDING',
+          delivered_text TEXT,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_manual_prices_pkey ON user_manual_prices(pkey)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS pos_product_prices(
-              reseller_id INTEGER NOT NULL,
-              client_user_id INTEGER NOT NULL,
-              pid INTEGER NOT NULL,
-              price REAL NOT NULL,
-              created_at TEXT NOT NULL DEFAULT (datetime('now')),
-              PRIMARY KEY(reseller_id, client_user_id, pid)
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS deposits(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          method TEXT NOT NULL,
+          note TEXT NOT NULL,
+          txid TEXT,
+          amount REAL,
+          status TEXT NOT NULL DEFAULT 'WAITING_PAYMENT',
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_pos_product_prices_client ON pos_product_prices(client_user_id)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS pos_manual_prices(
-              reseller_id INTEGER NOT NULL,
-              client_user_id INTEGER NOT NULL,
-              pkey TEXT NOT NULL,
-              price REAL NOT NULL,
-              created_at TEXT NOT NULL DEFAULT (datetime('now')),
-              PRIMARY KEY(reseller_id, client_user_id, pkey)
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS manual_orders(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          service TEXT NOT NULL,
+          plan_title TEXT NOT NULL,
+          price REAL NOT NULL,
+          email TEXT,
+          password TEXT,
+          player_id TEXT,
+          note TEXT,
+          status TEXT NOT NULL DEFAULT 'PENDING',
+          delivered_text TEXT,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_pos_manual_prices_client ON pos_manual_prices(client_user_id)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS resellers(
-              user_id INTEGER PRIMARY KEY,
-              active INTEGER NOT NULL DEFAULT 1,
-              profit_balance REAL NOT NULL DEFAULT 0,
-              created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS manual_prices(
+          pkey TEXT PRIMARY KEY,
+          price REAL NOT NULL
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_resellers_active ON resellers(active)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS reseller_clients(
-              client_user_id INTEGER PRIMARY KEY,
-              reseller_id INTEGER NOT NULL,
-              created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-            """
+        """,
+    ]),
+    (2, "legacy columns (manual_orders extras, orders.client_ref, users.suspended, approvals)", [
+        _m_legacy_columns,
+    ]),
+    (3, "unique codes, client_ref and lookup indexes", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_unique ON codes(pid, code_text)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_client_ref_unique ON orders(client_ref)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_codes_pid_used ON codes(pid, used)",
+        "CREATE INDEX IF NOT EXISTS idx_deposits_user_status ON deposits(user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_manual_user_status ON manual_orders(user_id, status)",
+    ]),
+    (4, "admins, manual_flags, balance_ledger, audit_alerts", [
+        """
+        CREATE TABLE IF NOT EXISTS admins(
+          user_id INTEGER PRIMARY KEY,
+          role TEXT NOT NULL
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_reseller_clients_reseller ON reseller_clients(reseller_id)")
-        con.commit()
-    except Exception:
-        pass
-    try:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS reseller_profit_log(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              reseller_id INTEGER NOT NULL,
-              amount REAL NOT NULL,
-              source_type TEXT NOT NULL,
-              source_id TEXT,
-              note TEXT,
-              created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-            """
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS manual_flags(
+          fkey TEXT PRIMARY KEY,
+          enabled INTEGER NOT NULL DEFAULT 1
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS balance_ledger(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          delta REAL NOT NULL,
+          balance_before REAL NOT NULL,
+          balance_after REAL NOT NULL,
+          source_type TEXT NOT NULL,
+          source_id TEXT,
+          note TEXT,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user_created ON balance_ledger(user_id, created_at)",
+        """
+        CREATE TABLE IF NOT EXISTS audit_alerts(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          audit_date TEXT NOT NULL,
+          user_id INTEGER NOT NULL,
+          issue_key TEXT NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_audit_alert_unique ON audit_alerts(audit_date, user_id, issue_key)",
+    ]),
+    (5, "per-user and POS price overrides", [
+        """
+        CREATE TABLE IF NOT EXISTS user_product_prices(
+          user_id INTEGER NOT NULL,
+          pid INTEGER NOT NULL,
+          price REAL NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          PRIMARY KEY(user_id, pid)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_product_prices_pid ON user_product_prices(pid)",
+        """
+        CREATE TABLE IF NOT EXISTS user_manual_prices(
+          user_id INTEGER NOT NULL,
+          pkey TEXT NOT NULL,
+          price REAL NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          PRIMARY KEY(user_id, pkey)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_manual_prices_pkey ON user_manual_prices(pkey)",
+        """
+        CREATE TABLE IF NOT EXISTS pos_product_prices(
+          reseller_id INTEGER NOT NULL,
+          client_user_id INTEGER NOT NULL,
+          pid INTEGER NOT NULL,
+          price REAL NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          PRIMARY KEY(reseller_id, client_user_id, pid)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pos_product_prices_client ON pos_product_prices(client_user_id)",
+        """
+        CREATE TABLE IF NOT EXISTS pos_manual_prices(
+          reseller_id INTEGER NOT NULL,
+          client_user_id INTEGER NOT NULL,
+          pkey TEXT NOT NULL,
+          price REAL NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          PRIMARY KEY(reseller_id, client_user_id, pkey)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pos_manual_prices_client ON pos_manual_prices(client_user_id)",
+    ]),
+    (6, "resellers", [
+        """
+        CREATE TABLE IF NOT EXISTS resellers(
+          user_id INTEGER PRIMARY KEY,
+          active INTEGER NOT NULL DEFAULT 1,
+          profit_balance REAL NOT NULL DEFAULT 0,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_resellers_active ON resellers(active)",
+        """
+        CREATE TABLE IF NOT EXISTS reseller_clients(
+          client_user_id INTEGER PRIMARY KEY,
+          reseller_id INTEGER NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_reseller_clients_reseller ON reseller_clients(reseller_id)",
+        """
+        CREATE TABLE IF NOT EXISTS reseller_profit_log(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          reseller_id INTEGER NOT NULL,
+          amount REAL NOT NULL,
+          source_type TEXT NOT NULL,
+          source_id TEXT,
+          note TEXT,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_reseller_profit_log_reseller_created ON reseller_profit_log(reseller_id, created_at)",
+    ]),
+    # ✅ Stock counters: unused codes per product, kept in sync by triggers on codes/products
+    (7, "product_stock counters", [
+        """
+        CREATE TABLE IF NOT EXISTS product_stock(
+          pid INTEGER PRIMARY KEY,
+          available INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_codes_stock_ins AFTER INSERT ON codes WHEN NEW.used=0
+        BEGIN
+          INSERT INTO product_stock(pid, available) VALUES(NEW.pid, 1)
+          ON CONFLICT(pid) DO UPDATE SET available=available+1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_codes_stock_upd AFTER UPDATE OF used, pid ON codes
+        WHEN OLD.used IS NOT NEW.used OR OLD.pid IS NOT NEW.pid
+        BEGIN
+          UPDATE product_stock SET available=available-1 WHERE pid=OLD.pid AND OLD.used=0;
+          INSERT INTO product_stock(pid, available) SELECT NEW.pid, 1 WHERE NEW.used=0
+          ON CONFLICT(pid) DO UPDATE SET available=available+1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_codes_stock_del AFTER DELETE ON codes WHEN OLD.used=0
+        BEGIN
+          UPDATE product_stock SET available=available-1 WHERE pid=OLD.pid;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_products_stock_del AFTER DELETE ON products
+        BEGIN
+          DELETE FROM product_stock WHERE pid=OLD.pid;
+        END
+        """,
+        "DELETE FROM product_stock",
+        "INSERT INTO product_stock(pid, available) " + CODE_STOCK_SQL,
+    ]),
+    # ✅ Precomputed product sort key (extract_sort_value of the title)
+    (8, "products.sort_value", [
+        _m_products_sort_value,
+        "CREATE INDEX IF NOT EXISTS idx_products_cid_sort ON products(cid, sort_value)",
+    ]),
+    # ✅ Per-user totals for the Customers pages (kept up to date by bump_user_stats)
+    (9, "user_stats", [
+        """
+        CREATE TABLE IF NOT EXISTS user_stats(
+          user_id INTEGER PRIMARY KEY,
+          orders_count INTEGER NOT NULL DEFAULT 0,
+          orders_spent REAL NOT NULL DEFAULT 0,
+          manual_count INTEGER NOT NULL DEFAULT 0,
+          manual_spent REAL NOT NULL DEFAULT 0,
+          deposits_approved REAL NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance)",
+        rebuild_user_stats,
+    ]),
+    # ✅ Epoch timestamps: indexed VIRTUAL columns derived from the TEXT created_at / approved_at,
+    # so time-range filters are plain integer range predicates
+    (10, "epoch timestamp columns", [
+        _m_epoch_columns,
+        "CREATE INDEX IF NOT EXISTS idx_orders_created_ts ON orders(created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_manual_created_ts ON manual_orders(created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_deposits_approved_ts ON deposits(approved_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_created_ts ON balance_ledger(created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user_created_ts ON balance_ledger(user_id, created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_reseller_profit_log_reseller_ts ON reseller_profit_log(reseller_id, created_ts)",
+    ]),
+    # ✅ Per-user per-day rollups for the daily audit (ledger + orders/manual/deposits)
+    (11, "daily rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS ledger_daily(
+          day TEXT NOT NULL,
+          user_id INTEGER NOT NULL,
+          opening REAL NOT NULL,
+          net REAL NOT NULL DEFAULT 0,
+          total_in REAL NOT NULL DEFAULT 0,
+          total_out REAL NOT NULL DEFAULT 0,
+          tx_count INTEGER NOT NULL DEFAULT 0,
+          order_out REAL NOT NULL DEFAULT 0,
+          manual_out REAL NOT NULL DEFAULT 0,
+          deposit_in REAL NOT NULL DEFAULT 0,
+          PRIMARY KEY(day, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS activity_daily(
+          day TEXT NOT NULL,
+          user_id INTEGER NOT NULL,
+          orders_total REAL NOT NULL DEFAULT 0,
+          manual_total REAL NOT NULL DEFAULT 0,
+          deposits_total REAL NOT NULL DEFAULT 0,
+          PRIMARY KEY(day, user_id)
+        )
+        """,
+        rebuild_daily_rollups,
+    ]),
+    # ✅ Background broadcasts: one row per job, checkpointed after every chunk so it can resume
+    (12, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          kind TEXT NOT NULL,
+          owner_id INTEGER NOT NULL,
+          text TEXT NOT NULL,
+          status TEXT NOT NULL DEFAULT 'RUNNING',
+          last_uid INTEGER NOT NULL DEFAULT 0,
+          total INTEGER NOT NULL DEFAULT 0,
+          sent INTEGER NOT NULL DEFAULT 0,
+          failed INTEGER NOT NULL DEFAULT 0,
+          report_chat_id INTEGER,
+          report_message_id INTEGER,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          finished_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)",
+    ]),
+    # ✅ Code format rules: named full-match patterns, assigned per product (NULL = no check)
+    (13, "code rule registry", [
+        """
+        CREATE TABLE IF NOT EXISTS code_rules(
+          rule TEXT PRIMARY KEY,
+          pattern TEXT NOT NULL,
+          message TEXT NOT NULL
+        )
+        """,
+        _m_code_rules,
+    ]),
+    # ✅ Global code fingerprint: one voucher can live in one product only; rejected copies are reported
+    (14, "code fingerprints and collision report", [
+        """
+        CREATE TABLE IF NOT EXISTS code_collisions(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          code_hash INTEGER NOT NULL,
+          code_text TEXT NOT NULL,
+          pid INTEGER NOT NULL,
+          existing_pid INTEGER,
+          existing_code_id INTEGER,
+          source TEXT NOT NULL,
+          created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        _m_code_hash,
+    ]),
+    # ✅ FIFO allocation index over unsold codes only; (pid, used) kept every sold code forever
+    (15, "partial index on unused codes", [
+        "CREATE INDEX IF NOT EXISTS idx_codes_unused ON codes(pid, code_id) WHERE used=0",
+        "DROP INDEX IF EXISTS idx_codes_pid_used",
+    ]),
+    # ✅ Sold codes of deleted products keep their fingerprint, so the voucher can't be stocked again
+    (16, "retired code fingerprints", [
+        """
+        CREATE TABLE IF NOT EXISTS code_fingerprints(
+          code_hash INTEGER PRIMARY KEY,
+          pid INTEGER NOT NULL,
+          code_text TEXT NOT NULL,
+          order_id INTEGER,
+          retired_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+        """,
+        _m_code_fingerprints,
+    ]),
+]
+def schema_version(c) -> int:
+    c.execute("SELECT MAX(version) FROM schema_version")
+    return c.fetchone()[0] or 0
+def ensure_schema(con: sqlite3.Connection):
+    # apply pending MIGRATIONS in one transaction; an up-to-date DB costs a single read.
+    # Any failure rolls the whole batch back and is raised: the bot must not start on a half-migrated DB.
+    cur = con.cursor()
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version(
+          version INTEGER PRIMARY KEY,
+          description TEXT NOT NULL,
+          applied_at TEXT NOT NULL DEFAULT (datetime('now'))
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_reseller_profit_log_reseller_created ON reseller_profit_log(reseller_id, created_at)")
+        """
+    )
+    current = schema_version(cur)
+    if current >= MIGRATIONS[-1][0]:
+        return
+    cur.execute("BEGIN IMMEDIATE")
+    # another process may have migrated while we waited for the write lock
+    current = schema_version(cur)
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    if not pending:
+        con.rollback()
+        return
+    try:
+        for version, description, steps in pending:
+            for step in steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            cur.execute("INSERT INTO schema_version(version, description) VALUES(?,?)", (version, description))
         con.commit()
     except Exception:
-        pass
-ensure_schema()
+        con.rollback()
+        logger.exception("Schema migration %s (%s) failed; rolled back to version %s", version, description, current)
+        raise
+    logger.info("Schema migrated from version %s to %s", current, pending[-1][0])
+# Auth gate cache: the whole admins table + per-user suspended flag.
+# Writers invalidate explicitly; AUTH_CACHE_TTL is only a safety net.
+AUTH_CACHE_TTL = max(1, int(os.getenv("AUTH_CACHE_TTL", "60")))
+SUSPENDED_CACHE_MAX = 50000
+_admin_roles: Optional[Dict[int, str]] = None
+_admin_roles_at = 0.0
+_suspended_cache: Dict[int, Tuple[float, bool]] = {}
+def invalidate_admin_roles():
+    global _admin_roles
+    _admin_roles = None
+def _admin_roles_snapshot() -> Dict[int, str]:
+    global _admin_roles, _admin_roles_at
+    roles = _admin_roles
+    now = time.monotonic()
+    if roles is None or now - _admin_roles_at > AUTH_CACHE_TTL:
+        with db_read() as c:
+            c.execute("SELECT user_id, role FROM admins")
+            roles = {int(r[0]): r[1] for r in c.fetchall()}
+        _admin_roles, _admin_roles_at = roles, now
+    return roles
 def seed_owner_admin():
     # Ensure owner exists as OWNER in admins table
-    try:
-        cur.execute("INSERT OR REPLACE INTO admins(user_id, role) VALUES(?,?)", (ADMIN_ID, ROLE_OWNER))
-        con.commit()
-    except Exception:
-        pass
-seed_owner_admin()
+    with db_write() as c:
+        c.execute("INSERT OR REPLACE INTO admins(user_id, role) VALUES(?,?)", (ADMIN_ID, ROLE_OWNER))
+    invalidate_admin_roles()
 def admin_role(uid: int) -> Optional[str]:
-    cur.execute("SELECT role FROM admins WHERE user_id=?", (uid,))
-    r = cur.fetchone()
-    return r[0] if r else None
+    return _admin_roles_snapshot().get(uid)
 def is_admin_any(uid: int) -> bool:
     return admin_role(uid) in (ROLE_OWNER, ROLE_HELPER)
 def is_manual_admin(uid: int) -> bool:
@@ -449,32 +897,51 @@ MANUAL_FLAG_DEFAULTS = {
     "SHAHID_MENA_3M_ENABLED": 1,
     "SHAHID_MENA_12M_ENABLED": 1,
 }
+# In-memory snapshot of manual_prices / manual_flags; every writer below
+# updates it after its commit (write-through), so reads never hit SQLite.
+_manual_prices: Dict[str, float] = {}
+_manual_flags: Dict[str, bool] = {}
+def load_manual_settings():
+    global _manual_prices, _manual_flags
+    prices: Dict[str, float] = {}
+    with db_read() as c:
+        c.execute("SELECT pkey, price FROM manual_prices")
+        for k, p in c.fetchall():
+            try:
+                prices[k] = float(p)
+            except Exception:
+                pass
+        c.execute("SELECT fkey, enabled FROM manual_flags")
+        flags = {k: bool(int(v)) for k, v in c.fetchall()}
+    _manual_prices, _manual_flags = prices, flags
 def seed_manual_prices():
-    for k, v in MANUAL_PRICE_DEFAULTS.items():
-        cur.execute("INSERT OR IGNORE INTO manual_prices(pkey, price) VALUES(?,?)", (k, float(v)))
-    con.commit()
+    with db_write() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO manual_prices(pkey, price) VALUES(?,?)",
+            [(k, float(v)) for k, v in MANUAL_PRICE_DEFAULTS.items()],
+        )
 def get_manual_price(key: str, default: float) -> float:
-    cur.execute("SELECT price FROM manual_prices WHERE pkey=?", (key,))
-    row = cur.fetchone()
-    if not row:
-        return float(default)
-    try:
-        return float(row[0])
-    except Exception:
-        return float(default)
+    return _manual_prices.get(key, float(default))
+def set_manual_price(key: str, price: float):
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO manual_prices(pkey, price) VALUES(?,?) "
+            "ON CONFLICT(pkey) DO UPDATE SET price=excluded.price",
+            (key, float(price)),
+        )
+    _manual_prices[key] = float(price)
 def seed_manual_flags():
-    for k, v in MANUAL_FLAG_DEFAULTS.items():
-        cur.execute("INSERT OR IGNORE INTO manual_flags(fkey, enabled) VALUES(?,?)", (k, int(v)))
-    con.commit()
+    with db_write() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO manual_flags(fkey, enabled) VALUES(?,?)",
+            [(k, int(v)) for k, v in MANUAL_FLAG_DEFAULTS.items()],
+        )
 def manual_flag_enabled(key: str, default: int = 1) -> bool:
-    cur.execute("SELECT enabled FROM manual_flags WHERE fkey=?", (key,))
-    row = cur.fetchone()
-    return bool(int(row[0])) if row else bool(default)
+    return _manual_flags.get(key, bool(default))
 def set_manual_flag(key: str, enabled: bool):
-    cur.execute("INSERT INTO manual_flags(fkey, enabled) VALUES(?,?) ON CONFLICT(fkey) DO UPDATE SET enabled=excluded.enabled", (key, 1 if enabled else 0))
-    con.commit()
-seed_manual_prices()
-seed_manual_flags()
+    with db_write() as c:
+        c.execute("INSERT INTO manual_flags(fkey, enabled) VALUES(?,?) ON CONFLICT(fkey) DO UPDATE SET enabled=excluded.enabled", (key, 1 if enabled else 0))
+    _manual_flags[key] = bool(enabled)
 # =========================
 # SEED
 # =========================
@@ -508,24 +975,64 @@ DEFAULT_PRODUCTS = [
     ("🎮 PLAYSTATION USA GIFTCARDS", "100$ PSN USA", 88.000),
 ]
 def seed_defaults():
-    for cat in DEFAULT_CATEGORIES:
-        cur.execute("INSERT OR IGNORE INTO categories(title) VALUES(?)", (cat,))
-    con.commit()
-    for cat, title, price in DEFAULT_PRODUCTS:
-        cur.execute("SELECT cid FROM categories WHERE title=?", (cat,))
-        row = cur.fetchone()
-        if not row:
-            continue
-        cid = int(row[0])
-        cur.execute("SELECT pid FROM products WHERE cid=? AND title=?", (cid, title))
-        if cur.fetchone():
-            continue
-        cur.execute(
-            "INSERT INTO products(cid,title,price,product_type,active) VALUES(?,?,?,'CODE',1)",
-            (cid, title, float(price)),
-        )
-    con.commit()
-seed_defaults()
+    # one write transaction: concurrent workers starting together can't both insert a product
+    with db_write() as c:
+        for cat in DEFAULT_CATEGORIES:
+            c.execute("INSERT OR IGNORE INTO categories(title) VALUES(?)", (cat,))
+        for cat, title, price in DEFAULT_PRODUCTS:
+            c.execute("SELECT cid FROM categories WHERE title=?", (cat,))
+            row = c.fetchone()
+            if not row:
+                continue
+            cid = int(row[0])
+            c.execute("SELECT pid FROM products WHERE cid=? AND title=?", (cid, title))
+            if c.fetchone():
+                continue
+            c.execute(
+                "INSERT INTO products(cid,title,price,product_type,active,sort_value,code_rule) VALUES(?,?,?,'CODE',1,?,?)",
+                (cid, title, float(price), extract_sort_value(title), guess_code_rule(title, cat)),
+            )
+# =========================
+# Startup
+# =========================
+# Nothing touches the database at import time; build_app() registers post_init,
+# which runs init_db() on the DB pool before polling starts.
+def init_db():
+    t0 = time.perf_counter()
+    timings = []
+    db_dir = os.path.dirname(DB_PATH)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    # schema work runs on its own short-lived connection; everything after it uses db_read()/db_write()
+    setup = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        setup.execute("PRAGMA journal_mode=WAL")
+        setup.execute("PRAGMA foreign_keys=ON")
+        t = time.perf_counter()
+        ensure_schema(setup)
+        timings.append(f"schema={(time.perf_counter() - t) * 1000:.1f}ms")
+    finally:
+        setup.close()
+    for name, step in [
+        ("owner", seed_owner_admin),
+        ("manual_prices", seed_manual_prices),
+        ("manual_flags", seed_manual_flags),
+        ("defaults", seed_defaults),
+        ("manual_settings", load_manual_settings),
+        ("code_rules", load_code_rules),
+        ("alloc_plan", log_code_allocation_plan),
+        ("code_hash_index", log_code_hash_index),
+    ]:
+        t = time.perf_counter()
+        step()
+        timings.append(f"{name}={(time.perf_counter() - t) * 1000:.1f}ms")
+    logger.info("DB ready in %.1fms (%s)", (time.perf_counter() - t0) * 1000, ", ".join(timings))
+async def post_init(app):
+    await run_db(init_db)
+    start_outbox(app.bot)
+    await resume_broadcasts(app)
+async def post_stop(app):
+    await drain_outbox()
 # =========================
 # Reply Menu
 # =========================
@@ -585,31 +1092,46 @@ UD_LAST_PID = "last_pid"
 # =========================
 # User helpers
 # =========================
+# Last (username, first_name) written per user, so repeat taps skip the users upsert.
+# Only filled after a committed upsert_user; process-local, cleared when full.
+USERS_SEEN_MAX = 50000
+_users_seen: Dict[int, Tuple[str, str]] = {}
 def upsert_user(u):
-    cur.execute(
-        """
-        INSERT INTO users(user_id, username, first_name, balance, suspended)
-        VALUES(?,?,?,0,0)
-        ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name
-        """,
-        (u.id, u.username or "", u.first_name or ""),
-    )
-    con.commit()
+    names = (u.username or "", u.first_name or "")
+    with db_write(durable=False) as c:
+        c.execute(
+            """
+            INSERT INTO users(user_id, username, first_name, balance, suspended)
+            VALUES(?,?,?,0,0)
+            ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name
+            """,
+            (u.id, *names),
+        )
+    if len(_users_seen) >= USERS_SEEN_MAX:
+        _users_seen.clear()
+    _users_seen[u.id] = names
+async def touch_user(u):
+    if _users_seen.get(u.id) == (u.username or "", u.first_name or ""):
+        return
+    await run_db(upsert_user, u)
 def ensure_user_exists(user_id: int, username: str = "", first_name: str = ""):
-    cur.execute(
-        """
-        INSERT INTO users(user_id, username, first_name, balance, suspended)
-        VALUES(?,?,?,0,0)
-        ON CONFLICT(user_id) DO NOTHING
-        """,
-        (user_id, username, first_name),
-    )
-    con.commit()
+    if user_id in _users_seen:
+        return
+    with db_write(durable=False) as c:
+        c.execute(
+            """
+            INSERT INTO users(user_id, username, first_name, balance, suspended)
+            VALUES(?,?,?,0,0)
+            ON CONFLICT(user_id) DO NOTHING
+            """,
+            (user_id, username, first_name),
+        )
 
 def get_user_brief(user_id: int) -> str:
     ensure_user_exists(user_id)
-    cur.execute("SELECT username, first_name FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT username, first_name FROM users WHERE user_id=?", (user_id,))
+        row = c.fetchone()
     if not row:
         return f"{user_id}"
     username = (row[0] or "").strip()
@@ -621,107 +1143,633 @@ def get_user_brief(user_id: int) -> str:
         label += f" ({first_name})"
     return label
 def is_suspended(uid: int) -> bool:
-    ensure_user_exists(uid)
-    cur.execute("SELECT suspended FROM users WHERE user_id=?", (uid,))
-    row = cur.fetchone()
-    return bool(int(row[0] or 0)) if row else False
+    hit = _suspended_cache.get(uid)
+    now = time.monotonic()
+    if hit and now - hit[0] <= AUTH_CACHE_TTL:
+        return hit[1]
+    with db_read() as c:
+        c.execute("SELECT suspended FROM users WHERE user_id=?", (uid,))
+        row = c.fetchone()
+    val = bool(int(row[0] or 0)) if row else False
+    if len(_suspended_cache) >= SUSPENDED_CACHE_MAX:
+        _suspended_cache.clear()
+    _suspended_cache[uid] = (now, val)
+    return val
 def set_suspended(uid: int, val: bool):
     ensure_user_exists(uid)
-    cur.execute("UPDATE users SET suspended=? WHERE user_id=?", (1 if val else 0, uid))
-    con.commit()
+    with db_write() as c:
+        c.execute("UPDATE users SET suspended=? WHERE user_id=?", (1 if val else 0, uid))
+    _suspended_cache[uid] = (time.monotonic(), bool(val))
+def _balance_in_tx(c, uid: int) -> float:
+    # balance as seen by the writer transaction (includes its own uncommitted changes)
+    c.execute("SELECT balance FROM users WHERE user_id=?", (uid,))
+    row = c.fetchone()
+    return float(row[0]) if row else 0.0
 def get_balance(uid: int) -> float:
     ensure_user_exists(uid)
-    cur.execute("SELECT balance FROM users WHERE user_id=?", (uid,))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT balance FROM users WHERE user_id=?", (uid,))
+        row = c.fetchone()
     return float(row[0]) if row else 0.0
 def add_balance(uid: int, amount: float):
     ensure_user_exists(uid)
-    cur.execute("UPDATE users SET balance=balance+? WHERE user_id=?", (amount, uid))
-    con.commit()
+    with db_write() as c:
+        c.execute("UPDATE users SET balance=balance+? WHERE user_id=?", (amount, uid))
 def charge_balance(uid: int, amount: float) -> bool:
-    bal = get_balance(uid)
-    if bal + 1e-9 < amount:
-        return False
-    cur.execute("UPDATE users SET balance=balance-? WHERE user_id=?", (amount, uid))
-    con.commit()
+    with db_write() as c:
+        bal = _balance_in_tx(c, uid)
+        if bal + 1e-9 < amount:
+            return False
+        c.execute("UPDATE users SET balance=balance-? WHERE user_id=?", (amount, uid))
     return True
 def record_ledger(uid: int, delta: float, balance_before: float, balance_after: float, source_type: str, source_id: Optional[str] = None, note: str = ""):
-    cur.execute(
-        "INSERT INTO balance_ledger(user_id, delta, balance_before, balance_after, source_type, source_id, note) VALUES(?,?,?,?,?,?,?)",
-        (uid, float(delta), float(balance_before), float(balance_after), source_type, str(source_id or ""), note[:1000]),
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO balance_ledger(user_id, delta, balance_before, balance_after, source_type, source_id, note) VALUES(?,?,?,?,?,?,?)",
+            (uid, float(delta), float(balance_before), float(balance_after), source_type, str(source_id or ""), note[:1000]),
+        )
+        # roll the row into ledger_daily (opening = balance_before of the day's first row)
+        c.execute(
+            """
+            INSERT INTO ledger_daily(day, user_id, opening, net, total_in, total_out, tx_count, order_out, manual_out, deposit_in)
+            SELECT date(created_at), user_id, balance_before, delta,
+                   MAX(delta, 0), MAX(-delta, 0), 1,
+                   CASE WHEN source_type='ORDER_PURCHASE' THEN -delta ELSE 0 END,
+                   CASE WHEN source_type IN ('MANUAL_SHAHID_CHARGE','MANUAL_FF_CHARGE') THEN -delta ELSE 0 END,
+                   CASE WHEN source_type='DEPOSIT_APPROVED' THEN delta ELSE 0 END
+            FROM balance_ledger WHERE id=?
+            ON CONFLICT(day, user_id) DO UPDATE SET
+              net=net+excluded.net,
+              total_in=total_in+excluded.total_in,
+              total_out=total_out+excluded.total_out,
+              tx_count=tx_count+1,
+              order_out=order_out+excluded.order_out,
+              manual_out=manual_out+excluded.manual_out,
+              deposit_in=deposit_in+excluded.deposit_in
+            """,
+            (c.lastrowid,),
+        )
+def bump_daily_activity(c, uid: int, orders: float = 0.0, manual: float = 0.0, deposits: float = 0.0, day: Optional[str] = None):
+    # call inside the db_write() block that changes the underlying row; day defaults to today (UTC)
+    c.execute(
+        """
+        INSERT INTO activity_daily(day, user_id, orders_total, manual_total, deposits_total)
+        VALUES(COALESCE(?, date('now')),?,?,?,?)
+        ON CONFLICT(day, user_id) DO UPDATE SET
+          orders_total=orders_total+excluded.orders_total,
+          manual_total=manual_total+excluded.manual_total,
+          deposits_total=deposits_total+excluded.deposits_total
+        """,
+        (day, uid, float(orders), float(manual), float(deposits)),
+    )
+def bump_user_stats(c, uid: int, orders: int = 0, orders_spent: float = 0.0, manual: int = 0, manual_spent: float = 0.0, deposits: float = 0.0):
+    # call inside the db_write() block that changes the underlying row
+    c.execute(
+        """
+        INSERT INTO user_stats(user_id, orders_count, orders_spent, manual_count, manual_spent, deposits_approved)
+        VALUES(?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          orders_count=orders_count+excluded.orders_count,
+          orders_spent=orders_spent+excluded.orders_spent,
+          manual_count=manual_count+excluded.manual_count,
+          manual_spent=manual_spent+excluded.manual_spent,
+          deposits_approved=deposits_approved+excluded.deposits_approved
+        """,
+        (uid, int(orders), float(orders_spent), int(manual), float(manual_spent), float(deposits)),
     )
-    con.commit()
 def add_balance_logged(uid: int, amount: float, source_type: str, source_id: Optional[str] = None, note: str = "") -> Tuple[float, float]:
-    bal_before = get_balance(uid)
-    add_balance(uid, amount)
-    bal_after = get_balance(uid)
-    record_ledger(uid, amount, bal_before, bal_after, source_type, source_id, note)
+    ensure_user_exists(uid)
+    with db_write() as c:
+        bal_before = _balance_in_tx(c, uid)
+        add_balance(uid, amount)
+        bal_after = _balance_in_tx(c, uid)
+        record_ledger(uid, amount, bal_before, bal_after, source_type, source_id, note)
     return bal_before, bal_after
 def charge_balance_logged(uid: int, amount: float, source_type: str, source_id: Optional[str] = None, note: str = "") -> Tuple[bool, float, float]:
-    bal_before = get_balance(uid)
-    if not charge_balance(uid, amount):
-        return False, bal_before, bal_before
-    bal_after = get_balance(uid)
-    record_ledger(uid, -amount, bal_before, bal_after, source_type, source_id, note)
+    with db_write() as c:
+        bal_before = _balance_in_tx(c, uid)
+        if not charge_balance(uid, amount):
+            return False, bal_before, bal_before
+        bal_after = _balance_in_tx(c, uid)
+        record_ledger(uid, -amount, bal_before, bal_after, source_type, source_id, note)
     return True, bal_before, bal_after
+def transfer_balance_logged(
+    src_uid: int,
+    dst_uid: int,
+    amount: float,
+    src_type: str,
+    dst_type: str,
+    src_id: Optional[str] = None,
+    dst_id: Optional[str] = None,
+    src_note: str = "",
+    dst_note: str = "",
+) -> Tuple[bool, float, float, float, float]:
+    # debit + credit (with both ledger rows) in one transaction: either both land or neither.
+    # Returns (ok, src_before, src_after, dst_before, dst_after); ok is False on insufficient balance.
+    with db_write():
+        ok, src_before, src_after = charge_balance_logged(src_uid, amount, src_type, src_id, src_note)
+        if not ok:
+            return False, src_before, src_after, 0.0, 0.0
+        dst_before, dst_after = add_balance_logged(dst_uid, amount, dst_type, dst_id, dst_note)
+    return True, src_before, src_after, dst_before, dst_after
 def all_admin_ids() -> List[int]:
-    cur.execute("SELECT user_id FROM admins")
-    return sorted({int(r[0]) for r in cur.fetchall()} | {ADMIN_ID})
+    return sorted(set(_admin_roles_snapshot()) | {ADMIN_ID})
 async def notify_manual_order_admins(context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    for aid in all_admin_ids():
+    notify_admins(message_text, parse_mode=ParseMode.MARKDOWN)
+# =========================
+# Send rate limits
+# =========================
+# Telegram allows ~30 messages/s per bot and ~1 message/s per chat. Every bulk
+# sender goes through acquire_send_slot(): a global token bucket plus a per-chat
+# pacer. A RetryAfter from Telegram pauses all senders for the requested time.
+SEND_RATE_GLOBAL = max(1.0, float(os.getenv("SEND_RATE_GLOBAL", "25")))
+SEND_RATE_PER_CHAT = max(0.05, float(os.getenv("SEND_RATE_PER_CHAT", "1")))
+SEND_BURST = max(1.0, float(os.getenv("SEND_BURST", "5")))
+CHAT_PACER_MAX = 100000
+_send_tokens = SEND_BURST
+_send_tokens_at = 0.0
+_send_paused_until = 0.0
+_chat_next_at: Dict[int, float] = {}
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+def pause_sends(seconds: float):
+    global _send_paused_until
+    _send_paused_until = max(_send_paused_until, time.monotonic() + seconds)
+async def acquire_send_slot(chat_id: int, bulk: bool = False):
+    # no await between the checks and the updates, so the event loop makes this atomic;
+    # bulk senders (broadcasts) wait while the outbox has work queued
+    global _send_tokens, _send_tokens_at
+    while True:
+        now = time.monotonic()
+        wait = max(_send_paused_until, _chat_next_at.get(chat_id, 0.0)) - now
+        if bulk and _outbox_pending:
+            wait = max(wait, 0.05)
+        if wait <= 0:
+            _send_tokens = min(SEND_BURST, _send_tokens + (now - _send_tokens_at) * SEND_RATE_GLOBAL)
+            _send_tokens_at = now
+            if _send_tokens >= 1:
+                _send_tokens -= 1
+                if len(_chat_next_at) >= CHAT_PACER_MAX:
+                    for k in [k for k, t in _chat_next_at.items() if t <= now]:
+                        del _chat_next_at[k]
+                _chat_next_at[chat_id] = now + 1 / SEND_RATE_PER_CHAT
+                return
+            wait = (1 - _send_tokens) / SEND_RATE_GLOBAL
+        await asyncio.sleep(wait)
+async def send_with_retry(bot, method: str, chat_id: int, attempts: int = 3, bulk: bool = False, **kwargs) -> bool:
+    # method is a Bot coroutine name (send_message / send_document); a retried upload is rewound first
+    for attempt in range(attempts):
+        await acquire_send_slot(chat_id, bulk)
         try:
-            await context.bot.send_message(chat_id=aid, text=message_text, parse_mode=ParseMode.MARKDOWN)
+            doc = kwargs.get("document")
+            if hasattr(doc, "seek"):
+                doc.seek(0)
+            await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            return True
+        except RetryAfter as e:
+            logger.warning("Flood control: pausing sends for %ss", e.retry_after)
+            pause_sends(_retry_after_seconds(e))
+        except (Forbidden, BadRequest) as e:
+            # blocked the bot / chat not found: retrying won't help
+            logger.info("Send to %s rejected: %s", chat_id, e)
+            return False
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(2 ** attempt)
         except Exception:
-            logger.exception("Failed notifying admin %s", aid)
-async def broadcast_to_all_users(context: ContextTypes.DEFAULT_TYPE, message_text: str) -> Tuple[int, int]:
-    cur.execute("SELECT user_id FROM users ORDER BY user_id")
-    rows = cur.fetchall()
-    sent = 0
-    failed = 0
-    for row in rows:
-        uid = int(row[0])
+            logger.exception("Send failed to %s", chat_id)
+            return False
+    logger.warning("Send to %s gave up after %s attempts", chat_id, attempts)
+    return False
+async def send_limited(bot, chat_id: int, text: str, attempts: int = 3, bulk: bool = False, **kwargs) -> bool:
+    return await send_with_retry(bot, "send_message", chat_id, attempts, bulk, text=text, **kwargs)
+# =========================
+# Outbox
+# =========================
+# Notifications that aren't a reply to the current update are queued instead of
+# awaited: handlers call enqueue_message()/enqueue_send() and return right away.
+# OUTBOX_WORKERS tasks (started in post_init) drain the queue through the shared
+# rate limiter; lower priority values go first. A job is a list of sends that
+# run in order for each of its chats (multi-part code deliveries), stopping at
+# the first send that still fails after OUTBOX_MAX_ATTEMPTS. A job for several
+# chats (admin fan-out) runs them concurrently, FANOUT_CONCURRENCY at a time;
+# one recipient failing doesn't affect the others.
+PRIO_CUSTOMER = 0  # deliveries and balance/order updates to the customer
+PRIO_NOTICE = 1  # admin / reseller notices
+OUTBOX_WORKERS = max(1, int(os.getenv("OUTBOX_WORKERS", "4")))
+OUTBOX_MAX_ATTEMPTS = 5
+FANOUT_CONCURRENCY = max(1, int(os.getenv("FANOUT_CONCURRENCY", "8")))
+_outbox: asyncio.PriorityQueue = asyncio.PriorityQueue()
+_outbox_seq = itertools.count()
+_outbox_pending = 0
+_outbox_workers: List[asyncio.Task] = []
+def enqueue_fanout(chat_ids: List[int], steps: List[Tuple[str, dict]], priority: int = PRIO_NOTICE):
+    global _outbox_pending
+    if not chat_ids:
+        return
+    _outbox_pending += 1
+    _outbox.put_nowait((priority, next(_outbox_seq), tuple(int(c) for c in chat_ids), steps))
+def enqueue_send(chat_id: int, steps: List[Tuple[str, dict]], priority: int = PRIO_NOTICE):
+    enqueue_fanout([chat_id], steps, priority)
+def enqueue_message(chat_id: int, text: str, priority: int = PRIO_NOTICE, **kwargs):
+    enqueue_send(chat_id, [("send_message", dict(text=text, **kwargs))], priority)
+def notify_admins(text: str, priority: int = PRIO_NOTICE, **kwargs):
+    enqueue_fanout(all_admin_ids(), [("send_message", dict(text=text, **kwargs))], priority)
+async def _outbox_run(bot, chat_id: int, steps: List[Tuple[str, dict]]) -> bool:
+    for i, (method, kwargs) in enumerate(steps):
+        if not await send_with_retry(bot, method, chat_id, OUTBOX_MAX_ATTEMPTS, **kwargs):
+            logger.warning("Outbox: dropped %s remaining send(s) to %s", len(steps) - i, chat_id)
+            return False
+    return True
+async def _outbox_fanout(bot, chat_ids: Tuple[int, ...], steps: List[Tuple[str, dict]]):
+    sem = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    t0 = time.monotonic()
+    async def _one(chat_id: int) -> Tuple[bool, float]:
+        async with sem:
+            t = time.monotonic()
+            try:
+                ok = await _outbox_run(bot, chat_id, steps)
+            except Exception:
+                logger.exception("Outbox fan-out to %s failed", chat_id)
+                ok = False
+            return ok, time.monotonic() - t
+    results = await asyncio.gather(*(_one(c) for c in chat_ids))
+    failed = sum(1 for ok, _ in results if not ok)
+    logger.info(
+        "Fan-out to %s chats: %s ok, %s failed in %.0fms (slowest %.0fms)",
+        len(chat_ids), len(chat_ids) - failed, failed, (time.monotonic() - t0) * 1000, max(d for _, d in results) * 1000,
+    )
+async def _outbox_worker(bot):
+    global _outbox_pending
+    while True:
+        priority, _, chat_ids, steps = await _outbox.get()
         try:
-            await context.bot.send_message(chat_id=uid, text=message_text)
-            sent += 1
+            if len(chat_ids) == 1:
+                await _outbox_run(bot, chat_ids[0], steps)
+            else:
+                await _outbox_fanout(bot, chat_ids, steps)
         except Exception:
-            failed += 1
-            logger.exception("Broadcast failed to %s", uid)
-    return sent, failed
+            logger.exception("Outbox job to %s failed (priority %s)", chat_ids, priority)
+        finally:
+            _outbox_pending -= 1
+            _outbox.task_done()
+def start_outbox(bot):
+    while len(_outbox_workers) < OUTBOX_WORKERS:
+        _outbox_workers.append(asyncio.create_task(_outbox_worker(bot), name=f"outbox-{len(_outbox_workers)}"))
+async def drain_outbox(timeout: float = 10.0):
+    try:
+        await asyncio.wait_for(_outbox.join(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Outbox: %s job(s) not sent at shutdown", _outbox_pending)
+# =========================
+# Broadcasts
+# =========================
+# A broadcast is a row in `broadcasts` worked by a background task: targets are
+# streamed by keyset (user_id > last_uid) in BROADCAST_CHUNK batches, each batch
+# is sent with BROADCAST_CONCURRENCY in flight, then last_uid/sent/failed are
+# checkpointed. After a restart RUNNING jobs resume from their checkpoint (at
+# most one chunk may be delivered twice). Kinds: ALL (every user, owner only)
+# and POS (a reseller's clients).
+BROADCAST_CHUNK = max(1, int(os.getenv("BROADCAST_CHUNK", "200")))
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BROADCAST_CONCURRENCY", "8")))
+BROADCAST_PROGRESS_EVERY = 5.0
+_broadcast_tasks: Dict[int, asyncio.Task] = {}
+def _broadcast_targets(kind: str, owner_id: int, after: int, limit: int) -> List[int]:
+    with db_read() as c:
+        if kind == "POS":
+            c.execute(
+                "SELECT client_user_id FROM reseller_clients WHERE reseller_id=? AND client_user_id>? ORDER BY client_user_id LIMIT ?",
+                (owner_id, after, limit),
+            )
+        else:
+            c.execute("SELECT user_id FROM users WHERE user_id>? ORDER BY user_id LIMIT ?", (after, limit))
+        return [int(r[0]) for r in c.fetchall()]
+def broadcast_target_count(kind: str, owner_id: int) -> int:
+    with db_read() as c:
+        if kind == "POS":
+            c.execute("SELECT COUNT(*) FROM reseller_clients WHERE reseller_id=?", (owner_id,))
+        else:
+            c.execute("SELECT COUNT(*) FROM users")
+        return int(c.fetchone()[0])
+def create_broadcast(kind: str, owner_id: int, text: str, total: int, report_chat_id: int, report_message_id: int) -> int:
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO broadcasts(kind, owner_id, text, total, report_chat_id, report_message_id) VALUES(?,?,?,?,?,?)",
+            (kind, owner_id, text, total, report_chat_id, report_message_id),
+        )
+        return int(c.lastrowid)
+def _broadcast_checkpoint(bid: int, last_uid: int, sent: int, failed: int, done: bool):
+    with db_write() as c:
+        c.execute(
+            "UPDATE broadcasts SET last_uid=?, sent=?, failed=?, status=?, "
+            "finished_at=CASE WHEN ? THEN datetime('now') ELSE finished_at END WHERE id=?",
+            (last_uid, sent, failed, "DONE" if done else "RUNNING", 1 if done else 0, bid),
+        )
+def _broadcast_status_text(kind: str, bid: int, sent: int, failed: int, total: int, done: bool) -> str:
+    if kind == "POS":
+        head = "✅ تم إرسال الإشعار إلى عملائك فقط." if done else "⏳ جاري إرسال الإشعار إلى عملائك..."
+        return f"{head}\nنجح: {sent}\nفشل: {failed}\nالإجمالي: {total}"
+    if done:
+        head = f"✅ Broadcast #{bid} finished."
+    else:
+        head = f"⏳ Broadcast #{bid} running..." if bid else "⏳ Broadcast starting..."
+    return f"{head}\nSent: {sent}\nFailed: {failed}\nTotal: {total}"
+async def _run_broadcast(bot, bid: int):
+    def _load():
+        with db_read() as c:
+            c.execute(
+                "SELECT kind, owner_id, text, last_uid, total, sent, failed, report_chat_id, report_message_id "
+                "FROM broadcasts WHERE id=? AND status='RUNNING'",
+                (bid,),
+            )
+            return c.fetchone()
+    row = await run_db(_load)
+    if not row:
+        return
+    kind, owner_id, text, last_uid, total, sent, failed, report_chat, report_msg = row
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    t0 = time.monotonic()
+    reported_at = 0.0
+    async def _one(uid: int) -> bool:
+        async with sem:
+            return await send_limited(bot, uid, text, bulk=True)
+    async def _report(done: bool):
+        if not report_chat or not report_msg:
+            return
+        await acquire_send_slot(report_chat, bulk=True)
+        try:
+            await bot.edit_message_text(
+                _broadcast_status_text(kind, bid, sent, failed, total, done), chat_id=report_chat, message_id=report_msg
+            )
+        except Exception as e:
+            logger.info("Broadcast %s status update failed: %s", bid, e)
+    while True:
+        targets = await run_db(_broadcast_targets, kind, owner_id, last_uid, BROADCAST_CHUNK)
+        if not targets:
+            break
+        results = await asyncio.gather(*(_one(uid) for uid in targets))
+        ok = sum(1 for r in results if r)
+        sent += ok
+        failed += len(results) - ok
+        last_uid = targets[-1]
+        await run_db(_broadcast_checkpoint, bid, last_uid, sent, failed, False)
+        if time.monotonic() - reported_at >= BROADCAST_PROGRESS_EVERY:
+            reported_at = time.monotonic()
+            await _report(False)
+    await run_db(_broadcast_checkpoint, bid, last_uid, sent, failed, True)
+    logger.info("Broadcast %s (%s) done in %.1fs: sent=%s failed=%s", bid, kind, time.monotonic() - t0, sent, failed)
+    await _report(True)
+def start_broadcast(bot, bid: int):
+    task = asyncio.create_task(_run_broadcast(bot, bid), name=f"broadcast-{bid}")
+    _broadcast_tasks[bid] = task
+    def _done(t: asyncio.Task):
+        if _broadcast_tasks.get(bid) is t:
+            del _broadcast_tasks[bid]
+        if not t.cancelled() and t.exception():
+            logger.error("Broadcast %s crashed", bid, exc_info=t.exception())
+    task.add_done_callback(_done)
+async def resume_broadcasts(app):
+    def _running() -> List[int]:
+        with db_read() as c:
+            c.execute("SELECT id FROM broadcasts WHERE status='RUNNING' ORDER BY id")
+            return [int(r[0]) for r in c.fetchall()]
+    for bid in await run_db(_running):
+        logger.info("Resuming broadcast %s", bid)
+        start_broadcast(app.bot, bid)
+async def launch_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, owner_id: int, text: str) -> bool:
+    # returns False when there is nobody to send to
+    total = await run_db(broadcast_target_count, kind, owner_id)
+    if total == 0:
+        return False
+    status = await update.message.reply_text(_broadcast_status_text(kind, 0, 0, 0, total, False))
+    bid = await run_db(create_broadcast, kind, owner_id, text, total, status.chat_id, status.message_id)
+    start_broadcast(context.bot, bid)
+    return True
 
+def _save_audit_alert(audit_date: str, uid: int, issue_key: str):
+    with db_write(durable=False) as c:
+        c.execute("INSERT INTO audit_alerts(audit_date, user_id, issue_key) VALUES(?,?,?)", (audit_date, uid, issue_key[:180]))
 async def send_audit_alert(context: ContextTypes.DEFAULT_TYPE, audit_date: str, uid: int, issue_key: str, message_text: str):
     try:
-        cur.execute("INSERT INTO audit_alerts(audit_date, user_id, issue_key) VALUES(?,?,?)", (audit_date, uid, issue_key[:180]))
-        con.commit()
+        await run_db(_save_audit_alert, audit_date, uid, issue_key)
     except sqlite3.IntegrityError:
         return
     except Exception:
         logger.exception("Failed to save audit alert")
         return
-    for aid in all_admin_ids():
-        try:
-            await context.bot.send_message(
-                chat_id=aid,
-                text=(
-                    "🚨 *Audit Alert*\n"
-                    f"📅 Date: `{audit_date}`\n"
-                    f"👤 User: `{uid}`\n"
-                    f"📝 Reason: {message_text}"
-                ),
-                parse_mode=ParseMode.MARKDOWN,
-            )
-        except Exception:
-            logger.exception("Failed sending audit alert to %s", aid)
+    notify_admins(
+        "🚨 *Audit Alert*\n"
+        f"📅 Date: `{audit_date}`\n"
+        f"👤 User: `{uid}`\n"
+        f"📝 Reason: {message_text}",
+        parse_mode=ParseMode.MARKDOWN,
+    )
 def must_block_user(update: Update) -> bool:
     uid = update.effective_user.id
     if is_admin_any(uid):
         return False
     return is_suspended(uid)
 # =========================
+# Purchase
+# =========================
+# FIFO allocation; must keep "used=0" literal so it can use the partial index idx_codes_unused
+CODE_ALLOC_SQL = "SELECT code_id, code_text, code_hash FROM codes WHERE pid=? AND used=0 ORDER BY code_id ASC LIMIT ?"
+# marks the same rows as CODE_ALLOC_SQL sold (the caller still holds the write lock)
+CODE_MARK_SOLD_SQL = (
+    "UPDATE codes SET used=1, used_at=datetime('now'), order_id=? "
+    "WHERE code_id IN (SELECT code_id FROM codes WHERE pid=? AND used=0 ORDER BY code_id ASC LIMIT ?)"
+)
+CODE_PLAN_QUERIES = (
+    ("alloc", CODE_ALLOC_SQL, (0, 1)),
+    ("mark_sold", CODE_MARK_SOLD_SQL, (0, 0, 1)),
+    ("stock", CODE_STOCK_SQL, ()),
+)
+def code_query_plan(c, sql: str, params: tuple = ()) -> str:
+    c.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return "; ".join(r[-1] for r in c.fetchall())
+def log_code_allocation_plan():
+    with db_read() as c:
+        plans = [(name, code_query_plan(c, sql, params)) for name, sql, params in CODE_PLAN_QUERIES]
+    for name, plan in plans:
+        if "idx_codes_unused" in plan and "TEMP B-TREE" not in plan:
+            logger.info("Code %s plan: %s", name, plan)
+        else:
+            logger.warning("Code %s query is not using idx_codes_unused: %s", name, plan)
+def _settle_unhashed_codes(c, pid: int, picked: List[tuple]) -> bool:
+    # rows written outside insert_codes have no fingerprint yet: set it now, and pull the row
+    # (reporting it) if the same voucher already exists elsewhere or was sold from a deleted
+    # product. True if a picked row was pulled.
+    pulled = False
+    for code_id, text, h in picked:
+        if h is not None:
+            continue
+        h = code_fingerprint(text)
+        hit = _codes_by_hash(c, [h]).get(h)
+        if hit is None:
+            c.execute("UPDATE codes SET code_hash=? WHERE code_id=?", (h, code_id))
+            continue
+        record_code_collision(c, h, text, pid, hit, "purchase")
+        c.execute("DELETE FROM codes WHERE code_id=?", (code_id,))
+        pulled = True
+    return pulled
+def purchase_codes(uid: int, pid: int, qty: int, unit_price: float, title: str, client_ref: str) -> Tuple[str, int, float, float, List[str]]:
+    """
+    Debit, ledger row, order and code allocation in one write transaction.
+    Returns (status, order_id, balance_before, balance_after, codes) where
+    status is OK / DUPLICATE / NO_STOCK / NO_BALANCE; nothing is written
+    unless status is OK (apart from pulling duplicate vouchers from stock).
+    """
+    total = float(unit_price) * qty
+    with db_write() as c:
+        c.execute("SELECT id, delivered_text FROM orders WHERE client_ref=?", (client_ref,))
+        row = c.fetchone()
+        if row:
+            bal = _balance_in_tx(c, uid)
+            return "DUPLICATE", int(row[0]), bal, bal, (row[1] or "").splitlines()
+        while True:
+            c.execute(CODE_ALLOC_SQL, (pid, qty))
+            picked = c.fetchall()
+            if not _settle_unhashed_codes(c, pid, picked):
+                break
+        if len(picked) < qty:
+            bal = _balance_in_tx(c, uid)
+            return "NO_STOCK", 0, bal, bal, []
+        c.execute(
+            "UPDATE users SET balance=balance-? WHERE user_id=? AND balance>=?",
+            (total, uid, total - 1e-9),
+        )
+        if c.rowcount != 1:
+            bal = _balance_in_tx(c, uid)
+            return "NO_BALANCE", 0, bal, bal, []
+        bal_after = _balance_in_tx(c, uid)
+        bal_before = bal_after + total
+        codes_list = [code for _, code, _ in picked]
+        c.execute(
+            "INSERT INTO orders(user_id,pid,product_title,qty,total,status,delivered_text,client_ref) VALUES(?,?,?,?,?,'COMPLETED',?,?)",
+            (uid, pid, title, qty, total, "\n".join(codes_list), client_ref),
+        )
+        oid = c.lastrowid
+        c.execute(CODE_MARK_SOLD_SQL, (oid, pid, qty))
+        if c.rowcount != qty:
+            raise sqlite3.DatabaseError(f"code allocation mismatch: {c.rowcount} != {qty}")
+        record_ledger(uid, -total, bal_before, bal_after, "ORDER_PURCHASE", str(oid), title)
+        bump_user_stats(c, uid, orders=1, orders_spent=total)
+        bump_daily_activity(c, uid, orders=total)
+    return "OK", oid, bal_before, bal_after, codes_list
+def create_manual_order(uid: int, price: float, source_type: str, ledger_note: str, **fields) -> Tuple[Optional[int], float, float]:
+    """
+    Charge the user and insert a PENDING manual order in one transaction.
+    `fields` are the manual_orders columns (service, plan_title, email, ...).
+    Returns (manual_id, balance_before, balance_after); manual_id is None when
+    the balance is too low and nothing was written.
+    """
+    cols = ["user_id", "price", *fields]
+    with db_write() as c:
+        ok_charge, bal_before, bal_after = charge_balance_logged(uid, price, source_type, note=ledger_note)
+        if not ok_charge:
+            return None, bal_before, bal_after
+        c.execute(
+            f"INSERT INTO manual_orders({','.join(cols)},status) VALUES({','.join('?' * len(cols))},'PENDING')",
+            (uid, price, *fields.values()),
+        )
+        mid = c.lastrowid
+        bump_daily_activity(c, uid, manual=price)
+    return mid, bal_before, bal_after
+def approve_manual_order(mid: int, approver_id: int) -> Tuple[str, Optional[Tuple[int, float, str, str, str]]]:
+    """
+    Mark a PENDING manual order COMPLETED. Returns (status, order) with status
+    OK / NOT_FOUND / NOT_PENDING and order = (user_id, price, service, plan_title, note).
+    """
+    with db_write() as c:
+        c.execute("SELECT user_id, price, service, plan_title, note FROM manual_orders WHERE id=?", (mid,))
+        row = c.fetchone()
+        if not row:
+            return "NOT_FOUND", None
+        c.execute(
+            "UPDATE manual_orders SET status='COMPLETED', approved_by=?, delivered_text=? WHERE id=? AND status='PENDING'",
+            (approver_id, f"APPROVED_BY:{approver_id}", mid),
+        )
+        if c.rowcount != 1:
+            return "NOT_PENDING", None
+        uid, price = int(row[0]), float(row[1])
+        bump_user_stats(c, uid, manual=1, manual_spent=price)
+    return "OK", (uid, price, row[2], row[3], row[4] or "")
+def reject_manual_order(mid: int, reason_text: str) -> Optional[Tuple[int, float, float, float]]:
+    """
+    Reject a PENDING manual order and refund it in one transaction.
+    Returns (user_id, price, balance_before, balance_after), or None if it was not pending.
+    """
+    with db_write() as c:
+        c.execute("SELECT user_id, price, date(created_at) FROM manual_orders WHERE id=? AND status='PENDING'", (mid,))
+        row = c.fetchone()
+        if not row:
+            return None
+        uid, price, day = int(row[0]), float(row[1]), row[2]
+        c.execute("UPDATE manual_orders SET status='REJECTED', delivered_text=? WHERE id=?", (reason_text[:3500], mid))
+        bal_before, bal_after = add_balance_logged(uid, price, 'MANUAL_REFUND', source_id=str(mid), note=reason_text)
+        bump_daily_activity(c, uid, manual=-price, day=day)
+    return uid, price, bal_before, bal_after
+def create_deposit(uid: int, method: str, note: str) -> int:
+    with db_write() as c:
+        c.execute("INSERT INTO deposits(user_id,method,note,status) VALUES(?,?,?,'WAITING_PAYMENT')", (uid, method, note))
+        return c.lastrowid
+def submit_deposit_details(dep_id: int, uid: int, amount: float, txid: str) -> str:
+    # the user's amount | txid; OK / NOT_FOUND (missing or not theirs) / NOT_PENDING
+    with db_write() as c:
+        c.execute(
+            """
+            UPDATE deposits SET txid=?, amount=?, status='PENDING_REVIEW'
+            WHERE id=? AND user_id=? AND status IN ('WAITING_PAYMENT','PAID','PENDING_REVIEW')
+            """,
+            (txid[:1500], amount, dep_id, uid),
+        )
+        if c.rowcount == 1:
+            return "OK"
+        c.execute("SELECT 1 FROM deposits WHERE id=? AND user_id=?", (dep_id, uid))
+        return "NOT_PENDING" if c.fetchone() else "NOT_FOUND"
+def approve_deposit(dep_id: int) -> Tuple[str, int, float, float, float]:
+    """
+    Credit a PENDING_REVIEW deposit. Returns (status, user_id, amount,
+    balance_before, balance_after); status is OK / NOT_FOUND / NOT_READY / NO_AMOUNT.
+    """
+    with db_write() as c:
+        c.execute("SELECT user_id, amount, status FROM deposits WHERE id=?", (dep_id,))
+        row = c.fetchone()
+        if not row:
+            return "NOT_FOUND", 0, 0.0, 0.0, 0.0
+        user_id, amount = int(row[0]), row[1]
+        if row[2] != "PENDING_REVIEW":
+            return "NOT_READY", user_id, 0.0, 0.0, 0.0
+        if amount is None:
+            return "NO_AMOUNT", user_id, 0.0, 0.0, 0.0
+        amount = float(amount)
+        c.execute("UPDATE deposits SET status='APPROVED', approved_at=datetime('now') WHERE id=? AND status='PENDING_REVIEW'", (dep_id,))
+        if c.rowcount != 1:
+            return "NOT_READY", user_id, amount, 0.0, 0.0
+        bal_before, bal_after = add_balance_logged(user_id, amount, 'DEPOSIT_APPROVED', source_id=str(dep_id), note='approved deposit')
+        bump_user_stats(c, user_id, deposits=amount)
+        bump_daily_activity(c, user_id, deposits=amount)
+    return "OK", user_id, amount, bal_before, bal_after
+def reject_deposit(dep_id: int) -> Tuple[str, int]:
+    # (status, user_id); status is OK / NOT_FOUND / NOT_PENDING
+    with db_write() as c:
+        c.execute("SELECT user_id FROM deposits WHERE id=?", (dep_id,))
+        row = c.fetchone()
+        if not row:
+            return "NOT_FOUND", 0
+        c.execute(
+            "UPDATE deposits SET status='REJECTED' WHERE id=? AND status IN ('PENDING_REVIEW','WAITING_PAYMENT')",
+            (dep_id,),
+        )
+        if c.rowcount != 1:
+            return "NOT_PENDING", int(row[0])
+    return "OK", int(row[0])
+# =========================
 # Delivery
 # =========================
 MAX_CODES_IN_MESSAGE = 200
 TELEGRAM_TEXT_LIMIT = 3800
-async def send_codes_delivery(chat_id: int, context: ContextTypes.DEFAULT_TYPE, order_id: int, codes: List[str]):
+def codes_delivery_steps(order_id: int, codes: List[str]) -> List[Tuple[str, dict]]:
     codes = [c.strip() for c in codes if c and c.strip()]
     count = len(codes)
     header_html = (
@@ -730,84 +1778,91 @@ async def send_codes_delivery(chat_id: int, context: ContextTypes.DEFAULT_TYPE,
         f"📦 Codes: <b>{count}</b>\n\n"
     )
     if count == 0:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"✅ Order <b>#{order_id}</b> COMPLETED\n(No codes)",
-            parse_mode=ParseMode.HTML,
-        )
-        return
+        return [("send_message", dict(text=f"✅ Order <b>#{order_id}</b> COMPLETED\n(No codes)", parse_mode=ParseMode.HTML))]
     if count > MAX_CODES_IN_MESSAGE:
         content = "\n".join(codes)
         bio = io.BytesIO(content.encode("utf-8"))
         bio.name = f"order_{order_id}_codes.txt"
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=header_html + "📎 <b>Your codes are attached in a file:</b>",
-            parse_mode=ParseMode.HTML,
-        )
-        await context.bot.send_document(chat_id=chat_id, document=bio)
-        return
+        return [
+            ("send_message", dict(text=header_html + "📎 <b>Your codes are attached in a file:</b>", parse_mode=ParseMode.HTML)),
+            ("send_document", dict(document=bio)),
+        ]
     body = "\n".join(codes)
     text_html = header_html + f"<pre>{html.escape(body)}</pre>"
     if len(text_html) <= TELEGRAM_TEXT_LIMIT:
-        await context.bot.send_message(chat_id=chat_id, text=text_html, parse_mode=ParseMode.HTML)
-        return
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=header_html + "🎁 <b>Codes (part 1):</b>",
-        parse_mode=ParseMode.HTML,
-    )
+        return [("send_message", dict(text=text_html, parse_mode=ParseMode.HTML))]
+    steps = [("send_message", dict(text=header_html + "🎁 <b>Codes (part 1):</b>", parse_mode=ParseMode.HTML))]
     chunk = ""
     for c in codes:
         line = c + "\n"
         if len(chunk) + len(line) > 3000:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"<pre>{html.escape(chunk.rstrip())}</pre>",
-                parse_mode=ParseMode.HTML,
-            )
+            steps.append(("send_message", dict(text=f"<pre>{html.escape(chunk.rstrip())}</pre>", parse_mode=ParseMode.HTML)))
             chunk = line
         else:
             chunk += line
     if chunk.strip():
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"<pre>{html.escape(chunk.rstrip())}</pre>",
-            parse_mode=ParseMode.HTML,
-        )
+        steps.append(("send_message", dict(text=f"<pre>{html.escape(chunk.rstrip())}</pre>", parse_mode=ParseMode.HTML)))
+    return steps
+def send_codes_delivery(chat_id: int, order_id: int, codes: List[str]):
+    # queued as one job so the parts arrive in order, ahead of admin notices
+    enqueue_send(chat_id, codes_delivery_steps(order_id, codes), PRIO_CUSTOMER)
 # =========================
 # Keyboards
 # =========================
+# Bumped by every admin edit to categories/products; rendered catalog
+# keyboards are cached against it.
+_catalog_version = 0
+_categories_kb_cache: Dict[bool, Tuple[int, InlineKeyboardMarkup]] = {}
+def bump_catalog_version():
+    global _catalog_version
+    _catalog_version += 1
+def cached_kb_categories(is_admin_user: bool) -> Optional[InlineKeyboardMarkup]:
+    hit = _categories_kb_cache.get(bool(is_admin_user))
+    if hit and hit[0] == _catalog_version:
+        return hit[1]
+    return None
 def kb_categories(is_admin_user: bool) -> InlineKeyboardMarkup:
-    cur.execute(
-        """
-        SELECT c.cid, c.title, COUNT(p.pid)
-        FROM categories c
-        LEFT JOIN products p ON p.cid=c.cid AND p.active=1
-        GROUP BY c.cid
-        ORDER BY c.title
-        """
-    )
+    cached = cached_kb_categories(is_admin_user)
+    if cached is not None:
+        return cached
+    version = _catalog_version
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT c.cid, c.title, COUNT(p.pid)
+            FROM categories c
+            LEFT JOIN products p ON p.cid=c.cid AND p.active=1
+            GROUP BY c.cid
+            ORDER BY c.title
+            """
+        )
+        cats = c.fetchall()
     rows = []
-    for cid, title, cnt in cur.fetchall():
+    for cid, title, cnt in cats:
         if title in HIDDEN_CATEGORIES:
             continue
         rows.append([InlineKeyboardButton(f"{title} | {cnt}", callback_data=f"cat:{cid}")])
     if is_admin_user:
         rows.append([InlineKeyboardButton("👑 Admin Panel", callback_data="admin:panel")])
-    return InlineKeyboardMarkup(rows)
+    kb = InlineKeyboardMarkup(rows)
+    _categories_kb_cache[bool(is_admin_user)] = (version, kb)
+    return kb
 def product_stock(pid: int) -> int:
-    cur.execute("SELECT COUNT(*) FROM codes WHERE pid=? AND used=0", (pid,))
-    return int(cur.fetchone()[0])
+    with db_read() as c:
+        c.execute("SELECT available FROM product_stock WHERE pid=?", (pid,))
+        row = c.fetchone()
+    return int(row[0]) if row else 0
 def get_base_product_price(pid: int) -> float:
-    cur.execute("SELECT price FROM products WHERE pid=?", (pid,))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT price FROM products WHERE pid=?", (pid,))
+        row = c.fetchone()
     return float(row[0]) if row else 0.0
 
 
 def get_admin_product_price(uid: int, pid: int, default_price: Optional[float] = None) -> float:
-    cur.execute("SELECT price FROM user_product_prices WHERE user_id=? AND pid=?", (uid, pid))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT price FROM user_product_prices WHERE user_id=? AND pid=?", (uid, pid))
+        row = c.fetchone()
     if row:
         return float(row[0])
     if default_price is not None:
@@ -818,11 +1873,12 @@ def get_admin_product_price(uid: int, pid: int, default_price: Optional[float] =
 def get_pos_product_price(reseller_id: Optional[int], client_uid: int, pid: int) -> Optional[float]:
     if not reseller_id:
         return None
-    cur.execute(
-        "SELECT price FROM pos_product_prices WHERE reseller_id=? AND client_user_id=? AND pid=?",
-        (reseller_id, client_uid, pid),
-    )
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute(
+            "SELECT price FROM pos_product_prices WHERE reseller_id=? AND client_user_id=? AND pid=?",
+            (reseller_id, client_uid, pid),
+        )
+        row = c.fetchone()
     return float(row[0]) if row else None
 
 
@@ -833,56 +1889,101 @@ def get_user_product_price(uid: int, pid: int, default_price: Optional[float] =
     return float(pos_price) if pos_price is not None else float(base)
 
 
+def resolve_prices(uid: int, pids: List[int], include_pos: bool = True) -> Dict[int, float]:
+    """
+    Effective prices for many products in a fixed number of queries:
+    POS price (if include_pos) > per-user admin price > product price.
+    Unknown pids are left out of the result.
+    """
+    pids = list(dict.fromkeys(int(p) for p in pids))
+    if not pids:
+        return {}
+    with db_read() as c:
+        reseller_id = None
+        if include_pos:
+            c.execute(
+                """
+                SELECT COALESCE(
+                  (SELECT reseller_id FROM reseller_clients WHERE client_user_id=?),
+                  (SELECT user_id FROM resellers WHERE user_id=? AND active=1)
+                )
+                """,
+                (uid, uid),
+            )
+            row = c.fetchone()
+            reseller_id = int(row[0]) if row and row[0] is not None else None
+        out: Dict[int, float] = {}
+        for i in range(0, len(pids), 500):
+            chunk = pids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            c.execute(
+                f"""
+                SELECT p.pid, COALESCE(ppp.price, upp.price, p.price)
+                FROM products p
+                LEFT JOIN user_product_prices upp ON upp.user_id=? AND upp.pid=p.pid
+                LEFT JOIN pos_product_prices ppp ON ppp.reseller_id=? AND ppp.client_user_id=? AND ppp.pid=p.pid
+                WHERE p.pid IN ({marks})
+                """,
+                (uid, reseller_id, uid, *chunk),
+            )
+            for pid, price in c.fetchall():
+                out[int(pid)] = float(price)
+    return out
+
+
 def get_effective_product_base_for_pos(client_uid: int, pid: int) -> float:
     return get_admin_product_price(client_uid, pid, get_base_product_price(pid))
 
 
 def has_user_product_price(uid: int, pid: int) -> bool:
-    cur.execute("SELECT 1 FROM user_product_prices WHERE user_id=? AND pid=?", (uid, pid))
-    return cur.fetchone() is not None
+    with db_read() as c:
+        c.execute("SELECT 1 FROM user_product_prices WHERE user_id=? AND pid=?", (uid, pid))
+        return c.fetchone() is not None
 
 
 def set_user_product_price(uid: int, pid: int, price: float):
-    cur.execute(
-        "INSERT INTO user_product_prices(user_id, pid, price) VALUES(?,?,?) ON CONFLICT(user_id, pid) DO UPDATE SET price=excluded.price",
-        (uid, pid, float(price)),
-    )
-    con.commit()
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO user_product_prices(user_id, pid, price) VALUES(?,?,?) ON CONFLICT(user_id, pid) DO UPDATE SET price=excluded.price",
+            (uid, pid, float(price)),
+        )
 
 
 def clear_user_product_price(uid: int, pid: int):
-    cur.execute("DELETE FROM user_product_prices WHERE user_id=? AND pid=?", (uid, pid))
-    con.commit()
+    with db_write() as c:
+        c.execute("DELETE FROM user_product_prices WHERE user_id=? AND pid=?", (uid, pid))
 
 
 def has_pos_product_price(reseller_id: int, client_uid: int, pid: int) -> bool:
-    cur.execute(
-        "SELECT 1 FROM pos_product_prices WHERE reseller_id=? AND client_user_id=? AND pid=?",
-        (reseller_id, client_uid, pid),
-    )
-    return cur.fetchone() is not None
+    with db_read() as c:
+        c.execute(
+            "SELECT 1 FROM pos_product_prices WHERE reseller_id=? AND client_user_id=? AND pid=?",
+            (reseller_id, client_uid, pid),
+        )
+        return c.fetchone() is not None
 
 
 def set_pos_product_price(reseller_id: int, client_uid: int, pid: int, price: float):
-    cur.execute(
-        "INSERT INTO pos_product_prices(reseller_id, client_user_id, pid, price) VALUES(?,?,?,?) ON CONFLICT(reseller_id, client_user_id, pid) DO UPDATE SET price=excluded.price, created_at=datetime('now')",
-        (reseller_id, client_uid, pid, float(price)),
-    )
-    con.commit()
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO pos_product_prices(reseller_id, client_user_id, pid, price) VALUES(?,?,?,?) ON CONFLICT(reseller_id, client_user_id, pid) DO UPDATE SET price=excluded.price, created_at=datetime('now')",
+            (reseller_id, client_uid, pid, float(price)),
+        )
 
 
 def clear_pos_product_price(reseller_id: int, client_uid: int, pid: int):
-    cur.execute(
-        "DELETE FROM pos_product_prices WHERE reseller_id=? AND client_user_id=? AND pid=?",
-        (reseller_id, client_uid, pid),
-    )
-    con.commit()
+    with db_write() as c:
+        c.execute(
+            "DELETE FROM pos_product_prices WHERE reseller_id=? AND client_user_id=? AND pid=?",
+            (reseller_id, client_uid, pid),
+        )
 
 
 def get_admin_manual_price(uid: Optional[int], key: str, default_price: Optional[float] = None) -> float:
     if uid is not None:
-        cur.execute("SELECT price FROM user_manual_prices WHERE user_id=? AND pkey=?", (uid, key))
-        row = cur.fetchone()
+        with db_read() as c:
+            c.execute("SELECT price FROM user_manual_prices WHERE user_id=? AND pkey=?", (uid, key))
+            row = c.fetchone()
         if row:
             return float(row[0])
     if default_price is not None:
@@ -893,11 +1994,12 @@ def get_admin_manual_price(uid: Optional[int], key: str, default_price: Optional
 def get_pos_manual_price(reseller_id: Optional[int], client_uid: int, key: str) -> Optional[float]:
     if not reseller_id:
         return None
-    cur.execute(
-        "SELECT price FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=? AND pkey=?",
-        (reseller_id, client_uid, key),
-    )
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute(
+            "SELECT price FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=? AND pkey=?",
+            (reseller_id, client_uid, key),
+        )
+        row = c.fetchone()
     return float(row[0]) if row else None
 
 
@@ -916,58 +2018,62 @@ def get_effective_manual_base_for_pos(client_uid: int, key: str) -> float:
 
 
 def has_user_manual_price(uid: int, key: str) -> bool:
-    cur.execute("SELECT 1 FROM user_manual_prices WHERE user_id=? AND pkey=?", (uid, key))
-    return cur.fetchone() is not None
+    with db_read() as c:
+        c.execute("SELECT 1 FROM user_manual_prices WHERE user_id=? AND pkey=?", (uid, key))
+        return c.fetchone() is not None
 
 
 def set_user_manual_price(uid: int, key: str, price: float):
-    cur.execute(
-        "INSERT INTO user_manual_prices(user_id, pkey, price) VALUES(?,?,?) ON CONFLICT(user_id, pkey) DO UPDATE SET price=excluded.price",
-        (uid, key, float(price)),
-    )
-    con.commit()
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO user_manual_prices(user_id, pkey, price) VALUES(?,?,?) ON CONFLICT(user_id, pkey) DO UPDATE SET price=excluded.price",
+            (uid, key, float(price)),
+        )
 
 
 def clear_user_manual_price(uid: int, key: str):
-    cur.execute("DELETE FROM user_manual_prices WHERE user_id=? AND pkey=?", (uid, key))
-    con.commit()
+    with db_write() as c:
+        c.execute("DELETE FROM user_manual_prices WHERE user_id=? AND pkey=?", (uid, key))
 
 
 def has_pos_manual_price(reseller_id: int, client_uid: int, key: str) -> bool:
-    cur.execute(
-        "SELECT 1 FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=? AND pkey=?",
-        (reseller_id, client_uid, key),
-    )
-    return cur.fetchone() is not None
+    with db_read() as c:
+        c.execute(
+            "SELECT 1 FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=? AND pkey=?",
+            (reseller_id, client_uid, key),
+        )
+        return c.fetchone() is not None
 
 
 def set_pos_manual_price(reseller_id: int, client_uid: int, key: str, price: float):
-    cur.execute(
-        "INSERT INTO pos_manual_prices(reseller_id, client_user_id, pkey, price) VALUES(?,?,?,?) ON CONFLICT(reseller_id, client_user_id, pkey) DO UPDATE SET price=excluded.price, created_at=datetime('now')",
-        (reseller_id, client_uid, key, float(price)),
-    )
-    con.commit()
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO pos_manual_prices(reseller_id, client_user_id, pkey, price) VALUES(?,?,?,?) ON CONFLICT(reseller_id, client_user_id, pkey) DO UPDATE SET price=excluded.price, created_at=datetime('now')",
+            (reseller_id, client_uid, key, float(price)),
+        )
 
 
 def clear_pos_manual_price(reseller_id: int, client_uid: int, key: str):
-    cur.execute(
-        "DELETE FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=? AND pkey=?",
-        (reseller_id, client_uid, key),
-    )
-    con.commit()
+    with db_write() as c:
+        c.execute(
+            "DELETE FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=? AND pkey=?",
+            (reseller_id, client_uid, key),
+        )
 
 
 def pos_all_products_text(client_uid: Optional[int] = None) -> str:
-    cur.execute(
-        """
-        SELECT p.pid, p.title, p.price, c.title
-        FROM products p
-        JOIN categories c ON c.cid = p.cid
-        WHERE p.active=1
-        ORDER BY c.title, p.pid
-        """
-    )
-    rows = cur.fetchall()
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT p.pid, p.title, p.price, c.title
+            FROM products p
+            JOIN categories c ON c.cid = p.cid
+            WHERE p.active=1
+            ORDER BY c.title, p.pid
+            """
+        )
+        rows = c.fetchall()
+    effective_prices = resolve_prices(client_uid, [r[0] for r in rows], include_pos=False) if client_uid else {}
     lines = ["📦 *Available Auto Products*", ""]
     if not rows:
         lines.append("لا توجد منتجات تلقائية نشطة.")
@@ -977,7 +2083,7 @@ def pos_all_products_text(client_uid: Optional[int] = None) -> str:
             if cat_title != last_cat:
                 lines.append(f"*{cat_title}*")
                 last_cat = cat_title
-            effective = get_effective_product_base_for_pos(client_uid, int(pid)) if client_uid else float(price)
+            effective = effective_prices.get(int(pid), float(price))
             lines.append(f"• PID `{pid}` | {title} | Base *{float(effective):.3f}{CURRENCY}*")
     return "\n".join(lines)[:3800]
 
@@ -1051,56 +2157,61 @@ def calculate_pos_manual_profit(reseller_id: Optional[int], client_uid: int, ser
     return 0.0, ""
 
 def is_reseller(uid: int) -> bool:
-    cur.execute("SELECT active FROM resellers WHERE user_id=?", (uid,))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT active FROM resellers WHERE user_id=?", (uid,))
+        row = c.fetchone()
     return bool(int(row[0])) if row else False
 
 def add_reseller(uid: int):
     ensure_user_exists(uid)
-    cur.execute("INSERT INTO resellers(user_id, active, profit_balance) VALUES(?,1,COALESCE((SELECT profit_balance FROM resellers WHERE user_id=?),0)) ON CONFLICT(user_id) DO UPDATE SET active=1", (uid, uid))
-    con.commit()
+    with db_write() as c:
+        c.execute("INSERT INTO resellers(user_id, active, profit_balance) VALUES(?,1,COALESCE((SELECT profit_balance FROM resellers WHERE user_id=?),0)) ON CONFLICT(user_id) DO UPDATE SET active=1", (uid, uid))
 
 def remove_reseller(uid: int):
-    cur.execute("DELETE FROM reseller_clients WHERE reseller_id=?", (uid,))
-    cur.execute("DELETE FROM pos_product_prices WHERE reseller_id=?", (uid,))
-    cur.execute("DELETE FROM pos_manual_prices WHERE reseller_id=?", (uid,))
-    cur.execute("DELETE FROM reseller_profit_log WHERE reseller_id=?", (uid,))
-    cur.execute("DELETE FROM resellers WHERE user_id=?", (uid,))
-    con.commit()
+    with db_write() as c:
+        c.execute("DELETE FROM reseller_clients WHERE reseller_id=?", (uid,))
+        c.execute("DELETE FROM pos_product_prices WHERE reseller_id=?", (uid,))
+        c.execute("DELETE FROM pos_manual_prices WHERE reseller_id=?", (uid,))
+        c.execute("DELETE FROM reseller_profit_log WHERE reseller_id=?", (uid,))
+        c.execute("DELETE FROM resellers WHERE user_id=?", (uid,))
 
 def reseller_profit_balance(uid: int) -> float:
-    cur.execute("SELECT profit_balance FROM resellers WHERE user_id=?", (uid,))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT profit_balance FROM resellers WHERE user_id=?", (uid,))
+        row = c.fetchone()
     return float(row[0]) if row else 0.0
 
 def add_reseller_profit(uid: int, amount: float, source_type: str, source_id: Optional[str] = None, note: str = ""):
     if amount <= 0:
         return
-    add_reseller(uid)
-    cur.execute("UPDATE resellers SET profit_balance=profit_balance+? WHERE user_id=?", (float(amount), uid))
-    cur.execute(
-        "INSERT INTO reseller_profit_log(reseller_id, amount, source_type, source_id, note) VALUES(?,?,?,?,?)",
-        (uid, float(amount), source_type[:80], str(source_id or "")[:80], note[:1000]),
-    )
-    con.commit()
+    with db_write() as c:
+        add_reseller(uid)
+        c.execute("UPDATE resellers SET profit_balance=profit_balance+? WHERE user_id=?", (float(amount), uid))
+        c.execute(
+            "INSERT INTO reseller_profit_log(reseller_id, amount, source_type, source_id, note) VALUES(?,?,?,?,?)",
+            (uid, float(amount), source_type[:80], str(source_id or "")[:80], note[:1000]),
+        )
 
 def transfer_reseller_profit_to_balance(uid: int) -> float:
-    amount = reseller_profit_balance(uid)
-    if amount <= 0:
-        return 0.0
-    cur.execute("UPDATE resellers SET profit_balance=0 WHERE user_id=?", (uid,))
-    con.commit()
-    add_balance_logged(uid, amount, "POS_PROFIT_TRANSFER", note="Transfer reseller profit to balance")
+    with db_write() as c:
+        c.execute("SELECT profit_balance FROM resellers WHERE user_id=?", (uid,))
+        row = c.fetchone()
+        amount = float(row[0]) if row else 0.0
+        if amount <= 0:
+            return 0.0
+        c.execute("UPDATE resellers SET profit_balance=0 WHERE user_id=?", (uid,))
+        add_balance_logged(uid, amount, "POS_PROFIT_TRANSFER", note="Transfer reseller profit to balance")
     return float(amount)
 
 def get_client_reseller_id(uid: int) -> Optional[int]:
-    cur.execute("SELECT reseller_id FROM reseller_clients WHERE client_user_id=?", (uid,))
-    row = cur.fetchone()
+    with db_read() as c:
+        c.execute("SELECT reseller_id FROM reseller_clients WHERE client_user_id=?", (uid,))
+        row = c.fetchone()
     return int(row[0]) if row else None
 
 
 def get_effective_reseller_id(uid: int) -> Optional[int]:
-    reseller_id = get_effective_reseller_id(uid)
+    reseller_id = get_client_reseller_id(uid)
     if reseller_id is not None:
         return reseller_id
     if is_reseller(uid):
@@ -1108,8 +2219,9 @@ def get_effective_reseller_id(uid: int) -> Optional[int]:
     return None
 
 def reseller_can_manage_client(reseller_id: int, client_uid: int) -> bool:
-    cur.execute("SELECT 1 FROM reseller_clients WHERE reseller_id=? AND client_user_id=?", (reseller_id, client_uid))
-    return cur.fetchone() is not None
+    with db_read() as c:
+        c.execute("SELECT 1 FROM reseller_clients WHERE reseller_id=? AND client_user_id=?", (reseller_id, client_uid))
+        return c.fetchone() is not None
 
 def assign_client_to_reseller(reseller_id: int, client_uid: int) -> Tuple[bool, str]:
     if reseller_id == client_uid:
@@ -1119,47 +2231,48 @@ def assign_client_to_reseller(reseller_id: int, client_uid: int) -> Tuple[bool,
     if is_reseller(client_uid):
         return False, "هذا المستخدم نقطة بيع بالفعل."
     ensure_user_exists(client_uid)
-    cur.execute("SELECT reseller_id FROM reseller_clients WHERE client_user_id=?", (client_uid,))
-    row = cur.fetchone()
-    if row and int(row[0]) == reseller_id:
-        return False, "العميل مضاف بالفعل لهذه النقطة."
-    if row and int(row[0]) != reseller_id:
-        return False, f"العميل تابع لنقطة بيع أخرى: {int(row[0])}"
-    cur.execute("INSERT OR REPLACE INTO reseller_clients(client_user_id, reseller_id) VALUES(?,?)", (client_uid, reseller_id))
-    con.commit()
+    with db_write() as c:
+        c.execute("SELECT reseller_id FROM reseller_clients WHERE client_user_id=?", (client_uid,))
+        row = c.fetchone()
+        if row and int(row[0]) == reseller_id:
+            return False, "العميل مضاف بالفعل لهذه النقطة."
+        if row and int(row[0]) != reseller_id:
+            return False, f"العميل تابع لنقطة بيع أخرى: {int(row[0])}"
+        c.execute("INSERT OR REPLACE INTO reseller_clients(client_user_id, reseller_id) VALUES(?,?)", (client_uid, reseller_id))
     return True, "تم ربط العميل بنقطة البيع."
 
 def remove_client_from_reseller(reseller_id: int, client_uid: int) -> bool:
-    cur.execute("DELETE FROM reseller_clients WHERE reseller_id=? AND client_user_id=?", (reseller_id, client_uid))
-    ch = cur.rowcount
-    if ch:
-        cur.execute(
-            "DELETE FROM pos_product_prices WHERE reseller_id=? AND client_user_id=?",
-            (reseller_id, client_uid),
-        )
-        cur.execute(
-            "DELETE FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=?",
-            (reseller_id, client_uid),
-        )
-    con.commit()
+    with db_write() as c:
+        c.execute("DELETE FROM reseller_clients WHERE reseller_id=? AND client_user_id=?", (reseller_id, client_uid))
+        ch = c.rowcount
+        if ch:
+            c.execute(
+                "DELETE FROM pos_product_prices WHERE reseller_id=? AND client_user_id=?",
+                (reseller_id, client_uid),
+            )
+            c.execute(
+                "DELETE FROM pos_manual_prices WHERE reseller_id=? AND client_user_id=?",
+                (reseller_id, client_uid),
+            )
     return bool(ch)
 
 def effective_topup_allowed(uid: int) -> bool:
     return get_client_reseller_id(uid) is None
 
 def pos_clients_text(reseller_id: int) -> str:
-    cur.execute(
-        """
-        SELECT u.user_id, u.username, u.first_name, u.balance
-        FROM reseller_clients rc
-        JOIN users u ON u.user_id=rc.client_user_id
-        WHERE rc.reseller_id=?
-        ORDER BY rc.client_user_id DESC
-        LIMIT 100
-        """,
-        (reseller_id,),
-    )
-    rows = cur.fetchall()
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT u.user_id, u.username, u.first_name, u.balance
+            FROM reseller_clients rc
+            JOIN users u ON u.user_id=rc.client_user_id
+            WHERE rc.reseller_id=?
+            ORDER BY rc.client_user_id DESC
+            LIMIT 100
+            """,
+            (reseller_id,),
+        )
+        rows = c.fetchall()
     lines = ["🏪 *POS Clients*", f"POS ID: `{reseller_id}`", ""]
     if not rows:
         lines.append("لا يوجد عملاء تابعون لهذه النقطة بعد.")
@@ -1187,8 +2300,9 @@ def kb_pos_panel(uid: int) -> InlineKeyboardMarkup:
     )
 
 def pos_panel_text(uid: int) -> str:
-    cur.execute("SELECT COUNT(*) FROM reseller_clients WHERE reseller_id=?", (uid,))
-    client_count = int(cur.fetchone()[0] or 0)
+    with db_read() as c:
+        c.execute("SELECT COUNT(*) FROM reseller_clients WHERE reseller_id=?", (uid,))
+        client_count = int(c.fetchone()[0] or 0)
     profit = reseller_profit_balance(uid)
     return (
         "🏪 *POS Panel*\n\n"
@@ -1205,24 +2319,25 @@ def pos_panel_text(uid: int) -> str:
     )
 
 def pos_product_prices_text(reseller_id: int) -> str:
-    cur.execute(
-        """
-        SELECT ppp.client_user_id, ppp.pid, ppp.price, p.title
-        FROM pos_product_prices ppp
-        LEFT JOIN products p ON p.pid = ppp.pid
-        WHERE ppp.reseller_id=?
-        ORDER BY ppp.client_user_id ASC, ppp.pid ASC
-        LIMIT 250
-        """,
-        (reseller_id,),
-    )
-    rows = cur.fetchall()
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT ppp.client_user_id, ppp.pid, ppp.price, p.title, COALESCE(upp.price, p.price, 0)
+            FROM pos_product_prices ppp
+            LEFT JOIN products p ON p.pid = ppp.pid
+            LEFT JOIN user_product_prices upp ON upp.user_id = ppp.client_user_id AND upp.pid = ppp.pid
+            WHERE ppp.reseller_id=?
+            ORDER BY ppp.client_user_id ASC, ppp.pid ASC
+            LIMIT 250
+            """,
+            (reseller_id,),
+        )
+        rows = c.fetchall()
     lines = ["📋 *POS Auto Prices*", ""]
     if not rows:
         lines.append("لا توجد أسعار تلقائية خاصة محفوظة لعملائك.")
     else:
-        for xuid, pid, price, ptitle in rows:
-            base = get_effective_product_base_for_pos(int(xuid), int(pid))
+        for xuid, pid, price, ptitle, base in rows:
             lines.append(f"• Client `{xuid}` | PID `{pid}` | Base *{float(base):.3f}{CURRENCY}* → Sell *{float(price):.3f}{CURRENCY}* | {ptitle or '-'}")
     lines.append("")
     lines.append("استخدم 🎯 Auto Price للتعديل أو الحذف.")
@@ -1231,17 +2346,18 @@ def pos_product_prices_text(reseller_id: int) -> str:
     return "\n".join(lines)[:3800]
 
 def pos_manual_prices_text(reseller_id: int) -> str:
-    cur.execute(
-        """
-        SELECT pmp.client_user_id, pmp.pkey, pmp.price
-        FROM pos_manual_prices pmp
-        WHERE pmp.reseller_id=?
-        ORDER BY pmp.client_user_id ASC, pmp.pkey ASC
-        LIMIT 250
-        """,
-        (reseller_id,),
-    )
-    rows = cur.fetchall()
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT pmp.client_user_id, pmp.pkey, pmp.price
+            FROM pos_manual_prices pmp
+            WHERE pmp.reseller_id=?
+            ORDER BY pmp.client_user_id ASC, pmp.pkey ASC
+            LIMIT 250
+            """,
+            (reseller_id,),
+        )
+        rows = c.fetchall()
     lines = ["📋 *POS Manual Prices*", ""]
     if not rows:
         lines.append("لا توجد أسعار يدوية خاصة محفوظة لعملائك.")
@@ -1267,17 +2383,18 @@ def kb_reseller_admin_panel() -> InlineKeyboardMarkup:
 
 
 def reseller_admin_text() -> str:
-    cur.execute(
-        """
-        SELECT r.user_id, r.profit_balance, COUNT(rc.client_user_id)
-        FROM resellers r
-        LEFT JOIN reseller_clients rc ON rc.reseller_id=r.user_id
-        WHERE r.active=1
-        GROUP BY r.user_id, r.profit_balance
-        ORDER BY r.user_id
-        """
-    )
-    rows = cur.fetchall()
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT r.user_id, r.profit_balance, COUNT(rc.client_user_id)
+            FROM resellers r
+            LEFT JOIN reseller_clients rc ON rc.reseller_id=r.user_id
+            WHERE r.active=1
+            GROUP BY r.user_id, r.profit_balance
+            ORDER BY r.user_id
+            """
+        )
+        rows = c.fetchall()
     lines = ["🏪 *POS Control*", ""]
     if not rows:
         lines.append("No active POS yet.")
@@ -1289,15 +2406,38 @@ def reseller_admin_text() -> str:
     return "\n".join(lines)[:3800]
 
 
+_category_products_cache: Dict[int, Tuple[int, List[Tuple[int, str, float]]]] = {}
+def category_products(cid: int) -> List[Tuple[int, str, float]]:
+    # active (pid, title, price) rows of a category in display order, cached per catalog version
+    hit = _category_products_cache.get(cid)
+    if hit and hit[0] == _catalog_version:
+        return hit[1]
+    version = _catalog_version
+    with db_read() as c:
+        c.execute(
+            "SELECT pid, title, price FROM products WHERE cid=? AND active=1 ORDER BY sort_value, pid",
+            (cid,),
+        )
+        items = [(int(pid), title, float(price)) for pid, title, price in c.fetchall()]
+    _category_products_cache[cid] = (version, items)
+    return items
 def kb_products(cid: int, viewer_uid: Optional[int] = None) -> InlineKeyboardMarkup:
-
-    cur.execute("SELECT pid,title,price FROM products WHERE cid=? AND active=1", (cid,))
-    items = cur.fetchall()
-    items.sort(key=lambda r: extract_sort_value(r[1]))
+    items = category_products(cid)
+    with db_read() as c:
+        c.execute(
+            """
+            SELECT s.pid, s.available FROM product_stock s
+            JOIN products p ON p.pid=s.pid
+            WHERE p.cid=? AND p.active=1
+            """,
+            (cid,),
+        )
+        stock_by_pid = {int(pid): int(n) for pid, n in c.fetchall()}
+    prices = resolve_prices(viewer_uid, [r[0] for r in items]) if viewer_uid else {}
     rows = []
     for pid, title, price in items:
-        stock = product_stock(pid)
-        show_price = get_user_product_price(viewer_uid, pid, float(price)) if viewer_uid else float(price)
+        stock = stock_by_pid.get(pid, 0)
+        show_price = prices.get(pid, price)
         label = f"{title} | {money(float(show_price))} | 📦{stock}"
         rows.append([InlineKeyboardButton(label[:62], callback_data=f"view:{pid}")])
     rows.append([InlineKeyboardButton("⬅️ Back", callback_data="back:cats")])
@@ -1404,8 +2544,7 @@ def kb_manual_prices_panel() -> InlineKeyboardMarkup:
         ]
     )
 def manual_prices_text() -> str:
-    cur.execute("SELECT pkey, price FROM manual_prices ORDER BY pkey")
-    rows = cur.fetchall()
+    rows = sorted(_manual_prices.items())
     lines = ["🛠 *Manual Control*", "", "الأسعار الحالية:"]
     for k, p in rows:
         lines.append(f"• `{k}` = *{float(p):.3f}{CURRENCY}*")
@@ -1462,7 +2601,7 @@ def kb_admin_manual_view(mid: int, service: str, has_email: bool, has_pass: bool
     rows.append([InlineKeyboardButton("⬅️ Back", callback_data="admin:manuallist:0")])
     rows.append([InlineKeyboardButton("👑 Admin Home", callback_data="admin:panel")])
     return InlineKeyboardMarkup(rows)
-def kb_admin_users_page(page: int, total_pages: int, rows: List[Tuple[int, str, str, float, int, float, int, float, float, int]]) -> InlineKeyboardMarkup:
+def kb_admin_users_page(page: int, total_pages: int, rows: List[Tuple[int, str, str, float, int, float, int, float, float, int]], sort: str = "id", has_next: bool = False) -> InlineKeyboardMarkup:
     buttons = []
     for uid, username, first_name, bal, oc, osp, mc, msp, dep, suspended in rows:
         uname = f"@{username}" if username else ""
@@ -1472,13 +2611,22 @@ def kb_admin_users_page(page: int, total_pages: int, rows: List[Tuple[int, str,
         sub = f" | 💰{bal:.3f}{CURRENCY} | 🧾{oc} | 🔥{osp:.3f}{CURRENCY}"
         text = (label + sub)[:58]
         buttons.append([InlineKeyboardButton(text, callback_data=f"admin:user:view:{uid}")])
+    # id sort pages by cursor (b<first uid> / a<last uid>), the others by offset
+    keyset = sort == "id" and bool(rows)
+    prev_cursor = f":b{rows[0][0]}" if keyset else ""
+    next_cursor = f":a{rows[-1][0]}" if keyset else ""
     nav = []
     if page > 0:
-        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:users:{page-1}"))
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:users:{page-1}:{sort}{prev_cursor}"))
     nav.append(InlineKeyboardButton(f"Page {page+1}/{total_pages}", callback_data="noop"))
-    if page < total_pages - 1:
-        nav.append(InlineKeyboardButton("➡️ Next", callback_data=f"admin:users:{page+1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️ Next", callback_data=f"admin:users:{page+1}:{sort}{next_cursor}"))
     buttons.append(nav)
+    sorts = [("id", "🆔 ID"), ("spend", "🔥 Spend"), ("bal", "💰 Balance")]
+    buttons.append([
+        InlineKeyboardButton(("✅ " if key == sort else "") + label, callback_data=f"admin:users:0:{key}")
+        for key, label in sorts
+    ])
     buttons.append([InlineKeyboardButton("👑 Admin Home", callback_data="admin:panel")])
     return InlineKeyboardMarkup(buttons)
 def kb_admin_user_view(uid: int, suspended: int) -> InlineKeyboardMarkup:
@@ -1609,17 +2757,18 @@ def ff_checkout_text(context, uid: Optional[int] = None) -> str:
 # Pages
 # =========================
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update.effective_user)
-    ensure_user_exists(ADMIN_ID)
+    await touch_user(update.effective_user)
+    await run_db(ensure_user_exists, ADMIN_ID)
     await update.message.reply_text("✅ Bot is online! 🚀", reply_markup=REPLY_MENU)
 async def id_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update.effective_user)
+    await touch_user(update.effective_user)
     await update.message.reply_text(f"🆔 Your ID: `{update.effective_user.id}`", parse_mode=ParseMode.MARKDOWN, reply_markup=REPLY_MENU)
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user and must_block_user(update):
         return await update.message.reply_text("⛔ حسابك موقوف. تواصل مع الدعم.", reply_markup=kb_support())
     text = "🛒 *Our Categories*\nاختر قسم 👇"
-    kb = kb_categories(is_admin_any(update.effective_user.id))
+    is_admin_user = is_admin_any(update.effective_user.id)
+    kb = cached_kb_categories(is_admin_user) or await run_db(kb_categories, is_admin_user)
     if update.message:
         await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
     else:
@@ -1631,8 +2780,8 @@ async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.callback_query.edit_message_text("⛔ حسابك موقوف. تواصل مع الدعم.", reply_markup=kb_support())
     u = update.effective_user
     uid = u.id
-    bal = get_balance(uid)
-    reseller_id = get_effective_reseller_id(uid)
+    bal = await run_db(get_balance, uid)
+    reseller_id = await run_db(get_effective_reseller_id, uid)
     if reseller_id is not None:
         text = (
             "💰 *Wallet*\n\n"
@@ -1691,7 +2840,7 @@ def smart_reply(msg: str) -> Optional[str]:
         return "💡 من 💰 My Balance اختر طريقة الشحن ثم اضغط ✅ I Have Paid وأرسل Amount | TXID."
     return None
 async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update.effective_user)
+    await touch_user(update.effective_user)
     # block suspended users (except admins)
     if must_block_user(update):
         t = (update.message.text or "").strip()
@@ -1710,9 +2859,9 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if t == "☎️ Contact Support":
         return await show_support(update, context)
     if t == "🏪 POS Panel":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await update.message.reply_text("❌ هذه القائمة متاحة لنقاط البيع فقط.", reply_markup=REPLY_MENU)
-        return await update.message.reply_text(pos_panel_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await update.message.reply_text(await run_db(pos_panel_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if t == "⚡ Manual Order":
         # ✅ enforce hours
         if not manual_open_now() and not is_admin_any(update.effective_user.id):
@@ -1758,13 +2907,12 @@ async def qty_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     if qty < 1 or qty > max_qty:
         return await update.message.reply_text(f"❌ Enter a quantity between 1 and {max_qty}:")
-    cur.execute("SELECT title, price FROM products WHERE pid=? AND active=1", (pid,))
-    row = cur.fetchone()
+    row = await run_db(db_fetchone, "SELECT title, price FROM products WHERE pid=? AND active=1", (pid,))
     if not row:
         await update.message.reply_text("❌ Product not found.")
         return ConversationHandler.END
     title, base_price = row
-    price = get_user_product_price(update.effective_user.id, pid, float(base_price))
+    price = await run_db(get_user_product_price, update.effective_user.id, pid, float(base_price))
     total = float(price) * qty
     client_ref = secrets.token_hex(10)
     context.user_data[UD_ORDER_CLIENT_REF] = client_ref
@@ -1812,40 +2960,29 @@ async def topup_details_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         amount = float(a)
     except ValueError:
         return await update.message.reply_text("❌ Amount must be a number.\nExample: 10 | TXID")
-    cur.execute("SELECT user_id, status FROM deposits WHERE id=?", (dep_id,))
-    row = cur.fetchone()
-    if not row:
+    uid = update.effective_user.id
+    status = await run_db(submit_deposit_details, dep_id, uid, amount, txid)
+    if status == "NOT_FOUND":
         await update.message.reply_text("❌ Deposit not found.")
         return ConversationHandler.END
-    if row[1] not in ("WAITING_PAYMENT", "PAID", "PENDING_REVIEW"):
+    if status != "OK":
         await update.message.reply_text("❌ This deposit is already processed.")
         return ConversationHandler.END
-    cur.execute(
-        "UPDATE deposits SET txid=?, amount=?, status='PENDING_REVIEW' WHERE id=?",
-        (txid[:1500], amount, dep_id),
-    )
-    con.commit()
-    uid = update.effective_user.id
     await update.message.reply_text(
         f"✅ Received!\n🧾 Deposit ID: {dep_id}\n⏳ Status: PENDING_REVIEW\n\nWe will approve soon ✅",
         reply_markup=REPLY_MENU,
     )
-    try:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=(
-                "💰 *DEPOSIT REVIEW*\n"
-                f"🧾 Deposit ID: *{dep_id}*\n"
-                f"👤 User: `{uid}`\n"
-                f"💵 Amount: *{amount}*\n"
-                f"🔗 TXID:\n`{txid}`\n\n"
-                f"✅ Approve: /approvedep {dep_id}\n"
-                f"🚫 Reject: /rejectdep {dep_id}"
-            ),
-            parse_mode=ParseMode.MARKDOWN,
-        )
-    except Exception as e:
-        logger.exception("Failed to notify admin about deposit %s: %s", dep_id, e)
+    enqueue_message(
+        ADMIN_ID,
+        "💰 *DEPOSIT REVIEW*\n"
+        f"🧾 Deposit ID: *{dep_id}*\n"
+        f"👤 User: `{uid}`\n"
+        f"💵 Amount: *{amount}*\n"
+        f"🔗 TXID:\n`{txid}`\n\n"
+        f"✅ Approve: /approvedep {dep_id}\n"
+        f"🚫 Reject: /rejectdep {dep_id}",
+        parse_mode=ParseMode.MARKDOWN,
+    )
     return ConversationHandler.END
 # =========================
 # Manual: Shahid Email/Pass
@@ -1889,24 +3026,18 @@ async def manual_pass_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if service != "SHAHID" or price <= 0 or not email or not plan_title:
         await update.message.reply_text("❌ Session expired. Open Manual Order again.", reply_markup=REPLY_MENU)
         return ConversationHandler.END
-    ok_charge, bal_before, bal_after = charge_balance_logged(uid, price, "MANUAL_SHAHID_CHARGE", note=plan_title)
-    if not ok_charge:
-        bal = get_balance(uid)
+    mid, bal_before, bal_after = await run_db(
+        create_manual_order, uid, price, "MANUAL_SHAHID_CHARGE", plan_title,
+        service="SHAHID", plan_title=plan_title, email=email, password=pwd[:250],
+    )
+    if mid is None:
+        bal = await run_db(get_balance, uid)
         missing = price - bal
         await update.message.reply_text(
             f"❌ Insufficient balance.\nYour balance: {bal:.3f} {CURRENCY}\nRequired: {price:.3f} {CURRENCY}\nMissing: {missing:.3f} {CURRENCY}",
             reply_markup=kb_topup_now(),
         )
         return ConversationHandler.END
-    cur.execute(
-        """
-        INSERT INTO manual_orders(user_id,service,plan_title,price,email,password,status)
-        VALUES(?,?,?,?,?,?,'PENDING')
-        """,
-        (uid, "SHAHID", plan_title, price, email, pwd[:250]),
-    )
-    con.commit()
-    mid = cur.lastrowid
     await update.message.reply_text(
         f"✅ Manual order created!\n"
         f"🧾 Order ID: {mid}\n"
@@ -1960,33 +3091,27 @@ async def ff_playerid_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("❌ Player ID is too short.\nExample: 123456789")
     uid = update.effective_user.id
     cart = _ff_cart_get(context)
-    total_price, total_diamonds, lines = _ff_calc_totals(cart, uid=uid)
+    total_price, total_diamonds, lines = await run_db(_ff_calc_totals, cart, uid=uid)
     if not lines or total_price <= 0:
         await update.message.reply_text("🛒 Cart is empty. Open Manual Order again.", reply_markup=REPLY_MENU)
         return ConversationHandler.END
-    ok_charge, bal_before, bal_after = charge_balance_logged(uid, total_price, "MANUAL_FF_CHARGE", note=f"diamonds={total_diamonds}")
-    if not ok_charge:
-        bal = get_balance(uid)
-        missing = total_price - bal
-        await update.message.reply_text(
-            f"❌ Insufficient balance.\nYour balance: {bal:.3f} {CURRENCY}\nRequired: {total_price:.3f} {CURRENCY}\nMissing: {missing:.3f} {CURRENCY}",
-            reply_markup=kb_topup_now(),
-        )
-        return ConversationHandler.END
     note_lines = []
     for title, qty, price, diamonds in lines:
         note_lines.append(f"{title} x{qty} | {price:.3f}{CURRENCY} | diamonds_each={diamonds}")
     note = "\n".join(note_lines)
     plan_title = f"Free Fire (MENA) | Total Diamonds: {total_diamonds}"
-    cur.execute(
-        """
-        INSERT INTO manual_orders(user_id,service,plan_title,price,player_id,note,status)
-        VALUES(?,?,?,?,?,?,'PENDING')
-        """,
-        (uid, "FREEFIRE_MENA", plan_title, float(total_price), player_id[:120], note[:4000]),
+    mid, bal_before, bal_after = await run_db(
+        create_manual_order, uid, float(total_price), "MANUAL_FF_CHARGE", f"diamonds={total_diamonds}",
+        service="FREEFIRE_MENA", plan_title=plan_title, player_id=player_id[:120], note=note[:4000],
     )
-    con.commit()
-    mid = cur.lastrowid
+    if mid is None:
+        bal = await run_db(get_balance, uid)
+        missing = total_price - bal
+        await update.message.reply_text(
+            f"❌ Insufficient balance.\nYour balance: {bal:.3f} {CURRENCY}\nRequired: {total_price:.3f} {CURRENCY}\nMissing: {missing:.3f} {CURRENCY}",
+            reply_markup=kb_topup_now(),
+        )
+        return ConversationHandler.END
     await update.message.reply_text(
         f"✅ Manual order created!\n"
         f"🧾 Order ID: {mid}\n"
@@ -2020,39 +3145,122 @@ async def ff_playerid_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # Admin: Customers helpers
 # =========================
-def _users_page(page: int, page_size: int = 10) -> Tuple[List[Tuple], int]:
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = int(cur.fetchone()[0])
+# "Page x/y" totals come from a COUNT(*) cached for APPROX_COUNT_TTL seconds;
+# the pages themselves are keyset-paginated, with the cursor in callback data.
+APPROX_COUNT_TTL = 60
+_approx_counts: Dict[str, Tuple[float, int]] = {}
+def approx_count(sql: str) -> int:
+    hit = _approx_counts.get(sql)
+    now = time.monotonic()
+    if hit and now - hit[0] <= APPROX_COUNT_TTL:
+        return hit[1]
+    with db_read() as c:
+        c.execute(sql)
+        n = int(c.fetchone()[0])
+    _approx_counts[sql] = (now, n)
+    return n
+def approx_total_pages(page: int, page_size: int, total: int, has_next: bool) -> int:
     total_pages = max(1, (total + page_size - 1) // page_size)
-    page = max(0, min(page, total_pages - 1))
-    off = page * page_size
-    cur.execute(
-        "SELECT user_id, username, first_name, balance, suspended FROM users ORDER BY user_id LIMIT ? OFFSET ?",
-        (page_size, off),
-    )
-    base_rows = cur.fetchall()
+    return max(total_pages, page + (2 if has_next else 1))
+def _keyset_fetch(c, sql: str, key: str, params: tuple, page_size: int, cursor: str = "", desc: bool = False) -> Tuple[List[Tuple], bool, bool]:
+    """
+    One page of `sql` (a SELECT ending in a WHERE clause) ordered by integer `key`.
+    cursor: "" = first page, "a<k>" = rows after key k, "b<k>" = rows before key k.
+    Returns (rows, has_prev, has_next).
+    """
+    forward = not cursor.startswith("b")
+    args = list(params)
+    extra = ""
+    if cursor[:1] in ("a", "b") and cursor[1:].isdigit():
+        after_op = "<" if desc else ">"
+        before_op = ">" if desc else "<"
+        extra = f" AND {key} {after_op if forward else before_op} ?"
+        args.append(int(cursor[1:]))
+    direction = ("DESC" if desc else "ASC") if forward else ("ASC" if desc else "DESC")
+    c.execute(f"{sql}{extra} ORDER BY {key} {direction} LIMIT ?", (*args, page_size + 1))
+    rows = c.fetchall()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if forward:
+        return rows, bool(extra), more
+    rows.reverse()
+    return rows, more, True
+USERS_SORTS = {
+    "id": "u.user_id",
+    "spend": "(COALESCE(s.orders_spent,0) + COALESCE(s.manual_spent,0)) DESC, u.user_id",
+    "bal": "u.balance DESC, u.user_id",
+}
+USERS_PAGE_SQL = """
+    SELECT u.user_id, u.username, u.first_name, u.balance,
+           COALESCE(s.orders_count,0), COALESCE(s.orders_spent,0),
+           COALESCE(s.manual_count,0), COALESCE(s.manual_spent,0),
+           COALESCE(s.deposits_approved,0), u.suspended
+    FROM users u LEFT JOIN user_stats s ON s.user_id=u.user_id
+"""
+def _users_page(page: int, page_size: int = 10, sort: str = "id", cursor: str = "") -> Tuple[List[Tuple], int, int, bool]:
+    # returns (rows, page, total_pages, has_next); the "id" sort is keyset-paginated on user_id
+    with db_read() as c:
+        if sort == "id":
+            rows, has_prev, has_next = _keyset_fetch(c, USERS_PAGE_SQL + " WHERE 1=1", "u.user_id", (), page_size, cursor)
+            if not has_prev:
+                page = 0
+        else:
+            page = max(0, page)
+            c.execute(
+                USERS_PAGE_SQL + f" ORDER BY {USERS_SORTS.get(sort, USERS_SORTS['id'])} LIMIT ? OFFSET ?",
+                (page_size + 1, page * page_size),
+            )
+            rows = c.fetchall()
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+    total_pages = approx_total_pages(page, page_size, approx_count("SELECT COUNT(*) FROM users"), has_next)
     out = []
-    for uid, username, first_name, bal, suspended in base_rows:
-        uid = int(uid)
-        cur.execute("SELECT COUNT(*), COALESCE(SUM(total),0) FROM orders WHERE user_id=? AND status='COMPLETED'", (uid,))
-        oc, osp = cur.fetchone()
-        cur.execute("SELECT COUNT(*), COALESCE(SUM(price),0) FROM manual_orders WHERE user_id=? AND status='COMPLETED'", (uid,))
-        mc, msp = cur.fetchone()
-        cur.execute("SELECT COALESCE(SUM(amount),0) FROM deposits WHERE user_id=? AND status='APPROVED'", (uid,))
-        dep = cur.fetchone()[0] or 0.0
-        out.append((uid, username or "", first_name or "", float(bal or 0), int(oc or 0), float(osp or 0), int(mc or 0), float(msp or 0), float(dep or 0), int(suspended or 0)))
-    return out, total_pages
+    for uid, username, first_name, bal, oc, osp, mc, msp, dep, suspended in rows:
+        out.append((int(uid), username or "", first_name or "", float(bal or 0), int(oc), float(osp), int(mc), float(msp), float(dep), int(suspended or 0)))
+    return out, page, total_pages, has_next
+def _pending_manual_page(page: int, page_size: int = 8, cursor: str = "") -> Tuple[List[Tuple], int, int, bool]:
+    # newest first, keyset-paginated on id
+    with db_read() as c:
+        rows, has_prev, has_next = _keyset_fetch(
+            c,
+            "SELECT id, user_id, service, plan_title, price, created_at FROM manual_orders WHERE status='PENDING'",
+            "id",
+            (),
+            page_size,
+            cursor,
+            desc=True,
+        )
+    if not has_prev:
+        page = 0
+    total = approx_count("SELECT COUNT(*) FROM manual_orders WHERE status='PENDING'")
+    return rows, page, approx_total_pages(page, page_size, total, has_next), has_next
 def _user_report_text(uid: int, limit_each: int = 10) -> str:
     ensure_user_exists(uid)
-    cur.execute("SELECT username, first_name, balance, suspended FROM users WHERE user_id=?", (uid,))
-    row = cur.fetchone() or ("", "", 0.0, 0)
+    with db_read() as c:
+        c.execute("SELECT username, first_name, balance, suspended FROM users WHERE user_id=?", (uid,))
+        row = c.fetchone() or ("", "", 0.0, 0)
+        c.execute(
+            "SELECT orders_count, orders_spent, manual_count, manual_spent, deposits_approved FROM user_stats WHERE user_id=?",
+            (uid,),
+        )
+        stats = c.fetchone() or (0, 0.0, 0, 0.0, 0.0)
+        c.execute(
+            "SELECT id, product_title, total, status, created_at FROM orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (uid, limit_each),
+        )
+        orders = c.fetchall()
+        c.execute(
+            "SELECT id, service, plan_title, price, status, created_at, COALESCE(approved_by,'') FROM manual_orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (uid, limit_each),
+        )
+        manual = c.fetchall()
+        c.execute(
+            "SELECT id, method, amount, status, created_at, txid FROM deposits WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (uid, limit_each),
+        )
+        deposits = c.fetchall()
     username, first_name, bal, suspended = row[0] or "", row[1] or "", float(row[2] or 0.0), int(row[3] or 0)
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(total),0) FROM orders WHERE user_id=? AND status='COMPLETED'", (uid,))
-    oc, osp = cur.fetchone()
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(price),0) FROM manual_orders WHERE user_id=? AND status='COMPLETED'", (uid,))
-    mc, msp = cur.fetchone()
-    cur.execute("SELECT COALESCE(SUM(amount),0) FROM deposits WHERE user_id=? AND status='APPROVED'", (uid,))
-    dep = cur.fetchone()[0] or 0.0
+    oc, osp, mc, msp, dep = stats
     lines = []
     lines.append("👥 CUSTOMER REPORT")
     lines.append(f"🆔 User ID: {uid}")
@@ -2067,50 +3275,39 @@ def _user_report_text(uid: int, limit_each: int = 10) -> str:
     lines.append(f"⚡ Manual Completed: {int(mc or 0)} | Spent: {float(msp or 0):.3f}{CURRENCY}")
     lines.append(f"💳 Deposits Approved: {float(dep or 0):.3f}{CURRENCY}")
     lines.append("\n--- LAST ORDERS ---")
-    cur.execute(
-        "SELECT id, product_title, total, status, created_at FROM orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
-        (uid, limit_each),
-    )
-    for oid, title, total, status, created_at in cur.fetchall():
+    for oid, title, total, status, created_at in orders:
         lines.append(f"#{oid} | {status} | {float(total):.3f}{CURRENCY} | {created_at} | {title}")
     lines.append("\n--- LAST MANUAL ---")
-    cur.execute(
-        "SELECT id, service, plan_title, price, status, created_at, COALESCE(approved_by,'') FROM manual_orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
-        (uid, limit_each),
-    )
-    for mid, service, plan_title, price, status, created_at, approved_by in cur.fetchall():
+    for mid, service, plan_title, price, status, created_at, approved_by in manual:
         ab = f" | approved_by={approved_by}" if approved_by else ""
         lines.append(f"M#{mid} | {status} | {float(price):.3f}{CURRENCY} | {created_at} | {service} | {plan_title}{ab}")
     lines.append("\n--- LAST DEPOSITS ---")
-    cur.execute(
-        "SELECT id, method, amount, status, created_at, txid FROM deposits WHERE user_id=? ORDER BY id DESC LIMIT ?",
-        (uid, limit_each),
-    )
-    for did, method, amount, status, created_at, txid in cur.fetchall():
+    for did, method, amount, status, created_at, txid in deposits:
         a = "None" if amount is None else f"{float(amount):.3f}{CURRENCY}"
         t = (txid or "")[:18] + ("..." if (txid and len(txid) > 18) else "")
         lines.append(f"D#{did} | {status} | {a} | {created_at} | {method} | {t}")
     return "\n".join(lines)
 def _dashboard_text() -> str:
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(total),0) FROM orders WHERE status='COMPLETED'")
-    oc, osp = cur.fetchone()
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(price),0) FROM manual_orders WHERE status='COMPLETED'")
-    mc, msp = cur.fetchone()
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(amount),0) FROM deposits WHERE status='APPROVED'")
-    dc, dep_sum = cur.fetchone()
-    cur.execute("SELECT COALESCE(SUM(CASE WHEN used=0 THEN 1 ELSE 0 END),0) FROM codes")
-    stock_all = int(cur.fetchone()[0] or 0)
-    cur.execute(
-        """
-        SELECT product_title, COALESCE(SUM(total),0) as rev
-        FROM orders
-        WHERE status='COMPLETED'
-        GROUP BY product_title
-        ORDER BY rev DESC
-        LIMIT 5
-        """
-    )
-    top = cur.fetchall()
+    with db_read() as c:
+        c.execute("SELECT COUNT(*), COALESCE(SUM(total),0) FROM orders WHERE status='COMPLETED'")
+        oc, osp = c.fetchone()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(price),0) FROM manual_orders WHERE status='COMPLETED'")
+        mc, msp = c.fetchone()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(amount),0) FROM deposits WHERE status='APPROVED'")
+        dc, dep_sum = c.fetchone()
+        c.execute("SELECT COALESCE(SUM(available),0) FROM product_stock")
+        stock_all = int(c.fetchone()[0] or 0)
+        c.execute(
+            """
+            SELECT product_title, COALESCE(SUM(total),0) as rev
+            FROM orders
+            WHERE status='COMPLETED'
+            GROUP BY product_title
+            ORDER BY rev DESC
+            LIMIT 5
+            """
+        )
+        top = c.fetchall()
     lines = []
     lines.append("📊 *Dashboard*")
     lines.append("")
@@ -2132,54 +3329,221 @@ def _dashboard_text() -> str:
 # =========================
 # Code validation rules for Admin adding codes
 # =========================
-FF_CODE_RE = re.compile(r"^\d{16}$")
-PUBG_CODE_RE = re.compile(r"^[A-Za-z0-9]{18}$")
-def _pid_code_rule(pid: int) -> Optional[str]:
-    """
-    Return 'FF16' or 'PUBG18' or None based on category/product title.
-    """
-    cur.execute(
-        """
-        SELECT p.title, c.title
-        FROM products p
-        JOIN categories c ON c.cid=p.cid
-        WHERE p.pid=?
-        """,
-        (pid,),
-    )
-    row = cur.fetchone()
-    if not row:
-        return None
-    ptitle = (row[0] or "").upper()
-    ctitle = (row[1] or "").upper()
-    blob = f"{ptitle} {ctitle}"
+# Rules live in code_rules (name -> full-match regex + error text) and each
+# product points at one via products.code_rule (NULL = accept anything).
+# Compiled patterns are cached until /coderule changes them; the pid -> rule
+# map is cached against the catalog version.
+_code_rules: Dict[str, Tuple["re.Pattern[str]", str]] = {}
+_pid_code_rules: Dict[int, Optional[str]] = {}
+_pid_code_rules_version = -1
+def guess_code_rule(product_title: str, category_title: str) -> Optional[str]:
+    # default rule for a new product, from its titles
+    blob = f"{product_title or ''} {category_title or ''}".upper()
     if "FREE FIRE" in blob or "GARENA" in blob:
         return "FF16"
     if "PUBG" in blob:
         return "PUBG18"
     return None
-def validate_codes_for_pid(pid: int, codes: List[str]) -> Tuple[bool, str]:
-    rule = _pid_code_rule(pid)
+def load_code_rules():
+    global _code_rules
+    with db_read() as c:
+        c.execute("SELECT rule, pattern, message FROM code_rules")
+        rows = c.fetchall()
+    _code_rules = {rule: (re.compile(pattern), message) for rule, pattern, message in rows}
+def _pid_code_rule(pid: int) -> Optional[str]:
+    global _pid_code_rules_version
+    if _pid_code_rules_version != _catalog_version:
+        _pid_code_rules.clear()
+        _pid_code_rules_version = _catalog_version
+    if pid not in _pid_code_rules:
+        with db_read() as c:
+            c.execute("SELECT code_rule FROM products WHERE pid=?", (pid,))
+            row = c.fetchone()
+        _pid_code_rules[pid] = row[0] if row else None
+    return _pid_code_rules[pid]
+def bad_code_lines(pid: int, lines: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+    # (line_no, code) pairs that don't full-match the product's rule
+    rule = _code_rules.get(_pid_code_rule(pid) or "")
     if not rule:
-        return True, ""
-    bad = []
-    for c in codes:
-        cc = (c or "").strip().replace(" ", "")
-        if rule == "FF16":
-            if not FF_CODE_RE.match(cc):
-                bad.append(cc)
-        elif rule == "PUBG18":
-            if not PUBG_CODE_RE.match(cc):
-                bad.append(cc)
-    if not bad:
-        return True, ""
-    # determine if too short/long for first bad
-    sample = bad[0]
-    if rule == "FF16":
-        msg = f"❌ Free Fire code must be 16 digits فقط.\nمثال: 1234567890123456\nBad sample: {sample}"
-    else:
-        msg = f"❌ PUBG code must be 18 characters (A-Z a-z 0-9).\nBad sample: {sample}"
-    return False, msg
+        return []
+    fullmatch = rule[0].fullmatch
+    return [(n, cc) for n, cc in lines if not fullmatch(cc)]
+def bad_codes_message(pid: int, bad: List[Tuple[int, str]], total: int) -> str:
+    _, message = _code_rules[_pid_code_rule(pid)]
+    out = [f"❌ {message}", f"Invalid lines: {len(bad)} of {total}", ""]
+    out.extend(f"line {n}: {cc}" for n, cc in bad)
+    return "\n".join(out)
+# =========================
+# Code import
+# =========================
+# Supplier files can hold 100k+ codes: they are downloaded to disk and streamed
+# CODE_IMPORT_CHUNK lines at a time, once to validate (before taking the write
+# lock) and once to insert, each chunk committing on its own. A chunk's
+# fingerprints are looked up in one query, so codes repeated in the input and
+# codes already in stock are counted exactly without a query per row.
+# Every code also carries a 64-bit fingerprint with a global unique index, so a
+# voucher already stocked (or sold) under another product is rejected and
+# logged to code_collisions instead of being sold twice. Deleting a product
+# moves the fingerprints of its sold codes to code_fingerprints, which the
+# same lookup consults.
+CODE_IMPORT_CHUNK = 5000
+CODE_HASH_LOOKUP = 900
+def code_fingerprint(code: str) -> int:
+    # blake2b truncated to a signed 64-bit SQLite INTEGER
+    return int.from_bytes(hashlib.blake2b(code.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+def _codes_by_hash(c, hashes: List[int]) -> Dict[int, Tuple[int, Optional[int], str]]:
+    # code_hash -> (pid, code_id, code_text) for the hashes already stored;
+    # code_id is None for a sold code whose product was deleted
+    found: Dict[int, Tuple[int, Optional[int], str]] = {}
+    for i in range(0, len(hashes), CODE_HASH_LOOKUP):
+        part = hashes[i:i + CODE_HASH_LOOKUP]
+        marks = ",".join("?" * len(part))
+        c.execute(
+            f"""
+            SELECT code_hash, pid, code_id, code_text FROM codes WHERE code_hash IN ({marks})
+            UNION ALL
+            SELECT code_hash, pid, NULL, code_text FROM code_fingerprints WHERE code_hash IN ({marks})
+            """,
+            part + part,
+        )
+        for h, p, cid, t in c.fetchall():
+            found.setdefault(h, (p, cid, t))
+    return found
+def record_code_collision(c, code_hash: int, code_text: str, pid: int, existing: Optional[Tuple[int, Optional[int], str]], source: str):
+    c.execute(
+        "INSERT INTO code_collisions(code_hash, code_text, pid, existing_pid, existing_code_id, source) VALUES(?,?,?,?,?,?)",
+        (code_hash, code_text, pid, existing[0] if existing else None, existing[1] if existing else None, source),
+    )
+def _code_file_chunks(path: str, size: int = CODE_IMPORT_CHUNK) -> Iterator[List[Tuple[int, str]]]:
+    # (line_no, normalised code) pairs; blank lines are skipped but still counted
+    chunk: List[Tuple[int, str]] = []
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for n, line in enumerate(f, 1):
+            cc = line.strip().replace(" ", "")
+            if cc:
+                chunk.append((n, cc))
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+_import_seq = itertools.count(1)
+def _hashes_in(c, table: str, hashes: List[int]) -> Set[int]:
+    found: Set[int] = set()
+    for i in range(0, len(hashes), CODE_HASH_LOOKUP):
+        part = hashes[i:i + CODE_HASH_LOOKUP]
+        c.execute(f"SELECT code_hash FROM {table} WHERE code_hash IN ({','.join('?' * len(part))})", part)
+        found.update(h for (h,) in c.fetchall())
+    return found
+def insert_codes(pid: int, chunks: Iterable[List[Tuple[int, str]]]) -> Tuple[List[Tuple[int, int, int, int]], str]:
+    # each chunk commits on its own so the writer lock is released between batches.
+    # Fingerprints already read from this input go to a temp table on the writer connection,
+    # so repeats across chunks are told apart from codes already in stock without holding the
+    # whole file in memory. Returns (per-batch (added, repeated in the input, already in this
+    # product, collisions with other products), error); on a DB error the batches committed so
+    # far are kept and the error says how many codes landed.
+    batches: List[Tuple[int, int, int, int]] = []
+    seen = f"temp.import_seen_{next(_import_seq)}"
+    try:
+        for chunk in chunks:
+            repeated = in_stock = collided = 0
+            with db_write() as c:
+                c.execute(f"CREATE TABLE IF NOT EXISTS {seen}(code_hash INTEGER PRIMARY KEY)")
+                rows = [(pid, cc, code_fingerprint(cc)) for _, cc in chunk]
+                hashes = list({h for _, _, h in rows})
+                earlier = _hashes_in(c, seen, hashes)
+                existing = _codes_by_hash(c, [h for h in hashes if h not in earlier])
+                keep = []
+                fresh: Set[int] = set()
+                for row in rows:
+                    if row[2] in earlier or row[2] in fresh:
+                        repeated += 1
+                        continue
+                    fresh.add(row[2])
+                    hit = existing.get(row[2])
+                    if not hit:
+                        keep.append(row)
+                    elif hit[0] == pid and hit[2] == row[1]:
+                        in_stock += 1
+                    else:
+                        record_code_collision(c, row[2], row[1], pid, hit, "import")
+                        collided += 1
+                c.executemany(f"INSERT INTO {seen}(code_hash) VALUES(?)", [(h,) for h in fresh])
+                c.executemany("INSERT OR IGNORE INTO codes(pid,code_text,code_hash,used) VALUES(?,?,?,0)", keep)
+                added = c.rowcount
+            batches.append((added, repeated, in_stock + len(keep) - added, collided))
+    except (sqlite3.Error, OSError) as e:
+        logger.exception("Code import into PID %s stopped after %s batches", pid, len(batches))
+        added = sum(b[0] for b in batches)
+        return batches, (
+            f"❌ Import stopped: {e}\n"
+            f"✅ {added} codes were already added to PID {pid} before the error ({len(batches)} batches).\n"
+            "Send the same codes again to finish: the ones already added are skipped."
+        )
+    finally:
+        try:
+            with db_write(durable=False) as c:
+                c.execute(f"DROP TABLE IF EXISTS {seen}")
+        except sqlite3.Error:
+            logger.exception("Could not drop %s", seen)
+    return batches, ""
+def _import_totals(batches: List[Tuple[int, int, int, int]]) -> Tuple[int, int, int, int]:
+    return tuple(map(sum, zip(*batches))) if batches else (0, 0, 0, 0)
+def delete_products(pids: List[int], cid: Optional[int] = None) -> int:
+    # delete products with their codes (and the category, if given); returns codes deleted.
+    # Sold codes leave their fingerprint in code_fingerprints so they can't be imported again.
+    deleted = 0
+    with db_write() as c:
+        for pid in pids:
+            c.execute("SELECT code_hash, code_text, order_id FROM codes WHERE pid=? AND used=1", (pid,))
+            c.executemany(
+                "INSERT OR IGNORE INTO code_fingerprints(code_hash, pid, code_text, order_id) VALUES(?,?,?,?)",
+                [(h if h is not None else code_fingerprint(t), pid, t, oid) for h, t, oid in c.fetchall()],
+            )
+            c.execute("DELETE FROM codes WHERE pid=?", (pid,))
+            deleted += c.rowcount
+            c.execute("DELETE FROM products WHERE pid=?", (pid,))
+        if cid is not None:
+            c.execute("DELETE FROM categories WHERE cid=?", (cid,))
+    return deleted
+def _product_exists(pid: int) -> bool:
+    with db_read() as c:
+        c.execute("SELECT 1 FROM products WHERE pid=?", (pid,))
+        return c.fetchone() is not None
+def import_codes_text(pid: int, lines: List[Tuple[int, str]]) -> Tuple[int, int, int, int, str]:
+    # pasted (line_no, code) pairs; same contract as import_codes_file
+    if not _product_exists(pid):
+        return 0, 0, 0, 0, "❌ Product not found."
+    bad = bad_code_lines(pid, lines)
+    if bad:
+        return 0, 0, 0, 0, bad_codes_message(pid, bad, len(lines))
+    chunks = [lines[i:i + CODE_IMPORT_CHUNK] for i in range(0, len(lines), CODE_IMPORT_CHUNK)]
+    batches, err = insert_codes(pid, chunks)
+    return (*_import_totals(batches), err)
+def import_codes_file(pid: int, path: str) -> Tuple[int, int, int, int, str]:
+    # returns (added, repeated, already in stock, collisions, error message). A bad line means
+    # nothing is inserted; a DB error midway keeps the committed batches and the message says so.
+    if not _product_exists(pid):
+        return 0, 0, 0, 0, "❌ Product not found."
+    total = 0
+    bad: List[Tuple[int, str]] = []
+    for chunk in _code_file_chunks(path):
+        bad.extend(bad_code_lines(pid, chunk))
+        total += len(chunk)
+    if not total:
+        return 0, 0, 0, 0, "❌ File has no codes."
+    if bad:
+        return 0, 0, 0, 0, bad_codes_message(pid, bad, total)
+    batches, err = insert_codes(pid, _code_file_chunks(path))
+    return (*_import_totals(batches), err)
+async def reply_long_text(update: Update, text: str, filename: str):
+    # a report too long for one message is cut and attached in full as a .txt
+    if len(text) <= TELEGRAM_TEXT_LIMIT:
+        return await update.message.reply_text(text)
+    await update.message.reply_text(text[:TELEGRAM_TEXT_LIMIT].rsplit("\n", 1)[0] + "\n…\n📎 Full list attached.")
+    bio = io.BytesIO(text.encode("utf-8"))
+    bio.name = filename
+    await update.message.reply_document(document=bio)
 def _resolve_audit_date(raw: Optional[str] = None) -> str:
     if not raw or raw == "today":
         return datetime.utcnow().strftime("%Y-%m-%d")
@@ -2188,71 +3552,42 @@ def _resolve_audit_date(raw: Optional[str] = None) -> str:
     return raw
 def _daily_audit_report(target_date: str) -> Tuple[str, List[Tuple[int, str, str]]]:
     target_date = _resolve_audit_date(target_date)
-    day_start_s = f"{target_date} 00:00:00"
-    day_end_s = f"{target_date} 23:59:59"
-    users = set()
-    for sql in [
-        "SELECT DISTINCT user_id FROM balance_ledger WHERE datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-        "SELECT DISTINCT user_id FROM orders WHERE status='COMPLETED' AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-        "SELECT DISTINCT user_id FROM manual_orders WHERE datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-        "SELECT DISTINCT user_id FROM deposits WHERE status='APPROVED' AND datetime(COALESCE(approved_at, created_at)) >= datetime(?) AND datetime(COALESCE(approved_at, created_at)) <= datetime(?)",
-    ]:
-        cur.execute(sql, (day_start_s, day_end_s))
-        users.update(int(r[0]) for r in cur.fetchall())
-    if not users:
+    with db_read() as c:
+        c.execute(
+            """
+            WITH day_users AS (
+              SELECT user_id FROM ledger_daily WHERE day=?
+              UNION
+              SELECT user_id FROM activity_daily WHERE day=?
+            )
+            SELECT d.user_id, l.opening,
+                   COALESCE(l.net,0), COALESCE(l.total_in,0), COALESCE(l.total_out,0), COALESCE(l.tx_count,0),
+                   COALESCE(l.order_out,0), COALESCE(l.manual_out,0), COALESCE(l.deposit_in,0),
+                   COALESCE(a.orders_total,0), COALESCE(a.manual_total,0), COALESCE(a.deposits_total,0),
+                   COALESCE(u.balance,0)
+            FROM day_users d
+            LEFT JOIN ledger_daily l ON l.day=? AND l.user_id=d.user_id
+            LEFT JOIN activity_daily a ON a.day=? AND a.user_id=d.user_id
+            LEFT JOIN users u ON u.user_id=d.user_id
+            ORDER BY d.user_id
+            """,
+            (target_date, target_date, target_date, target_date),
+        )
+        day_rows = c.fetchall()
+    if not day_rows:
         return (f"🧮 *Daily Audit* — `{target_date}`\n\nNo accounting activity found.", [])
     mismatches = 0
     alerts: List[Tuple[int, str, str]] = []
     lines = [f"🧮 *Daily Audit* — `{target_date}`", ""]
-    for uid in sorted(users):
-        cur.execute(
-            "SELECT balance_before FROM balance_ledger WHERE user_id=? AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?) ORDER BY id ASC LIMIT 1",
-            (uid, day_start_s, day_end_s),
-        )
-        row_first = cur.fetchone()
-        cur.execute(
-            "SELECT COALESCE(SUM(delta),0), COALESCE(SUM(CASE WHEN delta>0 THEN delta ELSE 0 END),0), COALESCE(SUM(CASE WHEN delta<0 THEN -delta ELSE 0 END),0), COUNT(*) FROM balance_ledger WHERE user_id=? AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-            (uid, day_start_s, day_end_s),
-        )
-        net_delta, total_in, total_out, tx_count = cur.fetchone()
-        net_delta = float(net_delta or 0)
-        total_in = float(total_in or 0)
-        total_out = float(total_out or 0)
-        tx_count = int(tx_count or 0)
-        actual = get_balance(uid)
-        opening = float(row_first[0]) if row_first else float(actual - net_delta)
+    for row in day_rows:
+        uid = int(row[0])
+        net_delta, total_in, total_out, tx_count = float(row[2]), float(row[3]), float(row[4]), int(row[5])
+        order_ledger_total, manual_ledger_total, dep_ledger_total = float(row[6]), float(row[7]), float(row[8])
+        orders_total, manual_total, dep_total = float(row[9]), float(row[10]), float(row[11])
+        actual = float(row[12])
+        opening = float(row[1]) if row[1] is not None else float(actual - net_delta)
         expected = opening + net_delta
         diff = actual - expected
-        cur.execute(
-            "SELECT COALESCE(SUM(total),0) FROM orders WHERE user_id=? AND status='COMPLETED' AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-            (uid, day_start_s, day_end_s),
-        )
-        orders_total = float(cur.fetchone()[0] or 0)
-        cur.execute(
-            "SELECT COALESCE(SUM(price),0) FROM manual_orders WHERE user_id=? AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?) AND status != 'REJECTED'",
-            (uid, day_start_s, day_end_s),
-        )
-        manual_total = float(cur.fetchone()[0] or 0)
-        cur.execute(
-            "SELECT COALESCE(SUM(amount),0) FROM deposits WHERE user_id=? AND status='APPROVED' AND datetime(COALESCE(approved_at, created_at)) >= datetime(?) AND datetime(COALESCE(approved_at, created_at)) <= datetime(?)",
-            (uid, day_start_s, day_end_s),
-        )
-        dep_total = float(cur.fetchone()[0] or 0)
-        cur.execute(
-            "SELECT COALESCE(SUM(-delta),0) FROM balance_ledger WHERE user_id=? AND source_type='ORDER_PURCHASE' AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-            (uid, day_start_s, day_end_s),
-        )
-        order_ledger_total = float(cur.fetchone()[0] or 0)
-        cur.execute(
-            "SELECT COALESCE(SUM(-delta),0) FROM balance_ledger WHERE user_id=? AND source_type IN ('MANUAL_SHAHID_CHARGE','MANUAL_FF_CHARGE') AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-            (uid, day_start_s, day_end_s),
-        )
-        manual_ledger_total = float(cur.fetchone()[0] or 0)
-        cur.execute(
-            "SELECT COALESCE(SUM(delta),0) FROM balance_ledger WHERE user_id=? AND source_type='DEPOSIT_APPROVED' AND datetime(created_at) >= datetime(?) AND datetime(created_at) <= datetime(?)",
-            (uid, day_start_s, day_end_s),
-        )
-        dep_ledger_total = float(cur.fetchone()[0] or 0)
         orders_gap = orders_total - order_ledger_total
         manual_gap = manual_total - manual_ledger_total
         deposits_gap = dep_total - dep_ledger_total
@@ -2282,7 +3617,7 @@ def _daily_audit_report(target_date: str) -> Tuple[str, List[Tuple[int, str, str
         lines.append("✅ لا يوجد فرق محاسبي في هذا اليوم.")
     return ("\n".join(lines)[:3900], alerts)
 async def _daily_audit_report_with_alerts(context: ContextTypes.DEFAULT_TYPE, target_date: str) -> str:
-    text, alerts = _daily_audit_report(target_date)
+    text, alerts = await run_db(_daily_audit_report, target_date)
     audit_date = _resolve_audit_date(target_date)
     for uid, issue_key, message_text in alerts:
         await send_audit_alert(context, audit_date, uid, issue_key, message_text)
@@ -2306,63 +3641,64 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "goto:balance" or data == "goto:topup":
         return await show_balance(update, context)
     if data == "pos:panel":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        return await q.edit_message_text(pos_panel_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(pos_panel_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:clients":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        return await q.edit_message_text(pos_clients_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(pos_clients_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:profit":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        amount = reseller_profit_balance(update.effective_user.id)
+        amount = await run_db(reseller_profit_balance, update.effective_user.id)
         text_profit = (
             "💰 *POS Profit*\n\n"
             f"Pending Profit: *{amount:.3f}{CURRENCY}*\n\n"
             "اضغط الزر لتحويل الربح المتجمع إلى رصيدك."
         )
-        return await q.edit_message_text(text_profit, parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(text_profit, parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:profit:transfer":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        amount = transfer_reseller_profit_to_balance(update.effective_user.id)
+        amount = await run_db(transfer_reseller_profit_to_balance, update.effective_user.id)
         if amount <= 0:
             await q.answer("No profit yet", show_alert=True)
-            return await q.edit_message_text(pos_panel_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+            return await q.edit_message_text(await run_db(pos_panel_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
         await q.answer("Profit transferred ✅", show_alert=False)
+        bal = await run_db(get_balance, update.effective_user.id)
         return await q.edit_message_text(
-            f"✅ تم تحويل أرباح نقطة البيع إلى الرصيد.\n\nAmount: *{amount:.3f}{CURRENCY}*\nBalance now: *{get_balance(update.effective_user.id):.3f}{CURRENCY}*",
+            f"✅ تم تحويل أرباح نقطة البيع إلى الرصيد.\n\nAmount: *{amount:.3f}{CURRENCY}*\nBalance now: *{bal:.3f}{CURRENCY}*",
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb_pos_panel(update.effective_user.id),
+            reply_markup=await run_db(kb_pos_panel, update.effective_user.id),
         )
     if data == "pos:addclient":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
         context.user_data[UD_ADMIN_MODE] = "pos_add_client"
         await q.edit_message_text("➕ Send client user_id to attach under your POS.\n\n/cancel to stop")
         return ST_ADMIN_INPUT
     if data == "pos:removeclient":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
         context.user_data[UD_ADMIN_MODE] = "pos_remove_client"
         await q.edit_message_text("➖ Send client user_id to remove from your POS.\n\n/cancel to stop")
         return ST_ADMIN_INPUT
     if data == "pos:setprice":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
         context.user_data[UD_ADMIN_MODE] = "pos_set_price"
         await q.edit_message_text(
             (
                 "🎯 *Set POS Auto Price*\n\nلنفسك داخل البوت:\n`pid | price`\nمثال:\n`12 | 10`\nحذف سعر نفسك:\n`del | pid`\n\nولعميل تابع لك:\n`client_user_id | pid | price`\nمثال:\n`1997968014 | 12 | 10`\nحذف سعر عميل:\n`del | client_user_id | pid`\n\n⚠️ لا يمكن أقل من السعر الأساسي.\n\n"
-                + pos_all_products_text(update.effective_user.id)
+                + await run_db(pos_all_products_text, update.effective_user.id)
                 + "\n\n/cancel to stop"
             )[:3900],
             parse_mode=ParseMode.MARKDOWN,
         )
         return ST_ADMIN_INPUT
     if data == "pos:charge":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
         context.user_data[UD_ADMIN_MODE] = "pos_charge_client"
         await q.edit_message_text(
@@ -2371,7 +3707,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ST_ADMIN_INPUT
     if data == "pos:setmanual":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
         context.user_data[UD_ADMIN_MODE] = "pos_set_manual_price"
         await q.edit_message_text(
@@ -2383,30 +3719,30 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "`1997968014 | FF_100 | 0.95`\n\n"
                 "Delete custom manual price:\n"
                 "`del | client_user_id | KEY`\n\n"
-                + pos_all_manual_keys_text(update.effective_user.id)
+                + await run_db(pos_all_manual_keys_text, update.effective_user.id)
                 + "\n\n/cancel to stop"
             )[:3900],
             parse_mode=ParseMode.MARKDOWN,
         )
         return ST_ADMIN_INPUT
     if data == "pos:prices:auto":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        return await q.edit_message_text(pos_product_prices_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(pos_product_prices_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:prices:manual":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        return await q.edit_message_text(pos_manual_prices_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(pos_manual_prices_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:catalog:auto":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        return await q.edit_message_text(pos_all_products_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(pos_all_products_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:catalog:manual":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
-        return await q.edit_message_text(pos_all_manual_keys_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_pos_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(pos_all_manual_keys_text, update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_pos_panel, update.effective_user.id))
     if data == "pos:notify":
-        if not is_reseller(update.effective_user.id):
+        if not await run_db(is_reseller, update.effective_user.id):
             return await q.edit_message_text("❌ POS only.")
         context.user_data[UD_ADMIN_MODE] = "pos_broadcast_clients"
         await q.edit_message_text(
@@ -2432,7 +3768,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "➡️ Password مؤقت\n\n"
             + manual_hours_text()
         )
-        return await q.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb_shahid_plans(update.effective_user.id))
+        return await q.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_shahid_plans, update.effective_user.id))
     if data.startswith("manual:shahid:"):
         if not manual_flag_enabled("MANUAL_SHAHID_ENABLED"):
             return await q.edit_message_text("⛔ خدمة Shahid معطلة حالياً.", reply_markup=kb_manual_services())
@@ -2441,18 +3777,18 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         plan = data.split(":")[2]
         if plan == "MENA_3M":
             if not manual_flag_enabled("SHAHID_MENA_3M_ENABLED"):
-                return await q.edit_message_text("⛔ باقة Shahid 3M معطلة حالياً.", reply_markup=kb_shahid_plans(update.effective_user.id))
+                return await q.edit_message_text("⛔ باقة Shahid 3M معطلة حالياً.", reply_markup=await run_db(kb_shahid_plans, update.effective_user.id))
             plan_title = "Shahid [MENA] | 3 Month"
-            price = get_user_manual_price(update.effective_user.id, "SHAHID_MENA_3M", get_manual_price("SHAHID_MENA_3M", MANUAL_PRICE_DEFAULTS["SHAHID_MENA_3M"]))
+            price = await run_db(get_user_manual_price, update.effective_user.id, "SHAHID_MENA_3M", get_manual_price("SHAHID_MENA_3M", MANUAL_PRICE_DEFAULTS["SHAHID_MENA_3M"]))
         elif plan == "MENA_12M":
             if not manual_flag_enabled("SHAHID_MENA_12M_ENABLED"):
-                return await q.edit_message_text("⛔ باقة Shahid 12M معطلة حالياً.", reply_markup=kb_shahid_plans(update.effective_user.id))
+                return await q.edit_message_text("⛔ باقة Shahid 12M معطلة حالياً.", reply_markup=await run_db(kb_shahid_plans, update.effective_user.id))
             plan_title = "Shahid [MENA] | 12 Month"
-            price = get_user_manual_price(update.effective_user.id, "SHAHID_MENA_12M", get_manual_price("SHAHID_MENA_12M", MANUAL_PRICE_DEFAULTS["SHAHID_MENA_12M"]))
+            price = await run_db(get_user_manual_price, update.effective_user.id, "SHAHID_MENA_12M", get_manual_price("SHAHID_MENA_12M", MANUAL_PRICE_DEFAULTS["SHAHID_MENA_12M"]))
         else:
             return await q.edit_message_text("❌ Unknown plan.")
         uid = update.effective_user.id
-        bal = get_balance(uid)
+        bal = await run_db(get_balance, uid)
         if bal + 1e-9 < price:
             missing = price - bal
             return await q.edit_message_text(
@@ -2473,36 +3809,36 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await q.edit_message_text("⛔ خدمة Free Fire معطلة حالياً.", reply_markup=kb_manual_services())
         if not manual_open_now() and not is_admin_any(update.effective_user.id):
             return await q.edit_message_text("⛔ الشحن اليدوي مغلق الآن.\n\n" + manual_hours_text(), parse_mode=ParseMode.MARKDOWN)
-        return await q.edit_message_text(ff_menu_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_ff_menu(context, update.effective_user.id))
+        return await q.edit_message_text(ff_menu_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_ff_menu, context, update.effective_user.id))
     if data.startswith("manual:ff:add:"):
         sku = data.split(":")[3]
         if not _ff_pack(sku):
-            return await q.edit_message_text("❌ Unknown pack.", reply_markup=kb_ff_menu(context))
+            return await q.edit_message_text("❌ Unknown pack.", reply_markup=await run_db(kb_ff_menu, context))
         cart = _ff_cart_get(context)
         cart[sku] = int(cart.get(sku, 0)) + 1
         context.user_data[UD_FF_CART] = cart
-        return await q.edit_message_text(ff_menu_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_ff_menu(context, update.effective_user.id))
+        return await q.edit_message_text(ff_menu_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_ff_menu, context, update.effective_user.id))
     if data == "manual:ff:clear":
         context.user_data[UD_FF_CART] = {}
         context.user_data.pop(UD_FF_TOTAL, None)
         context.user_data.pop("ff_total_diamonds", None)
-        return await q.edit_message_text(ff_menu_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_ff_menu(context, update.effective_user.id))
+        return await q.edit_message_text(ff_menu_text(update.effective_user.id), parse_mode=ParseMode.MARKDOWN, reply_markup=await run_db(kb_ff_menu, context, update.effective_user.id))
     if data == "manual:ff:checkout":
         if not manual_open_now() and not is_admin_any(update.effective_user.id):
             return await q.edit_message_text("⛔ الشحن اليدوي مغلق الآن.\n\n" + manual_hours_text(), parse_mode=ParseMode.MARKDOWN)
         cart = _ff_cart_get(context)
-        total_price, _, lines = _ff_calc_totals(cart)
+        total_price, _, lines = await run_db(_ff_calc_totals, cart)
         if not lines:
-            return await q.edit_message_text("🛒 Your Cart is empty.\nAdd items first.", reply_markup=kb_ff_menu(context))
+            return await q.edit_message_text("🛒 Your Cart is empty.\nAdd items first.", reply_markup=await run_db(kb_ff_menu, context))
         uid = update.effective_user.id
-        bal = get_balance(uid)
+        bal = await run_db(get_balance, uid)
         if bal + 1e-9 < total_price:
             missing = total_price - bal
             return await q.edit_message_text(
                 f"❌ Insufficient balance.\n\nYour balance: {bal:.3f} {CURRENCY}\nRequired: {total_price:.3f} {CURRENCY}\nMissing: {missing:.3f} {CURRENCY}\n\nClick below to top up 👇",
                 reply_markup=kb_topup_now(),
             )
-        await q.edit_message_text(ff_checkout_text(context, update.effective_user.id), parse_mode=ParseMode.MARKDOWN)
+        await q.edit_message_text(await run_db(ff_checkout_text, context, update.effective_user.id), parse_mode=ParseMode.MARKDOWN)
         return ST_FF_PLAYERID
     # =========================
     # Admin panel
@@ -2514,12 +3850,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin:dash":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        return await q.edit_message_text(_dashboard_text(), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_admin_panel(update.effective_user.id))
+        return await q.edit_message_text(await run_db(_dashboard_text), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_admin_panel(update.effective_user.id))
     if data == "admin:admins":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        cur.execute("SELECT user_id, role FROM admins ORDER BY role DESC, user_id ASC")
-        rows = cur.fetchall()
+        rows = await run_db(db_fetchall, "SELECT user_id, role FROM admins ORDER BY role DESC, user_id ASC")
         lines = ["👑 *Admins*\n", "Send:\n`addadmin | user_id`\n`deladmin | user_id`\n"]
         for uid, role in rows:
             lines.append(f"• `{uid}` — *{role}*")
@@ -2538,11 +3873,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin:resellers":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        return await q.edit_message_text(reseller_admin_text(), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_reseller_admin_panel())
+        return await q.edit_message_text(await run_db(reseller_admin_text), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_reseller_admin_panel())
     if data == "admin:resellers:list":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        return await q.edit_message_text(reseller_admin_text(), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_reseller_admin_panel())
+        return await q.edit_message_text(await run_db(reseller_admin_text), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_reseller_admin_panel())
     if data == "admin:resellers:add":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
@@ -2571,16 +3906,13 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin:userpricelist":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        cur.execute(
-            """
+        rows = await run_db(db_fetchall, """
             SELECT upp.user_id, upp.pid, upp.price, p.title
             FROM user_product_prices upp
             LEFT JOIN products p ON p.pid=upp.pid
             ORDER BY upp.user_id ASC, upp.pid ASC
             LIMIT 100
-            """
-        )
-        rows = cur.fetchall()
+            """)
         if not rows:
             return await q.edit_message_text("📌 No custom user prices found.", reply_markup=kb_admin_products_panel())
         lines = ["📌 *User Custom Prices*", ""]
@@ -2612,15 +3944,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin:usermanualpricelist":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        cur.execute(
-            """
+        rows = await run_db(db_fetchall, """
             SELECT ump.user_id, ump.pkey, ump.price
             FROM user_manual_prices ump
             ORDER BY ump.user_id ASC, ump.pkey ASC
             LIMIT 200
-            """
-        )
-        rows = cur.fetchall()
+            """)
         if not rows:
             return await q.edit_message_text("📌 No custom manual prices found.", reply_markup=kb_manual_prices_panel())
         lines = ["📌 *User Manual Prices*", ""]
@@ -2642,7 +3971,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
         key = data.split(":", 2)[2]
-        set_manual_flag(key, not manual_flag_enabled(key))
+        await run_db(set_manual_flag, key, not manual_flag_enabled(key))
         return await q.edit_message_text(manual_prices_text(), parse_mode=ParseMode.MARKDOWN, reply_markup=kb_manual_prices_panel())
     if data.startswith("admin:dailyauditday:"):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
@@ -2660,8 +3989,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin:manualprices_legacy_unused":
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        cur.execute("SELECT pkey, price FROM manual_prices ORDER BY pkey")
-        rows = cur.fetchall()
+        rows = await run_db(db_fetchall, "SELECT pkey, price FROM manual_prices ORDER BY pkey")
         lines = ["🛠 *Manual Prices*\nSend: `key | price`\nExample: `FF_100 | 0.95`\n"]
         for k, p in rows:
             lines.append(f"• `{k}` = *{float(p):.3f}{CURRENCY}*")
@@ -2673,17 +4001,19 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("admin:users:"):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
-        page = int(data.split(":")[2])
-        rows, total_pages = _users_page(page=page, page_size=10)
+        parts = data.split(":")
+        page = int(parts[2])
+        sort = parts[3] if len(parts) > 3 and parts[3] in USERS_SORTS else "id"
+        cursor = parts[4] if len(parts) > 4 else ""
+        rows, page, total_pages, has_next = await run_db(_users_page, page=page, page_size=10, sort=sort, cursor=cursor)
         text = "👥 *Customers*\nTap a user to view details:"
-        return await q.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb_admin_users_page(page, total_pages, rows))
+        return await q.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb_admin_users_page(page, total_pages, rows, sort, has_next))
     if data.startswith("admin:user:view:"):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
         uid = int(data.split(":")[3])
-        rep = _user_report_text(uid, limit_each=7)[:3800]
-        cur.execute("SELECT suspended FROM users WHERE user_id=?", (uid,))
-        s = int((cur.fetchone() or (0,))[0] or 0)
+        rep = (await run_db(_user_report_text, uid, limit_each=7))[:3800]
+        s = int((await run_db(db_fetchone, "SELECT suspended FROM users WHERE user_id=?", (uid,)) or (0,))[0] or 0)
         return await q.edit_message_text(rep, reply_markup=kb_admin_user_view(uid, s))
     if data.startswith("admin:user:suspend:"):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
@@ -2691,27 +4021,21 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = int(data.split(":")[3])
         if is_admin_any(uid) or uid == ADMIN_ID:
             return await q.edit_message_text("❌ لا يمكن تعليق الأدمن.")
-        set_suspended(uid, True)
-        try:
-            await context.bot.send_message(uid, "⛔ تم تعليق حسابك. تواصل مع الدعم.")
-        except Exception:
-            pass
+        await run_db(set_suspended, uid, True)
+        enqueue_message(uid, "⛔ تم تعليق حسابك. تواصل مع الدعم.", PRIO_CUSTOMER)
         return await q.edit_message_text(f"✅ User {uid} suspended.", reply_markup=kb_admin_panel(update.effective_user.id))
     if data.startswith("admin:user:unsuspend:"):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
         uid = int(data.split(":")[3])
-        set_suspended(uid, False)
-        try:
-            await context.bot.send_message(uid, "✅ تم فك تعليق حسابك. يمكنك استخدام البوت الآن.")
-        except Exception:
-            pass
+        await run_db(set_suspended, uid, False)
+        enqueue_message(uid, "✅ تم فك تعليق حسابك. يمكنك استخدام البوت الآن.", PRIO_CUSTOMER)
         return await q.edit_message_text(f"✅ User {uid} unsuspended.", reply_markup=kb_admin_panel(update.effective_user.id))
     if data.startswith("admin:user:export:"):
         if admin_role(update.effective_user.id) != ROLE_OWNER:
             return await q.edit_message_text("❌ Not allowed.")
         uid = int(data.split(":")[3])
-        rep = _user_report_text(uid, limit_each=30)
+        rep = await run_db(_user_report_text, uid, limit_each=30)
         bio = io.BytesIO(rep.encode("utf-8"))
         bio.name = f"user_{uid}_report.txt"
         try:
@@ -2724,24 +4048,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("admin:manuallist:"):
         if not is_manual_admin(update.effective_user.id):
             return await q.edit_message_text("❌ Not allowed.")
-        page = int(data.split(":")[2])
-        page_size = 8
-        cur.execute("SELECT COUNT(*) FROM manual_orders WHERE status='PENDING'")
-        total = int(cur.fetchone()[0])
-        total_pages = max(1, (total + page_size - 1) // page_size)
-        page = max(0, min(page, total_pages - 1))
-        off = page * page_size
-        cur.execute(
-            """
-            SELECT id, user_id, service, plan_title, price, created_at
-            FROM manual_orders
-            WHERE status='PENDING'
-            ORDER BY id DESC
-            LIMIT ? OFFSET ?
-            """,
-            (page_size, off),
-        )
-        rows = cur.fetchall()
+        parts = data.split(":")
+        page = int(parts[2])
+        cursor = parts[3] if len(parts) > 3 else ""
+        rows, page, total_pages, has_next = await run_db(_pending_manual_page, page, 8, cursor)
+        if not rows and cursor:
+            rows, page, total_pages, has_next = await run_db(_pending_manual_page, 0, 8, "")
         if not rows:
             return await q.edit_message_text("📥 No pending manual orders.", reply_markup=kb_admin_panel(update.effective_user.id))
         buttons = []
@@ -2750,10 +4062,10 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             buttons.append([InlineKeyboardButton(label[:60], callback_data=f"admin:manual:view:{mid}")])
         nav = []
         if page > 0:
-            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:manuallist:{page-1}"))
+            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:manuallist:{page-1}:b{rows[0][0]}"))
         nav.append(InlineKeyboardButton(f"Page {page+1}/{total_pages}", callback_data="noop"))
-        if page < total_pages - 1:
-            nav.append(InlineKeyboardButton("➡️ Next", callback_data=f"admin:manuallist:{page+1}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("➡️ Next", callback_data=f"admin:manuallist:{page+1}:a{rows[-1][0]}"))
         buttons.append(nav)
         buttons.append([InlineKeyboardButton("👑 Admin Home", callback_data="admin:panel")])
         return await q.edit_message_text("📥 *Pending Manual Orders:*", parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(buttons))
@@ -2761,14 +4073,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_manual_admin(update.effective_user.id):
             return await q.edit_message_text("❌ Not allowed.")
         mid = int(data.split(":")[3])
-        cur.execute(
-            """
+        row = await run_db(db_fetchone, """
             SELECT id, user_id, service, plan_title, price, email, password, player_id, note, status, created_at
             FROM manual_orders WHERE id=?
             """,
-            (mid,),
-        )
-        row = cur.fetchone()
+            (mid,))
         if not row:
             return await q.edit_message_text("❌ Manual order not found.")
         (_mid, uid, service, plan_title, price, email, password, player_id, note, status, created_at) = row
@@ -2805,8 +4114,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await q.edit_message_text("❌ Not allowed.")
         _, _, kind, mid_s = data.split(":")
         mid = int(mid_s)
-        cur.execute("SELECT user_id, email, password, player_id FROM manual_orders WHERE id=?", (mid,))
-        row = cur.fetchone()
+        row = await run_db(db_fetchone, "SELECT user_id, email, password, player_id FROM manual_orders WHERE id=?", (mid,))
         if not row:
             await q.answer("Not found", show_alert=True)
             return
@@ -2839,34 +4147,26 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_manual_admin(update.effective_user.id):
             return await q.edit_message_text("❌ Not allowed.")
         mid = int(data.split(":")[3])
-        cur.execute("SELECT user_id, price, status, service, plan_title, note FROM manual_orders WHERE id=?", (mid,))
-        row = cur.fetchone()
-        if not row:
+        approver_id = update.effective_user.id
+        status, order = await run_db(approve_manual_order, mid, approver_id)
+        if status == "NOT_FOUND":
             return await q.edit_message_text("❌ Manual order not found.")
-        uid, price, status, service, plan_title, manual_note = int(row[0]), float(row[1]), row[2], row[3], row[4], (row[5] or "")
-        if status != "PENDING":
+        if status != "OK":
             return await q.edit_message_text("❌ This manual order is not pending.")
-        approver_id = update.effective_user.id
-        delivered_note = f"APPROVED_BY:{approver_id}"
-        cur.execute("UPDATE manual_orders SET status='COMPLETED', approved_by=?, delivered_text=? WHERE id=?", (approver_id, delivered_note, mid))
-        con.commit()
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text=(
-                    "✅ *تم شحن بنجاح!*\n"
-                    f"🧾 Manual Order: *#{mid}*\n"
-                    f"📦 Service: {plan_title}\n"
-                    f"💵 Paid: *{price:.3f} {CURRENCY}*\n"
-                    f"🆔 Admin Approver ID: `{approver_id}`\n\n"
-                    "شكراً لك ❤️"
-                ),
-                parse_mode=ParseMode.MARKDOWN,
-            )
-        except Exception as e:
-            logger.exception("Failed to notify user %s about manual approve %s: %s", uid, mid, e)
-        reseller_id = get_effective_reseller_id(uid)
-        manual_margin, manual_margin_details = calculate_pos_manual_profit(
+        uid, price, service, plan_title, manual_note = order
+        enqueue_message(
+            uid,
+            "✅ *تم شحن بنجاح!*\n"
+            f"🧾 Manual Order: *#{mid}*\n"
+            f"📦 Service: {plan_title}\n"
+            f"💵 Paid: *{price:.3f} {CURRENCY}*\n"
+            f"🆔 Admin Approver ID: `{approver_id}`\n\n"
+            "شكراً لك ❤️",
+            PRIO_CUSTOMER,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        reseller_id = await run_db(get_effective_reseller_id, uid)
+        manual_margin, manual_margin_details = await run_db(calculate_pos_manual_profit,
             reseller_id,
             uid,
             service,
@@ -2874,31 +4174,20 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             manual_note,
         )
         if reseller_id and manual_margin > 1e-9:
-            add_reseller_profit(reseller_id, manual_margin, "POS_MANUAL_MARGIN", str(mid), f"client={uid} service={service} details={manual_margin_details}")
-            try:
-                detail_text = f"\nDetails: {manual_margin_details}" if manual_margin_details else ""
-                await context.bot.send_message(
-                    chat_id=reseller_id,
-                    text=(
-                        "💰 *POS Profit Added*\n"
-                        f"Client: `{uid}`\n"
-                        f"Manual Order: *#{mid}*\n"
-                        f"Margin added: *{manual_margin:.3f}{CURRENCY}*{detail_text}\n"
-                        f"Pending profit: *{reseller_profit_balance(reseller_id):.3f}{CURRENCY}*"
-                    ),
-                    parse_mode=ParseMode.MARKDOWN,
-                )
-            except Exception:
-                logger.exception("Failed notifying reseller %s about manual margin", reseller_id)
-        # notify owner (optional)
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"✅ Manual #{mid} approved by admin `{approver_id}`",
+            await run_db(add_reseller_profit, reseller_id, manual_margin, "POS_MANUAL_MARGIN", str(mid), f"client={uid} service={service} details={manual_margin_details}")
+            detail_text = f"\nDetails: {manual_margin_details}" if manual_margin_details else ""
+            pending = await run_db(reseller_profit_balance, reseller_id)
+            enqueue_message(
+                reseller_id,
+                "💰 *POS Profit Added*\n"
+                f"Client: `{uid}`\n"
+                f"Manual Order: *#{mid}*\n"
+                f"Margin added: *{manual_margin:.3f}{CURRENCY}*{detail_text}\n"
+                f"Pending profit: *{pending:.3f}{CURRENCY}*",
                 parse_mode=ParseMode.MARKDOWN,
             )
-        except Exception:
-            pass
+        # notify owner (optional)
+        enqueue_message(ADMIN_ID, f"✅ Manual #{mid} approved by admin `{approver_id}`", parse_mode=ParseMode.MARKDOWN)
         return await q.edit_message_text(f"✅ Manual order #{mid} approved.", reply_markup=kb_admin_panel(update.effective_user.id))
     # Manual reject menu + reason (same as before)
     if data.startswith("admin:manual:rejectmenu:"):
@@ -2933,29 +4222,25 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "NOT_AVAILABLE": "❌ تم الرفض: 🟨 الخدمة غير متاحة حالياً.",
         }
         reason_text = reason_map.get(reason, "❌ Rejected.")
-        cur.execute("SELECT user_id, price, status FROM manual_orders WHERE id=?", (mid,))
-        row = cur.fetchone()
+        row = await run_db(db_fetchone, "SELECT user_id, price, status FROM manual_orders WHERE id=?", (mid,))
         if not row:
             return await q.edit_message_text("❌ Manual order not found.")
         uid, price, status = int(row[0]), float(row[1]), row[2]
         if status != "PENDING":
             return await q.edit_message_text("❌ This manual order is not pending.")
-        bal_before, bal_after = add_balance_logged(uid, price, 'MANUAL_REFUND', source_id=str(mid), note=reason_text)
-        cur.execute("UPDATE manual_orders SET status='REJECTED', delivered_text=? WHERE id=?", (reason_text, mid))
-        con.commit()
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text=(
-                    f"{reason_text}\n"
-                    f"🧾 Manual Order #{mid}\n"
-                    f"💰 Refunded: +{price:.3f} {CURRENCY}\n\n"
-                    f"💳 Balance before: {bal_before:.3f} {CURRENCY}\n"
-                    f"✅ Balance after: {bal_after:.3f} {CURRENCY}\n"
-                ),
-            )
-        except Exception as e:
-            logger.exception("Failed to notify user %s about manual reject %s: %s", uid, mid, e)
+        rejected = await run_db(reject_manual_order, mid, reason_text)
+        if not rejected:
+            return await q.edit_message_text("❌ This manual order is not pending.")
+        uid, price, bal_before, bal_after = rejected
+        enqueue_message(
+            uid,
+            f"{reason_text}\n"
+            f"🧾 Manual Order #{mid}\n"
+            f"💰 Refunded: +{price:.3f} {CURRENCY}\n\n"
+            f"💳 Balance before: {bal_before:.3f} {CURRENCY}\n"
+            f"✅ Balance after: {bal_after:.3f} {CURRENCY}\n",
+            PRIO_CUSTOMER,
+        )
         return await q.edit_message_text(f"✅ Manual order #{mid} rejected + refunded.", reply_markup=kb_admin_panel(update.effective_user.id))
     # Admin generic modes entry (Owner only)
     if data.startswith("admin:"):
@@ -2978,14 +4263,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mode = data.split(":", 1)[1]
         context.user_data[UD_ADMIN_MODE] = mode
         if mode == "listprod":
-            cur.execute(
-                """
+            rows = await run_db(db_fetchall, """
                 SELECT p.pid, c.title, p.title, p.price, p.active
                 FROM products p JOIN categories c ON c.cid=p.cid
                 ORDER BY c.title, p.title
-                """
-            )
-            rows = cur.fetchall()
+                """)
             if not rows:
                 return await q.edit_message_text("No products.")
             lines = [
@@ -3018,20 +4300,19 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("cat:"):
         cid = int(data.split(":", 1)[1])
         context.user_data[UD_CID] = cid
-        return await q.edit_message_text("🛒 Choose a product:", reply_markup=kb_products(cid, update.effective_user.id))
+        return await q.edit_message_text("🛒 Choose a product:", reply_markup=await run_db(kb_products, cid, update.effective_user.id))
     if data.startswith("back:prods:"):
         cid = int(data.split(":", 2)[2])
-        return await q.edit_message_text("🛒 Choose a product:", reply_markup=kb_products(cid, update.effective_user.id))
+        return await q.edit_message_text("🛒 Choose a product:", reply_markup=await run_db(kb_products, cid, update.effective_user.id))
     # View
     if data.startswith("view:"):
         pid = int(data.split(":", 1)[1])
-        cur.execute("SELECT title, price, cid FROM products WHERE pid=? AND active=1", (pid,))
-        row = cur.fetchone()
+        row = await run_db(db_fetchone, "SELECT title, price, cid FROM products WHERE pid=? AND active=1", (pid,))
         if not row:
             return await q.edit_message_text("❌ Product not found.")
         title, base_price, cid = row
-        stock = product_stock(pid)
-        show_price = get_user_product_price(update.effective_user.id, pid, float(base_price))
+        stock = await run_db(product_stock, pid)
+        show_price = await run_db(get_user_product_price, update.effective_user.id, pid, float(base_price))
         custom_note = "\n🏷 Special customer price applied" if abs(float(show_price) - float(base_price)) > 1e-9 else ""
         text = (
             f"🎁 *{title}*\n\n"
@@ -3043,14 +4324,13 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Buy -> qty
     if data.startswith("buy:"):
         pid = int(data.split(":", 1)[1])
-        cur.execute("SELECT title, cid FROM products WHERE pid=? AND active=1", (pid,))
-        row = cur.fetchone()
+        row = await run_db(db_fetchone, "SELECT title, cid FROM products WHERE pid=? AND active=1", (pid,))
         if not row:
             return await q.edit_message_text("❌ Product not found.")
         title, cid = row
-        stock = product_stock(pid)
+        stock = await run_db(product_stock, pid)
         if stock <= 0:
-            return await q.edit_message_text("❌ Out of stock.", reply_markup=kb_products(cid, update.effective_user.id))
+            return await q.edit_message_text("❌ Out of stock.", reply_markup=await run_db(kb_products, cid, update.effective_user.id))
         context.user_data[UD_PID] = pid
         context.user_data[UD_CID] = cid
         context.user_data[UD_QTY_MAX] = stock
@@ -3070,61 +4350,38 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         qty = int(context.user_data.get(UD_LAST_QTY, 0))
         if qty <= 0 or pid <= 0 or not client_ref:
             return await q.edit_message_text("❌ Quantity expired. Buy again.")
-        cur.execute("SELECT id, delivered_text, status FROM orders WHERE client_ref=?", (client_ref,))
-        already = cur.fetchone()
+        already = await run_db(db_fetchone, "SELECT id, delivered_text, status FROM orders WHERE client_ref=?", (client_ref,))
         if already:
             oid, delivered_text, status = already[0], already[1] or "", already[2]
             await q.edit_message_text(f"✅ Already processed.\nOrder ID: {oid}\nStatus: {status}\nDelivering again...")
             if delivered_text.strip():
-                await send_codes_delivery(update.effective_user.id, context, oid, delivered_text.splitlines())
+                send_codes_delivery(update.effective_user.id, oid, delivered_text.splitlines())
             return
-        cur.execute("SELECT title, price FROM products WHERE pid=? AND active=1", (pid,))
-        row = cur.fetchone()
+        row = await run_db(db_fetchone, "SELECT title, price FROM products WHERE pid=? AND active=1", (pid,))
         if not row:
             return await q.edit_message_text("❌ Product not found.")
         title, base_price = row
         uid = update.effective_user.id
-        price = get_user_product_price(uid, pid, float(base_price))
+        price = await run_db(get_user_product_price, uid, pid, float(base_price))
         total = float(price) * qty
-        ok_charge, bal_before, bal_after = charge_balance_logged(uid, total, "ORDER_PURCHASE", note=title)
-        if not ok_charge:
-            bal = get_balance(uid)
-            missing = total - bal
-            return await q.edit_message_text(
-                f"❌ Insufficient balance.\nYour balance: {bal:.3f} {CURRENCY}\nRequired: {total:.3f} {CURRENCY}\nMissing: {missing:.3f} {CURRENCY}",
-                reply_markup=kb_topup_now(),
-            )
         try:
-            cur.execute("BEGIN IMMEDIATE")
-            cur.execute("SELECT code_id, code_text FROM codes WHERE pid=? AND used=0 ORDER BY code_id ASC LIMIT ?", (pid, qty))
-            picked = cur.fetchall()
-            if len(picked) < qty:
-                cur.execute("ROLLBACK")
-                add_balance_logged(uid, total, 'ORDER_PURCHASE_REFUND', note='stock error refund')
-                return await q.edit_message_text("❌ Stock error. Refunded. Try again.")
-            cur.execute(
-                "INSERT INTO orders(user_id,pid,product_title,qty,total,status,client_ref) VALUES(?,?,?,?,?,'PENDING',?)",
-                (uid, pid, title, qty, total, client_ref),
-            )
-            oid = cur.lastrowid
-            for code_id, _ in picked:
-                cur.execute(
-                    "UPDATE codes SET used=1, used_at=datetime('now'), order_id=? WHERE code_id=? AND used=0",
-                    (oid, code_id),
-                )
-            codes_list = [c for _, c in picked]
-            delivered_text = "\n".join(codes_list)
-            cur.execute("UPDATE orders SET status='COMPLETED', delivered_text=? WHERE id=?", (delivered_text, oid))
-            cur.execute("COMMIT")
+            status, oid, bal_before, bal_after, codes_list = await run_db(purchase_codes, uid, pid, qty, price, title, client_ref)
         except Exception as e:
-            try:
-                cur.execute("ROLLBACK")
-            except Exception:
-                pass
-            add_balance_logged(uid, total, 'ORDER_PURCHASE_REFUND', note='exception refund')
             logger.exception("Purchase transaction failed: %s", e)
-            return await q.edit_message_text("❌ Error while processing order. Refunded. Try again.")
-        bal_after = get_balance(uid)
+            return await q.edit_message_text("❌ Error while processing order. Nothing was charged. Try again.")
+        if status == "DUPLICATE":
+            await q.edit_message_text(f"✅ Already processed.\nOrder ID: {oid}\nDelivering again...")
+            if codes_list:
+                send_codes_delivery(uid, oid, codes_list)
+            return
+        if status == "NO_STOCK":
+            return await q.edit_message_text("❌ Stock error. Nothing was charged. Try again.")
+        if status == "NO_BALANCE":
+            missing = total - bal_after
+            return await q.edit_message_text(
+                f"❌ Insufficient balance.\nYour balance: {bal_after:.3f} {CURRENCY}\nRequired: {total:.3f} {CURRENCY}\nMissing: {missing:.3f} {CURRENCY}",
+                reply_markup=kb_topup_now(),
+            )
         await q.edit_message_text(
             f"✅ *Order Created Successfully!*\n"
             f"🧾 Order ID: *{oid}*\n"
@@ -3136,41 +4393,32 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🚚 Delivering codes... 🎁",
             parse_mode=ParseMode.MARKDOWN,
         )
-        await send_codes_delivery(chat_id=uid, context=context, order_id=oid, codes=codes_list)
-        reseller_id = get_effective_reseller_id(uid)
-        admin_base_price = get_effective_product_base_for_pos(uid, pid)
+        send_codes_delivery(chat_id=uid, order_id=oid, codes=codes_list)
+        reseller_id = await run_db(get_effective_reseller_id, uid)
+        admin_base_price = await run_db(get_effective_product_base_for_pos, uid, pid)
         margin = (float(price) - float(admin_base_price)) * qty
-        if reseller_id and margin > 1e-9 and has_pos_product_price(reseller_id, uid, pid):
-            add_reseller_profit(reseller_id, margin, "POS_ORDER_MARGIN", str(oid), f"client={uid} pid={pid} qty={qty}")
-            try:
-                await context.bot.send_message(
-                    chat_id=reseller_id,
-                    text=(
-                        "💰 *POS Profit Added*\n"
-                        f"Client: `{uid}`\n"
-                        f"Order: *#{oid}*\n"
-                        f"Margin added: *{margin:.3f}{CURRENCY}*\n"
-                        f"Pending profit: *{reseller_profit_balance(reseller_id):.3f}{CURRENCY}*"
-                    ),
-                    parse_mode=ParseMode.MARKDOWN,
-                )
-            except Exception:
-                logger.exception("Failed notifying reseller %s about margin", reseller_id)
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=(
-                    "✅ *NEW COMPLETED ORDER*\n"
-                    f"🧾 Order ID: *{oid}*\n"
-                    f"👤 User: `{uid}`\n"
-                    f"🎮 Product: {title}\n"
-                    f"🔢 Qty: *{qty}*\n"
-                    f"💵 Total: *{total:.3f} {CURRENCY}*"
-                ),
+        if reseller_id and margin > 1e-9 and await run_db(has_pos_product_price, reseller_id, uid, pid):
+            await run_db(add_reseller_profit, reseller_id, margin, "POS_ORDER_MARGIN", str(oid), f"client={uid} pid={pid} qty={qty}")
+            pending = await run_db(reseller_profit_balance, reseller_id)
+            enqueue_message(
+                reseller_id,
+                "💰 *POS Profit Added*\n"
+                f"Client: `{uid}`\n"
+                f"Order: *#{oid}*\n"
+                f"Margin added: *{margin:.3f}{CURRENCY}*\n"
+                f"Pending profit: *{pending:.3f}{CURRENCY}*",
                 parse_mode=ParseMode.MARKDOWN,
             )
-        except Exception as e:
-            logger.exception("Failed to notify admin about completed order %s: %s", oid, e)
+        enqueue_message(
+            ADMIN_ID,
+            "✅ *NEW COMPLETED ORDER*\n"
+            f"🧾 Order ID: *{oid}*\n"
+            f"👤 User: `{uid}`\n"
+            f"🎮 Product: {title}\n"
+            f"🔢 Qty: *{qty}*\n"
+            f"💵 Total: *{total:.3f} {CURRENCY}*",
+            parse_mode=ParseMode.MARKDOWN,
+        )
         return
     # Orders pagination
     if data.startswith("orders:range:"):
@@ -3184,16 +4432,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("pay:"):
         method = data.split(":", 1)[1]
         uid = update.effective_user.id
-        reseller_id = get_effective_reseller_id(uid)
+        reseller_id = await run_db(get_effective_reseller_id, uid)
         if reseller_id and not is_admin_any(uid):
             return await q.edit_message_text(f"⛔ هذا الحساب تابع لنقطة بيع `{reseller_id}`.\nشحن الرصيد يتم من خلال نقطة البيع فقط.", parse_mode=ParseMode.MARKDOWN)
         note = secrets.token_hex(8).upper()
-        cur.execute(
-            "INSERT INTO deposits(user_id,method,note,status) VALUES(?,?,?,'WAITING_PAYMENT')",
-            (uid, method, note),
-        )
-        dep_id = cur.lastrowid
-        con.commit()
+        dep_id = await run_db(create_deposit, uid, method, note)
         if method == "BINANCE":
             dest_title = "UID"
             dest_value = BINANCE_UID
@@ -3233,7 +4476,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid_admin = update.effective_user.id
-    if not is_admin_any(uid_admin) and not is_reseller(uid_admin):
+    if not is_admin_any(uid_admin) and not await run_db(is_reseller, uid_admin):
         return ConversationHandler.END
     mode = context.user_data.get(UD_ADMIN_MODE)
     # allow exit + menu
@@ -3252,61 +4495,50 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ConversationHandler.END
     text = (update.message.text or "").strip() if update.message else ""
     if mode == "pos_add_client":
-        if not is_reseller(uid_admin):
+        if not await run_db(is_reseller, uid_admin):
             await update.message.reply_text("❌ Not allowed.")
             return ConversationHandler.END
         if not text.isdigit():
             await update.message.reply_text("❌ Send client user_id only.")
             return ST_ADMIN_INPUT
         client_uid = int(text)
-        ok, msg = assign_client_to_reseller(uid_admin, client_uid)
+        ok, msg = await run_db(assign_client_to_reseller, uid_admin, client_uid)
         if ok:
-            try:
-                await context.bot.send_message(
-                    client_uid,
-                    (
-                        "✅ تم ربط حسابك بنقطة بيع داخل البوت.\n"
-                        f"🏪 POS ID: `{uid_admin}`\n"
-                        "🛒 الآن أي أسعار خاصة بنقطة البيع ستظهر لك تلقائياً داخل المنتجات والخدمات اليدوية."
-                    ),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=REPLY_MENU,
-                )
-            except Exception:
-                logger.exception("Failed notifying client %s about POS attach", client_uid)
+            enqueue_message(
+                client_uid,
+                "✅ تم ربط حسابك بنقطة بيع داخل البوت.\n"
+                f"🏪 POS ID: `{uid_admin}`\n"
+                "🛒 الآن أي أسعار خاصة بنقطة البيع ستظهر لك تلقائياً داخل المنتجات والخدمات اليدوية.",
+                PRIO_CUSTOMER,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=REPLY_MENU,
+            )
         await update.message.reply_text(("✅ " if ok else "❌ ") + msg, reply_markup=REPLY_MENU)
         return ConversationHandler.END
     if mode == "pos_remove_client":
-        if not is_reseller(uid_admin):
+        if not await run_db(is_reseller, uid_admin):
             await update.message.reply_text("❌ Not allowed.")
             return ConversationHandler.END
         if not text.isdigit():
             await update.message.reply_text("❌ Send client user_id only.")
             return ST_ADMIN_INPUT
         client_uid = int(text)
-        ok = remove_client_from_reseller(uid_admin, client_uid)
+        ok = await run_db(remove_client_from_reseller, uid_admin, client_uid)
         if ok:
-            try:
-                await context.bot.send_message(
-                    client_uid,
-                    "ℹ️ تم فك ربطك من نقطة البيع داخل البوت. عادت أسعارك الافتراضية.",
-                    reply_markup=REPLY_MENU,
-                )
-            except Exception:
-                logger.exception("Failed notifying client %s about POS detach", client_uid)
+            enqueue_message(client_uid, "ℹ️ تم فك ربطك من نقطة البيع داخل البوت. عادت أسعارك الافتراضية.", PRIO_CUSTOMER, reply_markup=REPLY_MENU)
         await update.message.reply_text(("✅ Client removed." if ok else "❌ Client not found under your POS."), reply_markup=REPLY_MENU)
         return ConversationHandler.END
     if mode == "pos_set_price":
-        if not is_reseller(uid_admin):
+        if not await run_db(is_reseller, uid_admin):
             await update.message.reply_text("❌ Not allowed.")
             return ConversationHandler.END
         m_del = re.match(r"^del\s*\|\s*(\d+)\s*\|\s*(\d+)$", text, re.I)
         if m_del:
             client_uid = int(m_del.group(1)); pid = int(m_del.group(2))
-            if not reseller_can_manage_client(uid_admin, client_uid):
+            if not await run_db(reseller_can_manage_client, uid_admin, client_uid):
                 await update.message.reply_text("❌ هذا العميل ليس تابعاً لك.")
                 return ConversationHandler.END
-            clear_pos_product_price(uid_admin, client_uid, pid)
+            await run_db(clear_pos_product_price, uid_admin, client_uid, pid)
             await update.message.reply_text("✅ تم حذف سعر POS الخاص للمنتج لهذا العميل.", reply_markup=REPLY_MENU)
             return ConversationHandler.END
         m = re.match(r"^(\d+)\s*\|\s*(\d+)\s*\|\s*([\d.]+)$", text)
@@ -3314,17 +4546,17 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Format: client_user_id | pid | price")
             return ST_ADMIN_INPUT
         client_uid, pid, price = int(m.group(1)), int(m.group(2)), float(m.group(3))
-        if not reseller_can_manage_client(uid_admin, client_uid):
+        if not await run_db(reseller_can_manage_client, uid_admin, client_uid):
             await update.message.reply_text("❌ هذا العميل ليس تابعاً لك.")
             return ConversationHandler.END
-        base_price = get_effective_product_base_for_pos(client_uid, pid)
+        base_price = await run_db(get_effective_product_base_for_pos, client_uid, pid)
         if base_price <= 0:
             await update.message.reply_text("❌ Product not found.")
             return ConversationHandler.END
         if price + 1e-9 < base_price:
             await update.message.reply_text(f"❌ لا يمكن أقل من السعر الأساسي الفعلي للعميل: {base_price:.3f}{CURRENCY}")
             return ConversationHandler.END
-        set_pos_product_price(uid_admin, client_uid, pid, price)
+        await run_db(set_pos_product_price, uid_admin, client_uid, pid, price)
         margin = float(price) - float(base_price)
         await update.message.reply_text(
             f"✅ تم حفظ سعر POS للمنتج.\nClient: {client_uid}\nPID: {pid}\nBase: {base_price:.3f}{CURRENCY}\nSell: {price:.3f}{CURRENCY}\nProfit per item: {margin:.3f}{CURRENCY}",
@@ -3332,7 +4564,7 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     if mode == "pos_set_manual_price":
-        if not is_reseller(uid_admin):
+        if not await run_db(is_reseller, uid_admin):
             await update.message.reply_text("❌ Not allowed.")
             return ConversationHandler.END
         allowed_keys = {"SHAHID_MENA_3M", "SHAHID_MENA_12M", "FF_100", "FF_210", "FF_530", "FF_1080", "FF_2200"}
@@ -3342,10 +4574,10 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if key not in allowed_keys:
                 await update.message.reply_text("❌ Invalid KEY.")
                 return ST_ADMIN_INPUT
-            if not reseller_can_manage_client(uid_admin, client_uid):
+            if not await run_db(reseller_can_manage_client, uid_admin, client_uid):
                 await update.message.reply_text("❌ هذا العميل ليس تابعاً لك.")
                 return ConversationHandler.END
-            clear_pos_manual_price(uid_admin, client_uid, key)
+            await run_db(clear_pos_manual_price, uid_admin, client_uid, key)
             await update.message.reply_text("✅ تم حذف سعر POS اليدوي لهذا العميل.", reply_markup=REPLY_MENU)
             return ConversationHandler.END
         m = re.match(r"^(\d+)\s*\|\s*([A-Za-z0-9_]+)\s*\|\s*([\d.]+)$", text)
@@ -3356,14 +4588,14 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if key not in allowed_keys:
             await update.message.reply_text("❌ Invalid KEY.")
             return ST_ADMIN_INPUT
-        if not reseller_can_manage_client(uid_admin, client_uid):
+        if not await run_db(reseller_can_manage_client, uid_admin, client_uid):
             await update.message.reply_text("❌ هذا العميل ليس تابعاً لك.")
             return ConversationHandler.END
-        base_price = get_effective_manual_base_for_pos(client_uid, key)
+        base_price = await run_db(get_effective_manual_base_for_pos, client_uid, key)
         if price + 1e-9 < base_price:
             await update.message.reply_text(f"❌ لا يمكن أقل من السعر الأساسي الفعلي للعميل: {base_price:.3f}{CURRENCY}")
             return ConversationHandler.END
-        set_pos_manual_price(uid_admin, client_uid, key, price)
+        await run_db(set_pos_manual_price, uid_admin, client_uid, key, price)
         margin = float(price) - float(base_price)
         await update.message.reply_text(
             f"✅ تم حفظ سعر POS اليدوي.\nClient: {client_uid}\nKEY: {key}\nBase: {base_price:.3f}{CURRENCY}\nSell: {price:.3f}{CURRENCY}\nProfit per order: {margin:.3f}{CURRENCY}",
@@ -3371,27 +4603,14 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     if mode == "pos_broadcast_clients":
-        if not is_reseller(uid_admin):
+        if not await run_db(is_reseller, uid_admin):
             await update.message.reply_text("❌ Not allowed.")
             return ConversationHandler.END
-        cur.execute("SELECT client_user_id FROM reseller_clients WHERE reseller_id=? ORDER BY client_user_id", (uid_admin,))
-        targets = [int(r[0]) for r in cur.fetchall()]
-        if not targets:
+        if not await launch_broadcast(update, context, "POS", uid_admin, f"📢 رسالة من نقطة البيع الخاصة بك:\n\n{text}"):
             await update.message.reply_text("❌ لا يوجد عملاء تابعون لك.", reply_markup=REPLY_MENU)
-            return ConversationHandler.END
-        sent = 0
-        failed = 0
-        for target_uid in targets:
-            try:
-                await context.bot.send_message(target_uid, f"📢 رسالة من نقطة البيع الخاصة بك:\n\n{text}")
-                sent += 1
-            except Exception:
-                failed += 1
-                logger.exception("POS broadcast failed to %s", target_uid)
-        await update.message.reply_text(f"✅ تم إرسال الإشعار إلى عملائك فقط.\nنجح: {sent}\nفشل: {failed}", reply_markup=REPLY_MENU)
         return ConversationHandler.END
     if mode == "pos_charge_client":
-        if not is_reseller(uid_admin):
+        if not await run_db(is_reseller, uid_admin):
             await update.message.reply_text("❌ Not allowed.")
             return ConversationHandler.END
         m = re.match(r"^(\d+)\s*\|\s*([\d.]+)$", text)
@@ -3402,18 +4621,25 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if amount <= 0:
             await update.message.reply_text("❌ Amount must be positive.")
             return ST_ADMIN_INPUT
-        if not reseller_can_manage_client(uid_admin, client_uid):
+        if not await run_db(reseller_can_manage_client, uid_admin, client_uid):
             await update.message.reply_text("❌ هذا العميل ليس تابعاً لك.")
             return ConversationHandler.END
-        ok, rb_before, rb_after = charge_balance_logged(uid_admin, amount, "POS_TOPUP_TO_CLIENT", str(client_uid), f"POS topup to client {client_uid}")
+        ok, rb_before, rb_after, cb_before, cb_after = await run_db(
+            transfer_balance_logged,
+            uid_admin,
+            client_uid,
+            amount,
+            "POS_TOPUP_TO_CLIENT",
+            "POS_TOPUP_FROM_RESELLER",
+            src_id=str(client_uid),
+            dst_id=str(uid_admin),
+            src_note=f"POS topup to client {client_uid}",
+            dst_note=f"POS {uid_admin} topup",
+        )
         if not ok:
             await update.message.reply_text(f"❌ رصيد نقطة البيع غير كافٍ.\nرصيدك: {rb_before:.3f}{CURRENCY}", reply_markup=REPLY_MENU)
             return ConversationHandler.END
-        cb_before, cb_after = add_balance_logged(client_uid, amount, "POS_TOPUP_FROM_RESELLER", str(uid_admin), f"POS {uid_admin} topup")
-        try:
-            await context.bot.send_message(client_uid, f"✅ تم شحن رصيدك من نقطة البيع التابعة لك.\n+{amount:.3f}{CURRENCY}\n\n💳 Before: {cb_before:.3f}{CURRENCY}\n✅ After: {cb_after:.3f}{CURRENCY}")
-        except Exception:
-            logger.exception("Failed notifying client %s about POS topup", client_uid)
+        enqueue_message(client_uid, f"✅ تم شحن رصيدك من نقطة البيع التابعة لك.\n+{amount:.3f}{CURRENCY}\n\n💳 Before: {cb_before:.3f}{CURRENCY}\n✅ After: {cb_after:.3f}{CURRENCY}", PRIO_CUSTOMER)
         await update.message.reply_text(f"✅ تم شحن العميل {client_uid} بمبلغ {amount:.3f}{CURRENCY}\nرصيدك الآن: {rb_after:.3f}{CURRENCY}", reply_markup=REPLY_MENU)
         return ConversationHandler.END
     if mode == "reseller_add":
@@ -3424,11 +4650,8 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Send user_id only.")
             return ST_ADMIN_INPUT
         target = int(text)
-        add_reseller(target)
-        try:
-            await context.bot.send_message(target, "✅ تم تفعيلك كنقطة بيع.\nاستخدم زر 🏪 POS Panel للدخول إلى لوحة نقطة البيع.", reply_markup=REPLY_MENU)
-        except Exception:
-            logger.exception("Failed notifying reseller %s", target)
+        await run_db(add_reseller, target)
+        enqueue_message(target, "✅ تم تفعيلك كنقطة بيع.\nاستخدم زر 🏪 POS Panel للدخول إلى لوحة نقطة البيع.", reply_markup=REPLY_MENU)
         await update.message.reply_text(f"✅ Added POS: {target}", reply_markup=REPLY_MENU)
         return ConversationHandler.END
     if mode == "reseller_del":
@@ -3439,11 +4662,8 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Send user_id only.")
             return ST_ADMIN_INPUT
         target = int(text)
-        remove_reseller(target)
-        try:
-            await context.bot.send_message(target, "ℹ️ تم إلغاء تفعيل نقطة البيع الخاصة بك.", reply_markup=REPLY_MENU)
-        except Exception:
-            logger.exception("Failed notifying reseller %s about removal", target)
+        await run_db(remove_reseller, target)
+        enqueue_message(target, "ℹ️ تم إلغاء تفعيل نقطة البيع الخاصة بك.", reply_markup=REPLY_MENU)
         await update.message.reply_text(f"✅ Removed POS: {target}", reply_markup=REPLY_MENU)
         return ConversationHandler.END
     # helper limitation
@@ -3466,16 +4686,16 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if target == ADMIN_ID:
                     await update.message.reply_text("✅ Owner already admin.")
                     return ConversationHandler.END
-                cur.execute("INSERT OR REPLACE INTO admins(user_id, role) VALUES(?,?)", (target, ROLE_HELPER))
-                con.commit()
+                await run_db(db_execute, "INSERT OR REPLACE INTO admins(user_id, role) VALUES(?,?)", (target, ROLE_HELPER))
+                invalidate_admin_roles()
                 await update.message.reply_text(f"✅ Added helper admin: {target}")
                 return ConversationHandler.END
             if cmd == "deladmin":
                 if target == ADMIN_ID:
                     await update.message.reply_text("❌ Cannot delete owner.")
                     return ConversationHandler.END
-                cur.execute("DELETE FROM admins WHERE user_id=? AND role!=?", (target, ROLE_OWNER))
-                con.commit()
+                await run_db(db_execute, "DELETE FROM admins WHERE user_id=? AND role!=?", (target, ROLE_OWNER))
+                invalidate_admin_roles()
                 await update.message.reply_text(f"✅ Removed admin: {target}")
                 return ConversationHandler.END
         if mode == "manual_reject_custom":
@@ -3484,8 +4704,7 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not mid or not reason_text:
                 await update.message.reply_text("❌ Missing manual id or reason.")
                 return ConversationHandler.END
-            cur.execute("SELECT user_id, price, status FROM manual_orders WHERE id=?", (mid,))
-            row = cur.fetchone()
+            row = await run_db(db_fetchone, "SELECT user_id, price, status FROM manual_orders WHERE id=?", (mid,))
             if not row:
                 await update.message.reply_text("❌ Manual order not found.")
                 return ConversationHandler.END
@@ -3493,23 +4712,21 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if status != "PENDING":
                 await update.message.reply_text("❌ This manual order is not pending.")
                 return ConversationHandler.END
-            bal_before, bal_after = add_balance_logged(uid, price, 'MANUAL_REFUND', source_id=str(mid), note=reason_text)
-            cur.execute("UPDATE manual_orders SET status='REJECTED', delivered_text=? WHERE id=?", (reason_text[:3500], mid))
-            con.commit()
+            rejected = await run_db(reject_manual_order, mid, reason_text)
+            if not rejected:
+                await update.message.reply_text("❌ This manual order is not pending.")
+                return ConversationHandler.END
+            uid, price, bal_before, bal_after = rejected
             await update.message.reply_text(f"✅ Manual order #{mid} rejected + refunded.", reply_markup=REPLY_MENU)
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=(
-                        f"❌ Your manual order #{mid} was rejected.\n"
-                        f"Reason: {reason_text}\n\n"
-                        f"Refunded: +{price:.3f} {CURRENCY}\n"
-                        f"💳 Balance before: {bal_before:.3f} {CURRENCY}\n"
-                        f"✅ Balance after: {bal_after:.3f} {CURRENCY}\n"
-                    ),
-                )
-            except Exception as e:
-                logger.exception("Failed to notify user %s about custom manual reject %s: %s", uid, mid, e)
+            enqueue_message(
+                uid,
+                f"❌ Your manual order #{mid} was rejected.\n"
+                f"Reason: {reason_text}\n\n"
+                f"Refunded: +{price:.3f} {CURRENCY}\n"
+                f"💳 Balance before: {bal_before:.3f} {CURRENCY}\n"
+                f"✅ Balance after: {bal_after:.3f} {CURRENCY}\n",
+                PRIO_CUSTOMER,
+            )
             context.user_data.pop(UD_ADMIN_MANUAL_ID, None)
             return ConversationHandler.END
         if mode == "usermanualprice":
@@ -3525,10 +4742,10 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if key not in allowed_keys:
                     await update.message.reply_text("❌ Unknown key.")
                     return ST_ADMIN_INPUT
-                if not has_user_manual_price(user_id, key):
+                if not await run_db(has_user_manual_price, user_id, key):
                     await update.message.reply_text("❌ No custom manual price exists for this user/key.")
                     return ConversationHandler.END
-                clear_user_manual_price(user_id, key)
+                await run_db(clear_user_manual_price, user_id, key)
                 await update.message.reply_text(
                     f"✅ Custom manual price deleted.\nUser: {user_id}\nKey: {key}",
                     reply_markup=REPLY_MENU,
@@ -3554,8 +4771,8 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if price < 0:
                 await update.message.reply_text("❌ Price must be >= 0")
                 return ST_ADMIN_INPUT
-            ensure_user_exists(user_id)
-            set_user_manual_price(user_id, key, price)
+            await run_db(ensure_user_exists, user_id)
+            await run_db(set_user_manual_price, user_id, key, price)
             await update.message.reply_text(
                 f"✅ Custom manual price saved.\nUser: {user_id}\nKey: {key}\nPrice: {price:.3f}{CURRENCY}",
                 reply_markup=REPLY_MENU,
@@ -3583,12 +4800,7 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if price < 0:
                 await update.message.reply_text("❌ Price must be >= 0")
                 return ST_ADMIN_INPUT
-            cur.execute(
-                "INSERT INTO manual_prices(pkey, price) VALUES(?,?) "
-                "ON CONFLICT(pkey) DO UPDATE SET price=excluded.price",
-                (key, price),
-            )
-            con.commit()
+            await run_db(set_manual_price, key, price)
             await update.message.reply_text(
                 f"✅ Manual price updated: {key} = {price:.3f}{CURRENCY}",
                 reply_markup=kb_manual_prices_panel(),
@@ -3612,8 +4824,8 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not msg:
                 await update.message.reply_text("❌ Send message text first.")
                 return ST_ADMIN_INPUT
-            sent, failed = await broadcast_to_all_users(context, f"📢 إشعار من الإدارة\n\n{msg}")
-            await update.message.reply_text(f"✅ Broadcast finished.\nSent: {sent}\nFailed: {failed}", reply_markup=REPLY_MENU)
+            if not await launch_broadcast(update, context, "ALL", uid_admin, f"📢 إشعار من الإدارة\n\n{msg}"):
+                await update.message.reply_text("❌ No users yet.", reply_markup=REPLY_MENU)
             return ConversationHandler.END
         if mode == "userprice":
             if admin_role(uid_admin) != ROLE_OWNER:
@@ -3624,15 +4836,14 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if m_del:
                 user_id = int(m_del.group(1))
                 pid = int(m_del.group(2))
-                cur.execute("SELECT title FROM products WHERE pid=?", (pid,))
-                prow = cur.fetchone()
+                prow = await run_db(db_fetchone, "SELECT title FROM products WHERE pid=?", (pid,))
                 if not prow:
                     await update.message.reply_text("❌ Product PID not found.")
                     return ST_ADMIN_INPUT
-                if not has_user_product_price(user_id, pid):
+                if not await run_db(has_user_product_price, user_id, pid):
                     await update.message.reply_text("❌ No custom price exists for this user/product.")
                     return ConversationHandler.END
-                clear_user_product_price(user_id, pid)
+                await run_db(clear_user_product_price, user_id, pid)
                 await update.message.reply_text(
                     f"✅ Custom price deleted.\nUser: {user_id}\nPID: {pid}\nProduct: {prow[0]}",
                     reply_markup=REPLY_MENU,
@@ -3654,13 +4865,12 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if price < 0:
                 await update.message.reply_text("❌ Price must be >= 0")
                 return ST_ADMIN_INPUT
-            cur.execute("SELECT title, price FROM products WHERE pid=?", (pid,))
-            prow = cur.fetchone()
+            prow = await run_db(db_fetchone, "SELECT title, price FROM products WHERE pid=?", (pid,))
             if not prow:
                 await update.message.reply_text("❌ Product PID not found.")
                 return ST_ADMIN_INPUT
-            ensure_user_exists(user_id)
-            set_user_product_price(user_id, pid, price)
+            await run_db(ensure_user_exists, user_id)
+            await run_db(set_user_product_price, user_id, pid, price)
             await update.message.reply_text(
                 f"✅ Custom price saved.\n"
                 f"User: {user_id}\n"
@@ -3679,15 +4889,13 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Send PID number only.\nExample: 12")
                 return ST_ADMIN_INPUT
             pid = int(text)
-            cur.execute("SELECT title FROM products WHERE pid=?", (pid,))
-            row = cur.fetchone()
+            row = await run_db(db_fetchone, "SELECT title FROM products WHERE pid=?", (pid,))
             if not row:
                 await update.message.reply_text("❌ Product not found.")
                 return ConversationHandler.END
             title = row[0]
-            cur.execute("DELETE FROM codes WHERE pid=?", (pid,))
-            cur.execute("DELETE FROM products WHERE pid=?", (pid,))
-            con.commit()
+            await run_db(delete_products, [pid])
+            bump_catalog_version()
             await update.message.reply_text(f"✅ Deleted product PID {pid}\nTitle: {title}")
             return ConversationHandler.END
         if mode == "delcatfull":
@@ -3699,32 +4907,22 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cat_title = None
             if inp.isdigit():
                 cid = int(inp)
-                cur.execute("SELECT title FROM categories WHERE cid=?", (cid,))
-                row = cur.fetchone()
+                row = await run_db(db_fetchone, "SELECT title FROM categories WHERE cid=?", (cid,))
                 if not row:
                     await update.message.reply_text("❌ Category not found.")
                     return ConversationHandler.END
                 cat_title = row[0]
             else:
                 cat_title = inp
-                cur.execute("SELECT cid FROM categories WHERE title=?", (cat_title,))
-                row = cur.fetchone()
+                row = await run_db(db_fetchone, "SELECT cid FROM categories WHERE title=?", (cat_title,))
                 if not row:
                     await update.message.reply_text("❌ Category not found.")
                     return ConversationHandler.END
                 cid = int(row[0])
-            cur.execute("SELECT pid FROM products WHERE cid=?", (cid,))
-            pids = [int(r[0]) for r in cur.fetchall()]
-            deleted_codes = 0
-            deleted_products = 0
-            for pid in pids:
-                cur.execute("SELECT COUNT(*) FROM codes WHERE pid=?", (pid,))
-                deleted_codes += int(cur.fetchone()[0])
-                cur.execute("DELETE FROM codes WHERE pid=?", (pid,))
-                cur.execute("DELETE FROM products WHERE pid=?", (pid,))
-                deleted_products += 1
-            cur.execute("DELETE FROM categories WHERE cid=?", (cid,))
-            con.commit()
+            pids = [int(r[0]) for r in await run_db(db_fetchall, "SELECT pid FROM products WHERE cid=?", (cid,))]
+            deleted_codes = await run_db(delete_products, pids, cid)
+            deleted_products = len(pids)
+            bump_catalog_version()
             await update.message.reply_text(
                 f"✅ Category deleted (FULL)\n"
                 f"Title: {cat_title}\nCID: {cid}\n"
@@ -3734,8 +4932,8 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
         if mode == "addcat":
-            cur.execute("INSERT OR IGNORE INTO categories(title) VALUES(?)", (text,))
-            con.commit()
+            await run_db(db_execute, "INSERT OR IGNORE INTO categories(title) VALUES(?)", (text,))
+            bump_catalog_version()
             await update.message.reply_text("✅ Category added.")
             return ConversationHandler.END
         if mode == "addprod":
@@ -3744,17 +4942,17 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Format invalid.\nExample:\n\"CAT\" | \"TITLE\" | 9.2")
                 return ST_ADMIN_INPUT
             cat_title, prod_title, price_s = m.groups()
-            cur.execute("SELECT cid FROM categories WHERE title=?", (cat_title,))
-            row = cur.fetchone()
+            row = await run_db(db_fetchone, "SELECT cid FROM categories WHERE title=?", (cat_title,))
             if not row:
                 await update.message.reply_text("❌ Category not found.")
                 return ConversationHandler.END
             cid = int(row[0])
-            cur.execute(
-                "INSERT INTO products(cid,title,price,product_type,active) VALUES(?,?,?,'CODE',1)",
-                (cid, prod_title, float(price_s)),
+            await run_db(
+                db_execute,
+                "INSERT INTO products(cid,title,price,product_type,active,sort_value,code_rule) VALUES(?,?,?,'CODE',1,?,?)",
+                (cid, prod_title, float(price_s), extract_sort_value(prod_title), guess_code_rule(prod_title, cat_title)),
             )
-            con.commit()
+            bump_catalog_version()
             await update.message.reply_text("✅ Product added.")
             return ConversationHandler.END
         if mode == "addcodes":
@@ -3766,25 +4964,20 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ PID must be a number.")
                 return ST_ADMIN_INPUT
             pid = int(pid_s)
-            codes = [c.strip() for c in codes_blob.splitlines() if c.strip()]
-            if not codes:
+            lines = [(n, c.strip().replace(" ", "")) for n, c in enumerate(codes_blob.splitlines(), 1) if c.strip()]
+            if not lines:
                 await update.message.reply_text("❌ No codes.")
                 return ConversationHandler.END
-            ok, msg = validate_codes_for_pid(pid, codes)
-            if not ok:
-                await update.message.reply_text(msg)
+            added, repeated, in_stock, collided, err = await run_db(import_codes_text, pid, lines)
+            if err:
+                await reply_long_text(update, err, f"invalid_codes_pid{pid}.txt")
                 return ConversationHandler.END
-            added = 0
-            skipped = 0
-            for ctext in codes:
-                ctext = ctext.strip().replace(" ", "")
-                try:
-                    cur.execute("INSERT INTO codes(pid,code_text,used) VALUES(?,?,0)", (pid, ctext))
-                    added += 1
-                except sqlite3.IntegrityError:
-                    skipped += 1
-            con.commit()
-            await update.message.reply_text(f"✅ Added {added} codes to PID {pid}.\n♻️ Skipped duplicates: {skipped}")
+            msg = f"✅ Added {added} codes to PID {pid}.\n♻️ Skipped duplicates: {repeated + in_stock}"
+            if repeated or in_stock:
+                msg += f"\n• repeated in message: {repeated}\n• already in stock: {in_stock}"
+            if collided:
+                msg += f"\n⚠️ Already in another product: {collided} (not added, see /collisions)"
+            await update.message.reply_text(msg)
             return ConversationHandler.END
         if mode == "addcodesfile":
             if update.message.text and not update.message.document:
@@ -3809,27 +5002,23 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Missing PID. Send PID number first, then send file.")
                 return ST_ADMIN_INPUT
             file = await update.message.document.get_file()
-            raw = await file.download_as_bytearray()
-            content = raw.decode("utf-8", errors="ignore")
-            codes = [c.strip().replace(" ", "") for c in content.splitlines() if c.strip()]
-            if not codes:
-                await update.message.reply_text("❌ File has no codes.")
-                return ConversationHandler.END
-            ok, msg = validate_codes_for_pid(pid, codes)
-            if not ok:
-                await update.message.reply_text(msg)
+            fd, path = tempfile.mkstemp(prefix="codes_", suffix=".txt")
+            os.close(fd)
+            try:
+                await file.download_to_drive(path)
+                added, repeated, in_stock, collided, err = await run_db(import_codes_file, pid, path)
+            finally:
+                os.unlink(path)
+            if err:
+                await reply_long_text(update, err, f"invalid_codes_pid{pid}.txt")
                 return ConversationHandler.END
-            added = 0
-            skipped = 0
-            for ctext in codes:
-                try:
-                    cur.execute("INSERT INTO codes(pid,code_text,used) VALUES(?,?,0)", (pid, ctext))
-                    added += 1
-                except sqlite3.IntegrityError:
-                    skipped += 1
-            con.commit()
             context.user_data.pop(UD_ADMIN_CODES_PID, None)
-            await update.message.reply_text(f"✅ Added {added} codes to PID {pid} from file.\n♻️ Skipped duplicates: {skipped}")
+            msg = f"✅ Added {added} codes to PID {pid} from file.\n♻️ Skipped duplicates: {repeated + in_stock}"
+            if repeated or in_stock:
+                msg += f"\n• repeated in file: {repeated}\n• already in stock: {in_stock}"
+            if collided:
+                msg += f"\n⚠️ Already in another product: {collided} (not added, see /collisions)"
+            await update.message.reply_text(msg)
             return ConversationHandler.END
         if mode == "setprice":
             m = re.match(r"^(\d+)\s*\|\s*([\d.]+)$", text)
@@ -3837,8 +5026,8 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Format: pid | price\nExample: 12 | 9.5")
                 return ST_ADMIN_INPUT
             pid, price = int(m.group(1)), float(m.group(2))
-            cur.execute("UPDATE products SET price=? WHERE pid=?", (price, pid))
-            con.commit()
+            await run_db(db_execute, "UPDATE products SET price=? WHERE pid=?", (price, pid))
+            bump_catalog_version()
             await update.message.reply_text("✅ Price updated.")
             return ConversationHandler.END
         if mode == "toggle":
@@ -3846,15 +5035,14 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Send PID number only.\nExample: 12")
                 return ST_ADMIN_INPUT
             pid = int(text)
-            cur.execute("SELECT active FROM products WHERE pid=?", (pid,))
-            row = cur.fetchone()
+            row = await run_db(db_fetchone, "SELECT active FROM products WHERE pid=?", (pid,))
             if not row:
                 await update.message.reply_text("❌ Product not found.")
                 return ConversationHandler.END
             active = int(row[0])
             newv = 0 if active else 1
-            cur.execute("UPDATE products SET active=? WHERE pid=?", (newv, pid))
-            con.commit()
+            await run_db(db_execute, "UPDATE products SET active=? WHERE pid=?", (newv, pid))
+            bump_catalog_version()
             await update.message.reply_text(f"✅ Product {'enabled ✅' if newv else 'disabled ⛔'}.")
             return ConversationHandler.END
         if mode == "approvedep":
@@ -3862,25 +5050,21 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Send deposit_id number only.\nExample: 10")
                 return ST_ADMIN_INPUT
             dep_id = int(text)
-            cur.execute("SELECT user_id, amount, status FROM deposits WHERE id=?", (dep_id,))
-            row = cur.fetchone()
-            if not row:
+            status, user_id, amount, bal_before, bal_after = await run_db(approve_deposit, dep_id)
+            if status == "NOT_FOUND":
                 await update.message.reply_text("❌ Deposit not found.")
                 return ConversationHandler.END
-            user_id, amount, status = int(row[0]), row[1], row[2]
-            if status != "PENDING_REVIEW":
-                await update.message.reply_text("❌ Deposit not ready for approval.")
-                return ConversationHandler.END
-            if amount is None:
+            if status == "NO_AMOUNT":
                 await update.message.reply_text("❌ Amount missing.")
                 return ConversationHandler.END
-            cur.execute("UPDATE deposits SET status='APPROVED', approved_at=datetime('now') WHERE id=?", (dep_id,))
-            con.commit()
-            bal_before, bal_after = add_balance_logged(user_id, float(amount), 'DEPOSIT_APPROVED', source_id=str(dep_id), note='approved deposit')
+            if status != "OK":
+                await update.message.reply_text("❌ Deposit not ready for approval.")
+                return ConversationHandler.END
             await update.message.reply_text(f"✅ Deposit #{dep_id} approved. +{money(float(amount))}")
-            await context.bot.send_message(
+            enqueue_message(
                 user_id,
                 f"✅ Top up approved: +{money(float(amount))}\n\n💳 Balance before: {bal_before:.3f} {CURRENCY}\n✅ Balance after: {bal_after:.3f} {CURRENCY}",
+                PRIO_CUSTOMER,
             )
             return ConversationHandler.END
         if mode == "rejectdep":
@@ -3888,19 +5072,15 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Send deposit_id number only.\nExample: 10")
                 return ST_ADMIN_INPUT
             dep_id = int(text)
-            cur.execute("SELECT user_id, status FROM deposits WHERE id=?", (dep_id,))
-            row = cur.fetchone()
-            if not row:
+            status, user_id = await run_db(reject_deposit, dep_id)
+            if status == "NOT_FOUND":
                 await update.message.reply_text("❌ Deposit not found.")
                 return ConversationHandler.END
-            user_id, status = int(row[0]), row[1]
-            if status not in ("PENDING_REVIEW", "WAITING_PAYMENT"):
+            if status != "OK":
                 await update.message.reply_text("❌ Deposit already processed.")
                 return ConversationHandler.END
-            cur.execute("UPDATE deposits SET status='REJECTED' WHERE id=?", (dep_id,))
-            con.commit()
             await update.message.reply_text(f"✅ Deposit #{dep_id} rejected.")
-            await context.bot.send_message(user_id, f"❌ Top up #{dep_id} rejected. Contact support.")
+            enqueue_message(user_id, f"❌ Top up #{dep_id} rejected. Contact support.", PRIO_CUSTOMER)
             return ConversationHandler.END
         if mode == "addbal":
             m = re.match(r"^(\d+)\s*\|\s*([\d.]+)$", text)
@@ -3908,11 +5088,12 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Format: user_id | amount\nExample: 1997968014 | 5")
                 return ST_ADMIN_INPUT
             user_id, amount = int(m.group(1)), float(m.group(2))
-            bal_before, bal_after = add_balance_logged(user_id, amount, 'ADMIN_ADD_BALANCE', source_id=str(uid_admin), note='admin add balance')
+            bal_before, bal_after = await run_db(add_balance_logged, user_id, amount, 'ADMIN_ADD_BALANCE', source_id=str(uid_admin), note='admin add balance')
             await update.message.reply_text(f"✅ Added +{money(amount)} to {user_id}")
-            await context.bot.send_message(
+            enqueue_message(
                 user_id,
                 f"✅ Admin added balance: +{money(amount)}\n\n💳 Balance before: {bal_before:.3f} {CURRENCY}\n✅ Balance after: {bal_after:.3f} {CURRENCY}",
+                PRIO_CUSTOMER,
             )
             return ConversationHandler.END
         if mode == "takebal":
@@ -3921,16 +5102,26 @@ async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Format: user_id | amount\nExample: 1997968014 | 5")
                 return ST_ADMIN_INPUT
             user_id, amount = int(m.group(1)), float(m.group(2))
-            ok_take, bal_before, bal_after = charge_balance_logged(user_id, amount, 'ADMIN_TAKE_BALANCE', source_id=str(uid_admin), note='admin take balance')
+            ok_take, bal_before, bal_after, _, _ = await run_db(
+                transfer_balance_logged,
+                user_id,
+                ADMIN_ID,
+                amount,
+                'ADMIN_TAKE_BALANCE',
+                'ADMIN_OWNER_COLLECTION',
+                src_id=str(uid_admin),
+                dst_id=str(user_id),
+                src_note='admin take balance',
+                dst_note='collected from user',
+            )
             if not ok_take:
-                bal = get_balance(user_id)
-                await update.message.reply_text(f"❌ User has insufficient balance. User balance: {bal:.3f} {CURRENCY}")
+                await update.message.reply_text(f"❌ User has insufficient balance. User balance: {bal_before:.3f} {CURRENCY}")
                 return ConversationHandler.END
-            add_balance_logged(ADMIN_ID, amount, 'ADMIN_OWNER_COLLECTION', source_id=str(user_id), note='collected from user')
             await update.message.reply_text(f"✅ Took {money(amount)} from {user_id} → added to Admin.")
-            await context.bot.send_message(
+            enqueue_message(
                 user_id,
                 f"➖ Admin deducted: -{money(amount)}\n\n💳 Balance before: {bal_before:.3f} {CURRENCY}\n✅ Balance after: {bal_after:.3f} {CURRENCY}",
+                PRIO_CUSTOMER,
             )
             return ConversationHandler.END
         await update.message.reply_text("✅ Done.")
@@ -3962,11 +5153,177 @@ async def rejectdep_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data[UD_ADMIN_MODE] = "rejectdep"
     update.message.text = context.args[0]
     return await admin_input(update, context)
+async def rebuildstats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if admin_role(update.effective_user.id) != ROLE_OWNER:
+        return
+    day = context.args[0] if context.args else None
+    if day and not re.match(r"^\d{4}-\d{2}-\d{2}$", day):
+        return await update.message.reply_text("Usage: /rebuildstats [YYYY-MM-DD]")
+    def _rebuild() -> Tuple[int, int]:
+        with db_write() as c:
+            if day:
+                return 0, rebuild_daily_rollups(c, day)
+            return rebuild_user_stats(c), rebuild_daily_rollups(c)
+    n_users, n_days = await run_db(_rebuild)
+    if day:
+        return await update.message.reply_text(f"✅ Daily rollups for {day} rebuilt: {n_days} rows.")
+    await update.message.reply_text(f"✅ user_stats rebuilt for {n_users} users.\n✅ Daily rollups rebuilt: {n_days} rows.")
+async def coderule_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if admin_role(update.effective_user.id) != ROLE_OWNER:
+        return
+    usage = (
+        "Usage:\n/coderule <pid> — show\n/coderule <pid> <RULE|off> — assign\n"
+        "/coderule new <RULE> <regex> | <message> — add or replace a rule\n"
+        f"Rules: {', '.join(sorted(_code_rules)) or '-'}"
+    )
+    args = context.args or []
+    if len(args) >= 3 and args[0].lower() == "new":
+        rule = args[1].upper()
+        m = re.match(r"^\s*/coderule\s+\S+\s+\S+\s+(.+?)\s*\|\s*(.+)$", update.message.text or "", re.S)
+        if not m:
+            return await update.message.reply_text(usage)
+        pattern, message = m.group(1), m.group(2).strip()
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            return await update.message.reply_text(f"❌ Bad regex: {e}")
+        await run_db(
+            db_execute,
+            "INSERT INTO code_rules(rule, pattern, message) VALUES(?,?,?) "
+            "ON CONFLICT(rule) DO UPDATE SET pattern=excluded.pattern, message=excluded.message",
+            (rule, pattern, message),
+        )
+        await run_db(load_code_rules)
+        return await update.message.reply_text(f"✅ Rule {rule} saved: {pattern}")
+    if not args or not args[0].isdigit() or len(args) > 2:
+        return await update.message.reply_text(usage)
+    pid = int(args[0])
+    if not await run_db(_product_exists, pid):
+        return await update.message.reply_text("❌ Product not found.")
+    if len(args) == 1:
+        rule = await run_db(_pid_code_rule, pid)
+        return await update.message.reply_text(f"PID {pid} code rule: {rule or 'off'}")
+    rule = None if args[1].lower() == "off" else args[1].upper()
+    if rule and rule not in _code_rules:
+        return await update.message.reply_text(f"❌ Unknown rule.\n{usage}")
+    await run_db(db_execute, "UPDATE products SET code_rule=? WHERE pid=?", (rule, pid))
+    bump_catalog_version()
+    await update.message.reply_text(f"✅ PID {pid} code rule: {rule or 'off'}")
+def code_hash_index_ready(c) -> bool:
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_codes_hash'")
+    return c.fetchone() is not None
+def log_code_hash_index():
+    with db_read() as c:
+        ready = code_hash_index_ready(c)
+    if not ready:
+        logger.warning("idx_codes_hash is not enabled: duplicate codes are waiting for /dupcodes resolve")
+def collision_report(limit: int = 200) -> str:
+    with db_read() as c:
+        ready = code_hash_index_ready(c)
+        c.execute("SELECT source, COUNT(*) FROM code_collisions GROUP BY source")
+        by_source = c.fetchall()
+        c.execute(
+            """
+            SELECT id, created_at, source, pid, existing_pid, existing_code_id, code_text
+            FROM code_collisions ORDER BY id DESC LIMIT ?
+            """,
+            (limit,),
+        )
+        rows = c.fetchall()
+    if not rows:
+        return "✅ No code collisions."
+    out = ["⚠️ Code collisions: " + ", ".join(f"{src}={n}" for src, n in by_source), f"Latest {len(rows)}:", ""]
+    out.extend(
+        f"#{i} {at} [{src}] PID {pid} ← {code} "
+        + (f"(sold from deleted PID {epid})" if epid is not None and ecid is None else f"(already in PID {epid if epid is not None else '?'})")
+        for i, at, src, pid, epid, ecid, code in rows
+    )
+    if not ready:
+        out.extend(["", "⚠️ Duplicate codes from the upgrade are still on sale: see /dupcodes"])
+    return "\n".join(out)
+def duplicate_codes_report(limit: int = 200) -> str:
+    with db_read() as c:
+        copies = _duplicate_code_copies(c)
+        ready = code_hash_index_ready(c)
+    if not copies:
+        return "✅ No duplicate codes." if ready else "✅ No duplicate codes left. Send /dupcodes resolve to enable the fingerprint index."
+    out = [
+        f"⚠️ Duplicate codes: {len(copies)} extra copies (still on sale until resolved)",
+        "/dupcodes resolve removes the unsold extra copies and keeps the sold or oldest one.",
+        "",
+    ]
+    out.extend(
+        f"PID {pid} #{code_id} {'SOLD' if used else 'unsold'} ← {text} (kept: PID {keep_pid} #{keep_id})"
+        for _, code_id, pid, text, used, keep_id, keep_pid in copies[:limit]
+    )
+    return "\n".join(out)
+def resolve_duplicate_codes() -> int:
+    with db_write() as c:
+        return dedupe_codes(c)
+async def collisions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if admin_role(update.effective_user.id) != ROLE_OWNER:
+        return
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 200
+    report = await run_db(collision_report, limit)
+    await reply_long_text(update, report, "code_collisions.txt")
+async def dupcodes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if admin_role(update.effective_user.id) != ROLE_OWNER:
+        return
+    if context.args and context.args[0].lower() == "resolve":
+        removed = await run_db(resolve_duplicate_codes)
+        return await update.message.reply_text(f"✅ Removed {removed} duplicate unsold codes. Fingerprint index enabled.")
+    report = await run_db(duplicate_codes_report)
+    await reply_long_text(update, report, "duplicate_codes.txt")
 # =========================
 # Main
 # =========================
+# Updates from different users are handled concurrently, so one slow handler
+# (audit, big import) doesn't hold up everybody else's buttons. A user's own
+# updates still run one at a time and in order: conversation states and
+# user_data never race.
+UPDATE_CONCURRENCY = max(1, int(os.getenv("UPDATE_CONCURRENCY", str(DB_WORKERS * 4))))
+UPDATE_BACKLOG_MAX = 1024
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        # the base semaphore only caps pending tasks; queued updates of a busy user wait
+        # on their user lock without taking one of the max_concurrent_updates slots
+        super().__init__(max(max_concurrent_updates, UPDATE_BACKLOG_MAX))
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_waiting: Dict[int, int] = {}
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        key = user.id if user else (chat.id if chat else None)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        lock = self._user_locks.setdefault(key, asyncio.Lock())
+        self._user_waiting[key] = self._user_waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            self._user_waiting[key] -= 1
+            if not self._user_waiting[key]:
+                del self._user_waiting[key]
+                del self._user_locks[key]
+    async def initialize(self) -> None:
+        pass
+    async def shutdown(self) -> None:
+        pass
 def build_app():
-    app = ApplicationBuilder().token(TOKEN).build()
+    check_env()
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
     CB_PATTERN = r"^(cat:|view:|buy:|confirm:|pay:|paid:|manual:|admin:|orders:|back:|goto:|pos:)"
     conv = ConversationHandler(
         entry_points=[
@@ -3988,6 +5345,10 @@ def build_app():
     app.add_handler(CommandHandler("admin", admin_cmd))
     app.add_handler(CommandHandler("approvedep", approvedep_cmd))
     app.add_handler(CommandHandler("rejectdep", rejectdep_cmd))
+    app.add_handler(CommandHandler("rebuildstats", rebuildstats_cmd))
+    app.add_handler(CommandHandler("coderule", coderule_cmd))
+    app.add_handler(CommandHandler("collisions", collisions_cmd))
+    app.add_handler(CommandHandler("dupcodes", dupcodes_cmd))
     app.add_handler(conv)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_router))
     return app
@@ -0,0 +1,38 @@
+"""Shared setup for the benchmark scripts: import bot.py against a throwaway DB."""
+import importlib.util
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot(bot_path=None, db_path=None):
+    # bot.py reads its settings at import time, so the env has to be in place first
+    db_path = db_path or os.path.join(tempfile.mkdtemp(prefix="shopbench-"), "shop.db")
+    os.environ.update(TOKEN="123456:BENCH", ADMIN_ID="1", DB_PATH=db_path)
+    spec = importlib.util.spec_from_file_location("bot", bot_path or os.path.join(ROOT, "bot.py"))
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules["bot"] = bot
+    spec.loader.exec_module(bot)
+    logging.getLogger("shopbot").setLevel(logging.WARNING)
+    return bot
+
+
+def code_pids(bot, n):
+    rows = bot.db_fetchall("SELECT pid FROM products WHERE code_rule IS NULL ORDER BY pid LIMIT ?", (n,))
+    if len(rows) < n:
+        raise SystemExit(f"need {n} products without a code rule, seed has {len(rows)}")
+    return [pid for (pid,) in rows]
+
+
+def median_ms(fn, runs):
+    samples = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t) * 1000)
+    return statistics.median(samples)
@@ -0,0 +1,59 @@
+"""
+Lock hold time of code allocation: one UPDATE per code (old) vs the single
+set-based CODE_MARK_SOLD_SQL (current). Each run picks qty codes with
+CODE_ALLOC_SQL and marks them sold inside BEGIN IMMEDIATE, then rolls back,
+so stock stays constant and the commit fsync is not measured.
+
+    python scripts/bench_code_alloc.py [--codes 300000] [--products 5] [--runs 40]
+"""
+import argparse
+import sqlite3
+
+from _benchenv import code_pids, load_bot, median_ms
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--codes", type=int, default=300000)
+    ap.add_argument("--products", type=int, default=5)
+    ap.add_argument("--runs", type=int, default=40)
+    ap.add_argument("--qty", type=int, nargs="+", default=[1, 100, 1000])
+    args = ap.parse_args()
+
+    bot = load_bot()
+    bot.init_db()
+    pids = code_pids(bot, args.products)
+    per = args.codes // len(pids)
+    for pid in pids:
+        codes = [(n, f"ALLOC-{pid}-{n:09d}") for n in range(per)]
+        batches = [codes[i:i + bot.CODE_IMPORT_CHUNK] for i in range(0, per, bot.CODE_IMPORT_CHUNK)]
+        _, err = bot.insert_codes(pid, batches)
+        if err:
+            raise SystemExit(err)
+
+    con = sqlite3.connect(bot.DB_PATH, isolation_level=None)
+    pid = pids[0]
+
+    def per_code(qty):
+        con.execute("BEGIN IMMEDIATE")
+        picked = con.execute(bot.CODE_ALLOC_SQL, (pid, qty)).fetchall()
+        for code_id, _, _ in picked:
+            con.execute("UPDATE codes SET used=1, used_at=datetime('now'), order_id=? WHERE code_id=? AND used=0", (0, code_id))
+        con.execute("ROLLBACK")
+
+    def set_based(qty):
+        con.execute("BEGIN IMMEDIATE")
+        con.execute(bot.CODE_ALLOC_SQL, (pid, qty)).fetchall()
+        con.execute(bot.CODE_MARK_SOLD_SQL, (0, pid, qty))
+        con.execute("ROLLBACK")
+
+    print(f"{args.codes} codes across {len(pids)} products, median of {args.runs} runs, SQLite {sqlite3.sqlite_version}")
+    print(f"{'qty':>6}  {'per-code':>10}  {'set-based':>10}")
+    for qty in args.qty:
+        old = median_ms(lambda: per_code(qty), args.runs)
+        new = median_ms(lambda: set_based(qty), args.runs)
+        print(f"{qty:>6}  {old:>8.2f}ms  {new:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
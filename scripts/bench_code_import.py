@@ -0,0 +1,82 @@
+"""
+Pasted-codes import: the old addcodes loop (one INSERT per code inside one
+db_write, IntegrityError counted as a duplicate) vs import_codes_text().
+Two products start with the same --stock codes; each paste has 5% codes
+repeated within the message and 5% codes already in stock, the rest new.
+Old and new runs alternate, each on its own product, so both see the same
+stock growth.
+
+    python scripts/bench_code_import.py [--stock 50000] [--sizes 1000 10000] [--runs 9]
+"""
+import argparse
+import sqlite3
+import statistics
+import time
+
+from _benchenv import code_pids, load_bot
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--stock", type=int, default=50000)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    ap.add_argument("--runs", type=int, default=9)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    bot.init_db()
+    old_pid, new_pid = code_pids(bot, 2)
+    for pid in (old_pid, new_pid):
+        codes = [(n, f"STOCK{pid}-{n:09d}") for n in range(args.stock)]
+        batches, err = bot.insert_codes(pid, [codes[i:i + bot.CODE_IMPORT_CHUNK] for i in range(0, len(codes), bot.CODE_IMPORT_CHUNK)])
+        if err or bot._import_totals(batches)[0] != args.stock:
+            raise SystemExit(err or f"PID {pid} did not get {args.stock} codes")
+
+    def paste(pid, size, run):
+        # every run gets its own fresh codes; in-stock picks are spread over the seed
+        dup = size // 20
+        fresh = [f"P{pid}-{size}-{run}-{n:07d}" for n in range(size - 2 * dup)]
+        stocked = [f"STOCK{pid}-{(n * 7919 + run) % args.stock:09d}" for n in range(dup)]
+        codes = fresh + fresh[:dup] + stocked
+        return [(n, cc) for n, cc in enumerate(codes, 1)]
+
+    def old_loop(pid, lines):
+        added = skipped = 0
+        with bot.db_write() as c:
+            for _, ctext in lines:
+                try:
+                    c.execute(
+                        "INSERT INTO codes(pid,code_text,code_hash,used) VALUES(?,?,?,0)",
+                        (pid, ctext, bot.code_fingerprint(ctext)),
+                    )
+                    added += 1
+                except sqlite3.IntegrityError:
+                    skipped += 1
+        return added, skipped
+
+    print(f"{args.stock} codes in stock per product, median of {args.runs} runs, SQLite {sqlite3.sqlite_version}")
+    print(f"{'paste':>6}  {'old loop':>10}  {'import_codes_text':>18}  counts (added/repeated/in stock/collided)")
+    run = 0
+    for size in args.sizes:
+        old, new = [], []
+        for _ in range(args.runs):
+            run += 1
+            lines = paste(old_pid, size, run)
+            t = time.perf_counter()
+            old_counts = old_loop(old_pid, lines)
+            old.append((time.perf_counter() - t) * 1000)
+
+            lines = paste(new_pid, size, run)
+            t = time.perf_counter()
+            added, repeated, in_stock, collided, err = bot.import_codes_text(new_pid, lines)
+            new.append((time.perf_counter() - t) * 1000)
+            if err:
+                raise SystemExit(err)
+        print(
+            f"{size:>6}  {statistics.median(old):>8.1f}ms  {statistics.median(new):>16.1f}ms"
+            f"  old {old_counts[0]}/{old_counts[1]} skipped, new {added}/{repeated}/{in_stock}/{collided}"
+        )
+
+
+if __name__ == "__main__":
+    main()
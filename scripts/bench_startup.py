@@ -0,0 +1,107 @@
+"""
+Startup cost of bot.py, each sample in a fresh interpreter:
+  compile - bytecode compile of bot.py (paid only when __pycache__ is stale)
+  import  - executing the module body with telegram.ext already imported,
+            and whether that alone creates the DB file
+  init_db - schema + seeds on a fresh DB, then again on an existing one
+Then --starters processes run init_db at the same time on one fresh DB, and
+the script checks none crashed, the migrations ran once and the seed
+produced no duplicates.
+Pass --bot to time another revision, e.g. git show <rev>:bot.py > /tmp/old.py.
+
+    python scripts/bench_startup.py [--runs 5] [--starters 6] [--bot PATH]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from _benchenv import ROOT
+
+PROBE = r"""
+import importlib.util, json, os, sys, time
+import telegram.ext
+bot_path, db_path, do_init = sys.argv[1], sys.argv[2], sys.argv[3] == "1"
+spec = importlib.util.spec_from_file_location("bot", bot_path)
+bot = importlib.util.module_from_spec(spec)
+sys.modules["bot"] = bot
+t = time.perf_counter()
+code = compile(open(bot_path, encoding="utf-8").read(), bot_path, "exec")
+compile_ms = (time.perf_counter() - t) * 1000
+t = time.perf_counter()
+exec(code, bot.__dict__)
+out = {
+    "compile_ms": compile_ms,
+    "import_ms": (time.perf_counter() - t) * 1000,
+    "db_touched": os.path.exists(db_path),
+}
+if do_init and hasattr(bot, "init_db"):
+    t = time.perf_counter()
+    bot.init_db()
+    out["init_ms"] = (time.perf_counter() - t) * 1000
+print(json.dumps(out))
+"""
+
+
+def probe(bot_path, db_path, do_init):
+    env = dict(os.environ, TOKEN="123456:BENCH", ADMIN_ID="1", DB_PATH=db_path)
+    return subprocess.Popen(
+        [sys.executable, "-c", PROBE, bot_path, db_path, "1" if do_init else "0"],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+
+
+def result(proc):
+    out, _ = proc.communicate()
+    if proc.returncode:
+        raise SystemExit(f"probe failed with exit code {proc.returncode}")
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--starters", type=int, default=6)
+    ap.add_argument("--bot", default=os.path.join(ROOT, "bot.py"))
+    args = ap.parse_args()
+    tmp = tempfile.mkdtemp(prefix="shopbench-")
+
+    compiles, imports, touched, fresh, existing = [], [], [], [], []
+    for i in range(args.runs):
+        db = os.path.join(tmp, f"run{i}.db")
+        r = result(probe(args.bot, db, False))
+        compiles.append(r["compile_ms"])
+        imports.append(r["import_ms"])
+        touched.append(r["db_touched"])
+        r = result(probe(args.bot, db, True))
+        fresh.append(r.get("init_ms"))
+        r = result(probe(args.bot, db, True))
+        existing.append(r.get("init_ms"))
+    print(f"{args.bot}, median of {args.runs} runs")
+    print(f"compile: {statistics.median(compiles):.1f} ms")
+    print(f"import body: {statistics.median(imports):.1f} ms, DB file created by import: {any(touched)}")
+    if None not in fresh:
+        print(f"init_db: fresh DB {statistics.median(fresh):.1f} ms, existing DB {statistics.median(existing):.1f} ms")
+
+    db = os.path.join(tmp, "race.db")
+    procs = [probe(args.bot, db, True) for _ in range(args.starters)]
+    crashed = sum(p.wait() != 0 for p in procs)
+    con = sqlite3.connect(db)
+    versions = con.execute("SELECT COUNT(*), COUNT(DISTINCT version) FROM schema_version").fetchone()
+    products = con.execute("SELECT COUNT(*), COUNT(DISTINCT cid || '/' || title) FROM products").fetchone()
+    con.close()
+    ok = not crashed and versions[0] == versions[1] and products[0] == products[1]
+    print(
+        f"{args.starters} concurrent starters: {crashed} crashed, {versions[0]} migrations applied, "
+        f"{products[0]} products ({products[1]} unique) -> {'OK' if ok else 'FAILED'}"
+    )
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+    # bot.py reads its settings at import time: point it at a throwaway DB first
+    os.environ["TOKEN"] = "123456:TEST"
+    os.environ["ADMIN_ID"] = "1"
+    os.environ["DB_PATH"] = str(tmp_path_factory.mktemp("db") / "shop.db")
+    module = importlib.import_module("bot")
+    module.init_db()
+    return module
@@ -0,0 +1,32 @@
+import pytest
+
+
+def _balance(bot, uid):
+    row = bot.db_fetchone("SELECT balance FROM users WHERE user_id=?", (uid,))
+    return row[0] if row else 0.0
+
+
+def test_transfer_moves_balance_with_both_ledger_rows(bot):
+    bot.add_balance_logged(601, 10.0, "TEST")
+    ok, src_before, src_after, dst_before, dst_after = bot.transfer_balance_logged(601, 602, 4.0, "OUT", "IN")
+    assert ok and (src_before, src_after) == (10.0, 6.0) and (dst_before, dst_after) == (0.0, 4.0)
+    rows = bot.db_fetchall("SELECT user_id, delta, source_type FROM balance_ledger WHERE user_id IN (601, 602) AND source_type IN ('OUT','IN')")
+    assert sorted(rows) == [(601, -4.0, "OUT"), (602, 4.0, "IN")]
+
+
+def test_transfer_refuses_insufficient_balance(bot):
+    ok, src_before, *_ = bot.transfer_balance_logged(611, 612, 1.0, "OUT", "IN")
+    assert not ok and src_before == 0.0
+    assert _balance(bot, 612) == 0.0
+
+
+def test_failed_credit_rolls_back_debit(bot, monkeypatch):
+    bot.add_balance_logged(621, 10.0, "TEST")
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("credit failed")
+
+    monkeypatch.setattr(bot, "add_balance_logged", broken)
+    with pytest.raises(RuntimeError):
+        bot.transfer_balance_logged(621, 622, 4.0, "OUT", "IN")
+    assert _balance(bot, 621) == 10.0
@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+PLAN_QUERIES = ["alloc", "mark_sold", "stock"]
+
+
+@pytest.fixture
+def conn(bot):
+    c = sqlite3.connect(bot.DB_PATH)
+    try:
+        yield c
+    finally:
+        c.close()
+
+
+def test_every_code_query_is_checked(bot):
+    assert [name for name, _, _ in bot.CODE_PLAN_QUERIES] == PLAN_QUERIES
+
+
+@pytest.mark.parametrize("name", PLAN_QUERIES)
+def test_code_queries_use_unused_index(bot, conn, name):
+    sql, params = {n: (s, p) for n, s, p in bot.CODE_PLAN_QUERIES}[name]
+    plan = bot.code_query_plan(conn.cursor(), sql, params)
+    assert "idx_codes_unused" in plan, plan
+    assert "TEMP B-TREE" not in plan, plan
+
+
+def test_unused_index_is_partial(conn):
+    (sql,) = conn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND name='idx_codes_unused'").fetchone()
+    assert "WHERE used=0" in sql
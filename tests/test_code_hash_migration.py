@@ -0,0 +1,41 @@
+import sqlite3
+
+
+def _index_exists(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_codes_hash'").fetchone() is not None
+
+
+def test_upgrade_keeps_duplicate_codes_until_resolved(bot, tmp_path, monkeypatch):
+    con = sqlite3.connect(tmp_path / "old.db")
+    con.execute("PRAGMA foreign_keys=ON")
+    monkeypatch.setattr(bot, "MIGRATIONS", [m for m in bot.MIGRATIONS if m[0] <= 13])
+    bot.ensure_schema(con)
+    con.execute("INSERT INTO categories(cid, title) VALUES(1, 'Cards')")
+    con.executemany("INSERT INTO products(pid, cid, title, price) VALUES(?, 1, ?, 1.0)", [(1, "A"), (2, "B")])
+    con.executemany(
+        "INSERT INTO codes(pid, code_text, used) VALUES(?,?,?)",
+        [(1, "DUP-1", 0), (2, "DUP-1", 0), (1, "DUP-2", 1), (2, "DUP-2", 0), (1, "ONLY", 0)],
+    )
+    con.commit()
+    monkeypatch.undo()
+
+    bot.ensure_schema(con)
+    assert con.execute("SELECT COUNT(*) FROM codes").fetchone()[0] == 5
+    assert not _index_exists(con)
+    sources = con.execute("SELECT source, code_text FROM code_collisions ORDER BY code_text").fetchall()
+    assert sources == [("migration", "DUP-1"), ("migration", "DUP-2")]
+
+    removed = bot.dedupe_codes(con.cursor())
+    con.commit()
+    assert removed == 2
+    assert sorted(con.execute("SELECT pid, code_text, used FROM codes").fetchall()) == [(1, "DUP-1", 0), (1, "DUP-2", 1), (1, "ONLY", 0)]
+    assert _index_exists(con)
+    con.close()
+
+
+def test_fresh_db_gets_unique_index(bot):
+    con = sqlite3.connect(bot.DB_PATH)
+    try:
+        assert _index_exists(con)
+    finally:
+        con.close()
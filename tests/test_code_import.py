@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def pids(bot):
+    rows = bot.db_fetchall("SELECT pid FROM products WHERE code_rule IS NULL ORDER BY pid LIMIT 2")
+    return [pid for (pid,) in rows]
+
+
+def _lines(codes):
+    return list(enumerate(codes, 1))
+
+
+def _temp_tables(bot):
+    with bot.db_write() as c:
+        c.execute("SELECT name FROM sqlite_temp_master WHERE type='table'")
+        return c.fetchall()
+
+
+def test_counts_repeats_across_batches_separately_from_stock(bot, pids):
+    pid = pids[0]
+    assert bot.import_codes_text(pid, _lines(["IMP-A", "IMP-B"]))[:4] == (2, 0, 0, 0)
+    chunks = [[(1, "IMP-C"), (2, "IMP-A")], [(3, "IMP-C"), (4, "IMP-D")], [(5, "IMP-D"), (6, "IMP-C")]]
+    batches, err = bot.insert_codes(pid, chunks)
+    assert err == ""
+    assert batches == [(1, 0, 1, 0), (1, 1, 0, 0), (0, 2, 0, 0)]
+    assert _temp_tables(bot) == []
+
+
+def test_collision_repeated_in_input_is_logged_once(bot, pids):
+    bot.import_codes_text(pids[0], _lines(["IMP-X"]))
+    before = bot.db_fetchone("SELECT COUNT(*) FROM code_collisions WHERE code_text='IMP-X'")[0]
+    assert bot.import_codes_text(pids[1], _lines(["IMP-X", "IMP-X", "IMP-Y"]))[:4] == (1, 1, 0, 1)
+    after = bot.db_fetchone("SELECT COUNT(*) FROM code_collisions WHERE code_text='IMP-X'")[0]
+    assert after == before + 1
+
+
+def test_failure_midway_keeps_committed_batches_and_reports_them(bot, pids):
+    def chunks():
+        yield [(1, "IMP-P1"), (2, "IMP-P2")]
+        raise sqlite3.OperationalError("disk I/O error")
+
+    batches, err = bot.insert_codes(pids[0], chunks())
+    assert batches == [(2, 0, 0, 0)]
+    assert "2 codes were already added" in err
+    assert bot.db_fetchone("SELECT COUNT(*) FROM codes WHERE code_text IN ('IMP-P1','IMP-P2')")[0] == 2
+    assert _temp_tables(bot) == []
@@ -0,0 +1,59 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+
+def _update(uid):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=uid), effective_chat=SimpleNamespace(id=uid))
+
+
+def test_app_processes_updates_concurrently(bot):
+    app = bot.build_app()
+    assert isinstance(app.update_processor, bot.PerUserUpdateProcessor)
+    assert app.concurrent_updates > 1
+
+
+def test_other_user_answered_while_slow_run_db_in_flight(bot):
+    async def main():
+        proc = bot.PerUserUpdateProcessor(4)
+        done = []
+
+        async def slow():
+            await bot.run_db(time.sleep, 0.5)
+            done.append("slow")
+
+        async def fast():
+            await bot.run_db(bot.db_fetchone, "SELECT 1")
+            done.append("fast")
+
+        start = time.perf_counter()
+        slow_task = asyncio.create_task(proc.process_update(_update(1), slow()))
+        await asyncio.sleep(0.05)
+        await proc.process_update(_update(2), fast())
+        fast_after = time.perf_counter() - start
+        await slow_task
+        return done, fast_after
+
+    done, fast_after = asyncio.run(main())
+    assert done == ["fast", "slow"]
+    assert fast_after < 0.3
+
+
+def test_same_user_updates_stay_in_order(bot):
+    async def main():
+        proc = bot.PerUserUpdateProcessor(4)
+        done = []
+
+        async def step(name, delay):
+            await asyncio.sleep(delay)
+            done.append(name)
+
+        await asyncio.gather(
+            proc.process_update(_update(7), step("first", 0.1)),
+            proc.process_update(_update(7), step("second", 0)),
+        )
+        return done, proc
+
+    done, proc = asyncio.run(main())
+    assert done == ["first", "second"]
+    assert not proc._user_locks
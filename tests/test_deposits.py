@@ -0,0 +1,15 @@
+def test_details_only_update_own_pending_deposit(bot):
+    dep = bot.create_deposit(501, "USDT", "test")
+    assert bot.submit_deposit_details(dep, 502, 10.0, "TX-OTHER") == "NOT_FOUND"
+    assert bot.submit_deposit_details(dep, 501, 10.0, "TX-1") == "OK"
+    assert bot.approve_deposit(dep)[0] == "OK"
+    assert bot.submit_deposit_details(dep, 501, 99.0, "TX-2") == "NOT_PENDING"
+    assert bot.db_fetchone("SELECT status, amount, txid FROM deposits WHERE id=?", (dep,)) == ("APPROVED", 10.0, "TX-1")
+
+
+def test_reject_only_pending_deposit(bot):
+    dep = bot.create_deposit(503, "USDT", "test")
+    assert bot.submit_deposit_details(dep, 503, 5.0, "TX") == "OK"
+    assert bot.approve_deposit(dep)[0] == "OK"
+    assert bot.reject_deposit(dep) == ("NOT_PENDING", 503)
+    assert bot.db_fetchone("SELECT status FROM deposits WHERE id=?", (dep,)) == ("APPROVED",)